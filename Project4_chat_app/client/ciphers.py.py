@@ -0,0 +1,118 @@
+import base64
+import os
+import struct
+import threading
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+NONCE_PREFIX_SIZE = 8
+NONCE_SIZE = NONCE_PREFIX_SIZE + 4
+MAX_COUNTER = 0xFFFFFFFF
+
+
+class FernetSuite:
+    """AES-128-CBC + HMAC-SHA256, base64 encoded. Kept for clients that only speak Fernet."""
+
+    name = 'fernet'
+    suite_id = None
+
+    def __init__(self, key):
+        self.cipher = Fernet(key)
+
+    def encrypt(self, data):
+        return self.cipher.encrypt(data)
+
+    def decrypt(self, token):
+        return self.cipher.decrypt(token)
+
+
+class AEADSuite:
+    """Raw binary AEAD tokens: suite id (1 byte) + nonce (12 bytes) + ciphertext + 16-byte tag.
+
+    The key is derived from the shared Fernet key with HKDF, one per suite.
+    Nonces are a random 8-byte prefix chosen per process plus a 4-byte
+    counter, so they never repeat within a process and collide across
+    processes only if two random prefixes do; the prefix is redrawn before
+    the counter wraps.
+    """
+
+    name = None
+    suite_id = None
+    algorithm = None
+
+    def __init__(self, key):
+        secret = base64.urlsafe_b64decode(key)
+        hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b'chat-app ' + self.name.encode('ascii'))
+        self.cipher = self.algorithm(hkdf.derive(secret))
+        self.lock = threading.Lock()
+        self.prefix = os.urandom(NONCE_PREFIX_SIZE)
+        self.counter = 0
+
+    def nonce(self):
+        with self.lock:
+            if self.counter == MAX_COUNTER:
+                self.prefix = os.urandom(NONCE_PREFIX_SIZE)
+                self.counter = 0
+            self.counter += 1
+            return self.prefix + struct.pack('>I', self.counter)
+
+    def encrypt(self, data):
+        nonce = self.nonce()
+        # The suite id is authenticated too, so a token cannot be replayed under another suite
+        return self.suite_id + nonce + self.cipher.encrypt(nonce, data, self.suite_id)
+
+    def decrypt(self, token):
+        try:
+            return self.cipher.decrypt(token[1:1 + NONCE_SIZE], token[1 + NONCE_SIZE:], self.suite_id)
+        except InvalidTag:
+            raise InvalidToken
+
+
+class AESGCMSuite(AEADSuite):
+    name = 'aes-256-gcm'
+    suite_id = b'\x01'
+    algorithm = AESGCM
+
+
+class ChaCha20Suite(AEADSuite):
+    name = 'chacha20-poly1305'
+    suite_id = b'\x02'
+    algorithm = ChaCha20Poly1305
+
+
+SUITES = {suite.name: suite for suite in (AESGCMSuite, ChaCha20Suite, FernetSuite)}
+# In order of preference when negotiating; AES-GCM wins where AES-NI is available
+SUPPORTED = ['aes-256-gcm', 'chacha20-poly1305', 'fernet']
+DEFAULT_SUITE = 'fernet'
+
+
+def negotiate(offered, allowed=SUPPORTED):
+    """Pick the first suite in `allowed` that the peer offered; peers that offer nothing get Fernet."""
+    if isinstance(offered, list):
+        for name in allowed:
+            if name in offered:
+                return name
+    return DEFAULT_SUITE
+
+
+class CipherSuites:
+    """Every supported suite under one shared key.
+
+    Tokens are self-describing: AEAD tokens start with their suite id byte,
+    while Fernet tokens are base64 text and always start with 'g'. So
+    decrypt() needs no per-connection state, and peers on different suites
+    can share a room.
+    """
+
+    def __init__(self, key):
+        self.suites = {name: cls(key) for name, cls in SUITES.items()}
+        self.by_id = {suite.suite_id: suite for suite in self.suites.values() if suite.suite_id}
+
+    def encrypt(self, data, suite=None):
+        return self.suites[suite or DEFAULT_SUITE].encrypt(data)
+
+    def decrypt(self, token):
+        return self.by_id.get(token[:1], self.suites[DEFAULT_SUITE]).decrypt(token)
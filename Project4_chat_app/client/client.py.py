@@ -2,19 +2,47 @@ import socket
 import threading
 import json
 import time
+import hashlib
+import itertools
+import os
+from ciphers import SUPPORTED as CIPHER_SUITES
+from compression import SUPPORTED as COMPRESSION_CODECS
 from encryption import EncryptionManager
+from protocol import (FRAME_BLOB, FRAME_CHAT, FRAME_JSON, FRAME_RECORD, FRAME_SEQ, RECV_SIZE, FrameReader,
+                      ProtocolError, decode_blob, decode_seq, encode_blob, encode_chat, encode_json)
+from records import TEXT, RecordError, decode_record, unpack
 from gui import ChatGUI
 
+ATTACHMENT_CHUNK = 64 * 1024
+FETCH_RANGE = 1024 * 1024
+BLOB_CACHE_SIZE = 32
+# A throttled range request is retried, after the wait the server asks for, this many times in a row
+FETCH_RETRIES = 5
+# Seconds to wait before each attempt to resume a dropped session
+RECONNECT_DELAYS = (0.5, 1, 2, 4, 8)
+
 class ChatClient:
     def __init__(self, host='127.0.0.1', port=5555):
         self.host = host
         self.port = port
         self.client = None
+        self.reader = None
         self.encryption = EncryptionManager()
         self.gui = None
         self.username = None
         self.current_room = None
+        self.roster = {}  # {username: 'active' | 'idle'} for the current room, kept current by presence diffs
+        self.compression = None
+        self.cipher_suite = None
+        self.session = None  # token for reconnecting without the password
+        self.last_seq = 0  # id of the newest message seen in the current room
+        self.history_cursor = None  # oldest message shown, where /history continues from
         self.running = False
+        self.send_lock = threading.Lock()
+        self.transfer_ids = itertools.count(1)
+        self.uploads = {}  # {upload_id: {'event': Event, 'reply': dict}}
+        self.fetches = {}  # {request_id: {'sha256', 'size', 'data', 'callback'}}
+        self.blob_cache = {}
         print(f"Client initialized, connecting to {host}:{port}")
 
     def initialize_socket(self):
@@ -23,6 +51,7 @@ class ChatClient:
             self.client.close()
         self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.client.settimeout(5)
+        self.reader = FrameReader(self.client, RECV_SIZE)
 
     def connect(self, username, password, action):
         """Connect to server and authenticate with proper error handling"""
@@ -35,20 +64,19 @@ class ChatClient:
             auth_data = {
                 'action': action,
                 'username': username,
-                'password': password
+                'password': password,
+                **self.capabilities()
             }
 
-            self.client.send(json.dumps(auth_data).encode('utf-8'))
-            response = self.client.recv(4096)
-
-            if not response:
+            self.send_frame(encode_json(auth_data))
+            try:
+                response_data = self.reader.read_json()
+            except ConnectionError:
                 return False, "No response from server"
 
-            response_data = json.loads(response.decode('utf-8'))
-
             if response_data.get('status') == 'success':
                 self.username = username
-                self.running = True
+                self.accept_login(response_data)
                 return True, response_data.get('rooms', [])
 
             return False, response_data.get('message', 'Authentication failed')
@@ -60,11 +88,54 @@ class ChatClient:
         except Exception as e:
             return False, f"Connection error: {str(e)}"
 
+    @staticmethod
+    def capabilities():
+        """What this client offers in every auth request"""
+        return {'compression': COMPRESSION_CODECS, 'ciphers': CIPHER_SUITES, 'heartbeat': True, 'resume': True,
+                'records': True}
+
+    def accept_login(self, response_data):
+        """Take the negotiated settings and session token from a successful auth reply"""
+        self.compression = response_data.get('compression')
+        self.cipher_suite = response_data.get('cipher')
+        self.session = response_data.get('session')
+        self.running = True
+
+    def resume(self):
+        """Reconnect a dropped connection with the session token instead of the password.
+
+        The server replays only the messages after the last one seen, which
+        are appended to what the window already shows. Returns False if the
+        server stayed unreachable or the session expired.
+        """
+        for delay in RECONNECT_DELAYS:
+            time.sleep(delay)
+            if not self.running or not self.session:
+                return False
+            try:
+                self.initialize_socket()
+                self.client.connect((self.host, self.port))
+                self.send({'action': 'resume', 'token': self.session, **self.capabilities()})
+                response_data = self.reader.read_json()
+                if response_data.get('status') != 'success':
+                    self.session = None
+                    return False
+                self.accept_login(response_data)
+                self.send({'room': self.current_room, 'since': self.last_seq,
+                           'history_cursor': self.history_cursor})
+                self.client.settimeout(None)
+                print("Session resumed")
+                return True
+            except (OSError, ProtocolError, ValueError) as e:
+                print(f"Reconnect failed: {e}")
+        return False
+
     def join_room(self, room):
         """Join a chat room with error handling"""
         try:
-            self.client.send(json.dumps({'room': room}).encode('utf-8'))
+            self.send_frame(encode_json({'room': room}))
             self.current_room = room
+            self.client.settimeout(None)
 
             receive_thread = threading.Thread(target=self.receive_messages)
             receive_thread.daemon = True
@@ -80,28 +151,44 @@ class ChatClient:
         """Receive and process messages from server"""
         while self.running:
             try:
-                message = self.client.recv(4096)
-                if not message:
+                frame = self.reader.read_frame()
+                if frame is None:
                     print("Server closed connection")
+                    if self.resume():
+                        continue
                     self.running = False
                     break
 
-                try:
-                    decoded = json.loads(message.decode('utf-8'))
-                    if decoded.get('type') == 'room_change':
-                        self.current_room = decoded['room']
-                        if self.gui:
-                            self.gui.update_message_history(decoded.get('history', []))
-                    continue
-                except json.JSONDecodeError:
-                    pass
+                frame_type, payload = frame
+                if frame_type == FRAME_JSON:
+                    self.handle_control(json.loads(payload.decode('utf-8')))
+                elif frame_type == FRAME_CHAT:
+                    decrypted = self.encryption.decrypt(payload)
+                    if self.gui:
+                        self.gui.display_message(decrypted)
+                elif frame_type == FRAME_RECORD:
+                    record = decode_record(self.encryption.decrypt_raw(payload))
+                    if record.kind == TEXT and record.room == self.current_room:
+                        self.last_seq = max(self.last_seq, record.id)
+                    if self.gui:
+                        self.gui.display_message(record)
+                elif frame_type == FRAME_SEQ:
+                    seq, token = decode_seq(payload)
+                    self.last_seq = max(self.last_seq, seq)
+                    decrypted = self.encryption.decrypt(token)
+                    if self.gui:
+                        self.gui.display_message(decrypted)
+                elif frame_type == FRAME_BLOB:
+                    self.receive_blob_chunk(payload)
 
-                decrypted = self.encryption.decrypt(message)
-                if self.gui:
-                    self.gui.display_message(decrypted)
-
-            except ConnectionResetError:
+            except (ProtocolError, RecordError) as e:
+                print(f"Protocol error: {e}")
+                self.running = False
+                break
+            except ConnectionError:
                 print("Connection reset by server")
+                if self.resume():
+                    continue
                 self.running = False
                 if self.gui:
                     self.gui.show_error("Connection lost with server")
@@ -112,14 +199,93 @@ class ChatClient:
                     self.gui.show_error(f"Connection error: {str(e)}")
                 break
 
+    @staticmethod
+    def messages_of(decoded, room, key='history'):
+        """The messages of a history or mailbox frame: Records, or text lines from a server without records"""
+        if 'records' in decoded:
+            return [unpack(room, fields) for fields in decoded['records']]
+        return decoded.get(key, [])
+
+    def handle_control(self, decoded):
+        """Handle a JSON control frame from the server"""
+        if decoded.get('type') == 'room_change':
+            self.current_room = decoded['room']
+            self.last_seq = decoded.get('latest_id', 0)
+            messages = self.messages_of(decoded, decoded['room'])
+            if decoded.get('resumed'):
+                if self.gui:
+                    for message in messages:
+                        self.gui.display_message(message)
+                return
+            self.history_cursor = decoded.get('oldest_id')
+            if self.gui:
+                self.gui.update_message_history(messages)
+        elif decoded.get('type') == 'history':
+            self.history_cursor = decoded.get('oldest_id')
+            if self.gui:
+                self.gui.prepend_history(self.messages_of(decoded, decoded.get('room')), decoded.get('has_more', False))
+        elif decoded.get('type') in ('upload_ready', 'upload_done', 'upload_failed'):
+            waiter = self.uploads.get(decoded.get('upload_id'))
+            if waiter:
+                waiter['reply'] = decoded
+                waiter['event'].set()
+        elif decoded.get('type') == 'ping':
+            self.send({'type': 'pong'})
+        elif decoded.get('type') == 'roster':
+            self.roster = dict(decoded.get('users', []))
+            if self.gui:
+                self.gui.update_users(self.roster)
+        elif decoded.get('type') == 'presence':
+            if decoded.get('room') != self.current_room:
+                return
+            # Diffs are idempotent: re-applying one that overlaps the last roster changes nothing
+            for username in decoded.get('joined', []) + decoded.get('active', []):
+                self.roster[username] = 'active'
+            for username in decoded.get('idle', []):
+                self.roster[username] = 'idle'
+            for username in decoded.get('left', []):
+                self.roster.pop(username, None)
+            if self.gui:
+                self.gui.update_users(self.roster)
+        elif decoded.get('type') == 'mailbox':
+            # Direct messages that arrived while we were offline, oldest first
+            if self.gui:
+                for message in self.messages_of(decoded, decoded.get('recipient'), 'messages'):
+                    self.gui.display_message(message)
+        elif decoded.get('type') == 'search_results':
+            for result in decoded.get('results', []):
+                if 'record' in result:
+                    result['record'] = unpack(result['room'], result['record'])
+            if self.gui:
+                self.gui.show_search_results(decoded)
+        elif decoded.get('type') == 'rooms':
+            if self.gui:
+                self.gui.update_rooms(decoded.get('rooms', []))
+        elif decoded.get('type') == 'throttled':
+            # Throttled downloads are retried by themselves, and uploads are only slowed down
+            if self.gui and decoded.get('kind') != 'transfer':
+                self.gui.display_message(f"⚠️ Slow down: too many {decoded.get('kind', 'messages')}, "
+                                         f"try again in {decoded.get('retry_after', 1)}s")
+        elif decoded.get('type') == 'fetch_done':
+            self.continue_fetch(decoded['request_id'], decoded.get('length', 0))
+        elif decoded.get('type') == 'fetch_failed':
+            state = self.fetches.get(decoded.get('request_id'))
+            if state and decoded.get('retry_after') is not None and state['retries'] < FETCH_RETRIES:
+                state['retries'] += 1
+                threading.Timer(decoded['retry_after'], self.retry_range, (decoded['request_id'],)).start()
+                return
+            state = self.fetches.pop(decoded.get('request_id'), None)
+            if state:
+                state['callback'](None)
+
     def send_message(self, message):
         """Send message to server with encryption"""
         if not message or not self.running:
             return False
 
         try:
-            encrypted = self.encryption.encrypt(message)
-            self.client.send(encrypted)
+            encrypted = self.encryption.encrypt(message, self.compression, self.cipher_suite)
+            self.send_frame(encode_chat(encrypted))
             return True
         except Exception as e:
             print(f"Error sending message: {e}")
@@ -127,6 +293,112 @@ class ChatClient:
                 self.gui.show_error("Failed to send message")
             return False
 
+    def wait_upload_reply(self, waiter, timeout):
+        if not waiter['event'].wait(timeout):
+            return {'type': 'upload_failed', 'message': 'Server did not respond'}
+        waiter['event'].clear()
+        return waiter['reply']
+
+    def send_attachment(self, filepath):
+        """Upload a file in chunks over the attachment channel.
+
+        The room only receives a small [FILE] reference; the server skips the
+        transfer if it already has the same content. Past its transfer limit
+        the server reads chunks more slowly, which paces the sends below.
+        Returns (success, reference line or error message).
+        """
+        digest = hashlib.sha256()
+        size = 0
+        with open(filepath, 'rb') as f:
+            for block in iter(lambda: f.read(ATTACHMENT_CHUNK), b''):
+                digest.update(block)
+                size += len(block)
+        sha256 = digest.hexdigest()
+        name = os.path.basename(filepath)
+
+        upload_id = next(self.transfer_ids)
+        waiter = {'event': threading.Event(), 'reply': None}
+        self.uploads[upload_id] = waiter
+        try:
+            self.send({'type': 'upload_start', 'upload_id': upload_id, 'sha256': sha256, 'size': size, 'name': name})
+            reply = self.wait_upload_reply(waiter, 30)
+            if reply['type'] == 'upload_ready':
+                with open(filepath, 'rb') as f:
+                    for block in iter(lambda: f.read(ATTACHMENT_CHUNK), b''):
+                        self.send_frame(encode_blob(upload_id, self.encryption.encrypt(block, suite=self.cipher_suite)))
+                self.send({'type': 'upload_end', 'upload_id': upload_id})
+                reply = self.wait_upload_reply(waiter, 60)
+        finally:
+            self.uploads.pop(upload_id, None)
+
+        if reply['type'] == 'upload_done':
+            return True, f"[FILE]{sha256}:{size}:{name}"
+        return False, reply.get('message', 'Upload failed')
+
+    def fetch_attachment(self, sha256, size, callback):
+        """Download an attachment lazily, one range at a time; callback(bytes or None) runs on completion
+
+        A range the server throttles comes back as fetch_failed with a
+        retry_after, and is asked for again after that long.
+        """
+        if sha256 in self.blob_cache:
+            callback(self.blob_cache[sha256])
+            return
+        request_id = next(self.transfer_ids)
+        self.fetches[request_id] = {'sha256': sha256, 'size': size, 'data': bytearray(), 'callback': callback,
+                                    'retries': 0}
+        self.request_range(request_id, 0)
+
+    def request_range(self, request_id, offset):
+        state = self.fetches[request_id]
+        self.send({'type': 'fetch', 'request_id': request_id, 'sha256': state['sha256'],
+                   'offset': offset, 'length': FETCH_RANGE})
+
+    def retry_range(self, request_id):
+        """Ask again for the range a throttled fetch was refused"""
+        state = self.fetches.get(request_id)
+        if state and self.running:
+            self.request_range(request_id, len(state['data']))
+
+    def receive_blob_chunk(self, payload):
+        request_id, token = decode_blob(payload)
+        state = self.fetches.get(request_id)
+        if state:
+            state['data'] += self.encryption.decrypt_bytes(token)
+
+    def continue_fetch(self, request_id, length):
+        """Ask for the next range, or verify and hand over the finished download"""
+        state = self.fetches.get(request_id)
+        if not state:
+            return
+        received = len(state['data'])
+        state['retries'] = 0
+        if length and received < state['size']:
+            self.request_range(request_id, received)
+            return
+        del self.fetches[request_id]
+        data = bytes(state['data'])
+        if hashlib.sha256(data).hexdigest() != state['sha256']:
+            state['callback'](None)
+            return
+        if len(self.blob_cache) >= BLOB_CACHE_SIZE:
+            self.blob_cache.pop(next(iter(self.blob_cache)))
+        self.blob_cache[state['sha256']] = data
+        state['callback'](data)
+
+    def request_history(self):
+        """Ask the server for the next page of older messages in the current room"""
+        return self.send_message('/history')
+
+    def search(self, terms, all_rooms=False, page=1):
+        """Full-text search of the current room's history (or every room's); results arrive as 'search_results'"""
+        scope = ' room:all' if all_rooms else ''
+        return self.send_message(f"/search {terms}{scope} page:{page}")
+
+    def send_direct(self, username, message):
+        """Send a private message to one user; the server keeps it for them if they are offline"""
+        return self.send_message(f"/msg {username} {message}")
+
     def change_room(self, room_name):
         """Change the chat room"""
         try:
@@ -138,10 +410,14 @@ class ChatClient:
             if self.gui:
                 self.gui.show_error(f"Error changing room: {str(e)}")
 
+    def send_frame(self, frame):
+        """Send one encoded frame; the lock keeps frames from different threads from interleaving"""
+        with self.send_lock:
+            self.client.sendall(frame)
+
     def send(self, data):
-        """Send raw JSON data"""
-        message = json.dumps(data).encode()
-        self.client.send(message)
+        """Send a JSON control frame"""
+        self.send_frame(encode_json(data))
 
     def disconnect(self):
         """Cleanly disconnect from server"""
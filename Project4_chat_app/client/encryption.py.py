@@ -1,16 +1,25 @@
-from cryptography.fernet import Fernet
+from ciphers import CipherSuites
+from compression import CompressionStage
 
 class EncryptionManager:
     def __init__(self):
         self.key = b'CdkW6E-EpEDi3B_fI3NKFrjZEG3FyhM3kyehQ2kuU5c='  # MUST have b prefix
-        self.cipher = Fernet(self.key)
+        self.cipher = CipherSuites(self.key)
+        self.compression = CompressionStage()
 
-    def encrypt(self, message):
+    def encrypt(self, message, codec=None, suite=None):
         if isinstance(message, str):
             message = message.encode('utf-8')
-        return self.cipher.encrypt(message)
+        return self.cipher.encrypt(self.compression.compress(message, codec), suite)
 
     def decrypt(self, encrypted_message):
+        return self.decrypt_raw(encrypted_message).decode('utf-8')
+
+    def decrypt_raw(self, encrypted_message):
+        """Decrypt and decompress a payload (a chat line or a binary record) without decoding it as text"""
         if isinstance(encrypted_message, str):
             encrypted_message = encrypted_message.encode('utf-8')
-        return self.cipher.decrypt(encrypted_message).decode('utf-8')
\ No newline at end of file
+        return self.compression.decompress(self.cipher.decrypt(encrypted_message))
+
+    def decrypt_bytes(self, encrypted_message):
+        return self.cipher.decrypt(encrypted_message)
\ No newline at end of file
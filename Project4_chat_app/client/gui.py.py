@@ -9,6 +9,7 @@ import threading
 import pystray
 from pystray import MenuItem as item
 from PIL import Image as PILImage
+from records import NOTICE, Record, render
 
 class ChatGUI(tk.Tk):
     def __init__(self, client):
@@ -85,9 +86,26 @@ class ChatGUI(tk.Tk):
         main_area = ttk.Frame(self.chat_frame)
         main_area.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True)
         
+        # Search box: full-text search over the current room, or every room
+        search_frame = ttk.Frame(main_area)
+        search_frame.pack(fill=tk.X, padx=5, pady=(5, 0))
+        self.search_entry = ttk.Entry(search_frame)
+        self.search_entry.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.search_entry.bind("<Return>", self.run_search)
+        self.search_all_rooms = tk.BooleanVar(value=False)
+        ttk.Checkbutton(search_frame, text="All rooms", variable=self.search_all_rooms).pack(side=tk.LEFT, padx=5)
+        ttk.Button(search_frame, text="Search", command=self.run_search).pack(side=tk.LEFT)
+        self.search_window = None
+        self.search_query = None
+
+        self.history_button = ttk.Button(main_area, text="Load older messages", command=self.client.request_history)
+        self.history_button.pack(fill=tk.X, padx=5, pady=(5, 0))
+
         # Message display
         self.message_text = tk.Text(main_area, wrap=tk.WORD, state=tk.DISABLED)
         self.message_text.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        self.message_text.tag_configure('attachment', foreground='blue', underline=True)
+        self.attachment_links = 0
         
         # Message input area
         input_frame = ttk.Frame(main_area)
@@ -148,8 +166,7 @@ class ChatGUI(tk.Tk):
             self.chat_frame.pack(fill=tk.BOTH, expand=True)
             
             # Populate room list
-            for room in response:
-                self.room_listbox.insert(tk.END, room)
+            self.update_rooms(response)
             
             # Join default room
             self.client.join_room('general')
@@ -164,33 +181,87 @@ class ChatGUI(tk.Tk):
             self.message_entry.delete(0, tk.END)
 
     def display_message(self, message):
-        """Display incoming message in the chat window"""
+        """Display an incoming message (a Record, or a text line) in the chat window"""
         self.message_text.config(state=tk.NORMAL)
-        
+        text = render(message) if isinstance(message, Record) else message
+        if isinstance(message, Record) and message.kind != NOTICE:
+            # "[time] sender: " is drawn from the record's fields, the body exactly as sent
+            prefix, body = render(message._replace(body='')), message.body
+        else:
+            prefix, body = '', text
+
         # Check if message contains an image
-        if message.startswith('[IMAGE]'):
-            img_data = message[7:]
+        if body.startswith('[IMAGE]'):
+            img_data = body[7:]
             self.display_image(img_data)
+        elif '[FILE]' in body:
+            before, _, reference = body.partition('[FILE]')
+            self.display_file_link(prefix + before, reference)
+        elif prefix:
+            self.message_text.insert(tk.END, prefix, 'username')
+            self.message_text.insert(tk.END, body + '\n')
         else:
             # Format regular message
-            if ':' in message:
-                username, msg_content = message.split(':', 1)
+            if ':' in text:
+                username, msg_content = text.split(':', 1)
                 self.message_text.insert(tk.END, username + ':', 'username')
                 self.message_text.insert(tk.END, msg_content + '\n')
             else:
-                self.message_text.insert(tk.END, message + '\n')
+                self.message_text.insert(tk.END, text + '\n')
         
         self.message_text.config(state=tk.DISABLED)
         self.message_text.see(tk.END)
         
         # Show notification if window not focused
         if not self.focus_get():
-            self.show_notification(message)
+            self.show_notification(text)
+
+    def display_file_link(self, prefix, reference):
+        """Show an attachment reference as a link; the file is only downloaded when clicked"""
+        try:
+            sha256, size, name = reference.split(':', 2)
+            size = int(size)
+        except ValueError:
+            self.message_text.insert(tk.END, prefix + '[FILE]' + reference + '\n')
+            return
+        self.attachment_links += 1
+        tag = f"attachment-{self.attachment_links}"
+        self.message_text.insert(tk.END, prefix, 'username')
+        self.message_text.insert(tk.END, f"📎 {name} ({max(1, size // 1024)} KB)", ('attachment', tag))
+        self.message_text.insert(tk.END, '\n')
+        self.message_text.tag_bind(tag, '<Button-1>', lambda e: self.open_attachment(sha256, size, name))
+
+    def open_attachment(self, sha256, size, name):
+        """Fetch an attachment from the server and show or save it"""
+        self.client.fetch_attachment(sha256, size, lambda data: self.after(0, self.show_attachment, name, data))
+
+    def show_attachment(self, name, data):
+        if data is None:
+            messagebox.showerror("Error", f"Failed to download {name}")
+            return
+        try:
+            Image.open(io.BytesIO(data)).verify()
+        except Exception:
+            path = filedialog.asksaveasfilename(initialfile=name)
+            if path:
+                with open(path, 'wb') as f:
+                    f.write(data)
+            return
+        self.message_text.config(state=tk.NORMAL)
+        self.display_image_bytes(data)
+        self.message_text.config(state=tk.DISABLED)
+        self.message_text.see(tk.END)
 
     def display_image(self, img_data):
         """Display base64 encoded image in chat"""
         try:
-            img_bytes = base64.b64decode(img_data)
+            self.display_image_bytes(base64.b64decode(img_data))
+        except Exception as e:
+            self.message_text.insert(tk.END, f"[Failed to display image: {str(e)}]\n")
+
+    def display_image_bytes(self, img_bytes):
+        """Display raw image bytes in chat"""
+        try:
             img = Image.open(io.BytesIO(img_bytes))
             img.thumbnail((400, 400))
             
@@ -223,6 +294,63 @@ class ChatGUI(tk.Tk):
         
         self.message_text.config(state=tk.DISABLED)
         self.message_text.see(tk.END)
+        self.history_button.config(state=tk.NORMAL)
+
+    def prepend_history(self, messages, has_more):
+        """Insert an older page of history above what is already shown"""
+        self.message_text.config(state=tk.NORMAL)
+        for message in reversed(messages):
+            self.message_text.insert('1.0', (render(message) if isinstance(message, Record) else message) + '\n')
+        self.message_text.config(state=tk.DISABLED)
+        self.history_button.config(state=tk.NORMAL if has_more else tk.DISABLED)
+
+    def run_search(self, event=None, page=1):
+        """Send the search box's terms; page > 1 fetches more results for the same search"""
+        if page == 1:
+            terms = self.search_entry.get().strip()
+            if not terms:
+                return
+            self.search_query = (terms, self.search_all_rooms.get())
+        if self.search_query:
+            self.client.search(*self.search_query, page=page)
+
+    def show_search_results(self, results):
+        """Show one page of ranked search results in a separate window"""
+        if self.search_window is None or not self.search_window.winfo_exists():
+            self.search_window = tk.Toplevel(self)
+            self.search_window.title("Search results")
+            self.search_text = tk.Text(self.search_window, wrap=tk.WORD, state=tk.DISABLED, width=80, height=25)
+            self.search_text.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+            self.search_more = ttk.Button(self.search_window, text="More results")
+            self.search_more.pack(fill=tk.X, padx=5, pady=(0, 5))
+
+        page = results.get('page', 1)
+        self.search_text.config(state=tk.NORMAL)
+        if page == 1:
+            self.search_text.delete(1.0, tk.END)
+            scope = results.get('room') or "all rooms"
+            self.search_text.insert(tk.END, f"Results for {' '.join(results.get('terms', []))} in {scope}:\n")
+        for result in results.get('results', []):
+            line = render(result['record']) if 'record' in result else result['line']
+            self.search_text.insert(tk.END, f"#{result['room']} {line}\n")
+        if page == 1 and not results.get('results'):
+            self.search_text.insert(tk.END, "No matches\n")
+        self.search_text.config(state=tk.DISABLED)
+        self.search_more.config(command=lambda: self.run_search(page=page + 1),
+                                state=tk.NORMAL if results.get('has_more') else tk.DISABLED)
+        self.search_window.lift()
+
+    def update_users(self, roster):
+        """Redraw the Online Users list from the client's local roster {username: 'active' | 'idle'}"""
+        self.user_listbox.delete(0, tk.END)
+        for username, state in sorted(roster.items()):
+            self.user_listbox.insert(tk.END, username if state == 'active' else f"{username} (idle)")
+
+    def update_rooms(self, rooms):
+        """Replace the room list, e.g. after someone runs /create or /delete"""
+        self.room_listbox.delete(0, tk.END)
+        for room in rooms:
+            self.room_listbox.insert(tk.END, room)
 
     def on_room_select(self, event):
         """Handle room selection change"""
@@ -257,15 +385,19 @@ class ChatGUI(tk.Tk):
         )
         
         if filepath:
-            try:
-                with open(filepath, 'rb') as f:
-                    file_data = f.read()
-                
-                # Convert to base64 for transmission
-                encoded = base64.b64encode(file_data).decode('utf-8')
-                self.client.send_message(f"[IMAGE]{encoded}")
-            except Exception as e:
-                messagebox.showerror("Error", f"Failed to send file: {str(e)}")
+            # Upload in the background so large files don't freeze the window
+            threading.Thread(target=self.upload_file, args=(filepath,), daemon=True).start()
+
+    def upload_file(self, filepath):
+        """Send a file over the attachment channel and show our own reference to it"""
+        try:
+            success, result = self.client.send_attachment(filepath)
+        except Exception as e:
+            success, result = False, str(e)
+        if success:
+            self.after(0, self.display_message, f"{self.client.username}: {result}")
+        else:
+            self.after(0, messagebox.showerror, "Error", f"Failed to send file: {result}")
 
     def on_close(self):
         """Handle window close event"""
@@ -0,0 +1,299 @@
+"""Headless load generator for the chat server.
+
+Simulates N users from one process without Tk: each registers (or logs in),
+joins a room drawn from --rooms, then for --duration seconds sends chat
+messages at --rate per second, now and then switching rooms with /join,
+asking for /users or uploading an attachment. Every chat line carries its
+send time, so receivers measure end-to-end fan-out latency.
+
+Reports connect time, p50/p95/p99 fan-out latency, messages sent and
+delivered per second and, given --server-pid, the server's peak RSS
+(worker processes included).
+
+    python loadgen.py --users 200 --rate 1 --duration 30 --server-pid $(pgrep -f server.py | head -1)
+"""
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import os
+import random
+import time
+from ciphers import SUPPORTED as CIPHER_SUITES
+from compression import SUPPORTED as COMPRESSION_CODECS
+from encryption import EncryptionManager
+from protocol import (FRAME_CHAT, FRAME_JSON, RECV_SIZE, FrameDecoder,
+                      encode_blob, encode_chat, encode_json)
+
+TAG = 'LOADGEN'
+ATTACHMENT_CHUNK = 64 * 1024
+
+
+def percentile(samples, pct):
+    if not samples:
+        return float('nan')
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def parse_rooms(spec):
+    """'general=0.6,random=0.3,support=0.1' -> (rooms, weights)"""
+    rooms, weights = [], []
+    for part in spec.split(','):
+        name, _, weight = part.partition('=')
+        rooms.append(name.strip())
+        weights.append(float(weight or 1))
+    return rooms, weights
+
+
+def process_rss(pid):
+    """Resident set size in bytes of `pid` and all its descendants, from /proc (Linux only)."""
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+            for task in os.listdir(f'/proc/{current}/task'):
+                with open(f'/proc/{current}/task/{task}/children') as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except (OSError, ValueError):
+            continue
+    return total
+
+
+class Stats:
+    def __init__(self):
+        self.connect_times = []
+        self.latencies = []
+        self.connect_failures = 0
+        self.sent = 0
+        self.delivered = 0
+        self.commands = 0
+        self.uploads = 0
+        self.errors = 0
+        self.throttled = 0
+        self.peak_rss = 0
+
+
+class SimulatedUser:
+    def __init__(self, args, index, stats, encryption):
+        self.args = args
+        self.username = f"{args.prefix}{index}"
+        self.stats = stats
+        self.encryption = encryption
+        self.reader = None
+        self.writer = None
+        self.decoder = FrameDecoder()
+        self.compression = None
+        self.cipher_suite = None
+        self.uploads = {}  # {upload_id: Future resolved with the server's reply}
+        self.upload_ids = itertools.count(1)
+        self.rng = random.Random(index)
+
+    async def read_frame(self, pending):
+        while not pending:
+            data = await self.reader.read(RECV_SIZE)
+            if not data:
+                raise ConnectionError("Server closed connection")
+            pending.extend(self.decoder.feed(data))
+        return pending.pop(0)
+
+    async def login(self, room):
+        """Register (or log in if the name is taken) and join `room`. Returns the frames read past the join."""
+        pending = []
+        for action in ('register', 'login'):
+            self.reader, self.writer = await asyncio.open_connection(self.args.host, self.args.port)
+            self.decoder = FrameDecoder()
+            pending = []
+            self.writer.write(encode_json({'action': action, 'username': self.username, 'password': self.args.password,
+                                           'compression': COMPRESSION_CODECS, 'ciphers': self.args.ciphers,
+                                           'heartbeat': True}))
+            reply = json.loads((await self.read_frame(pending))[1])
+            if reply.get('status') == 'success':
+                self.compression = reply.get('compression')
+                self.cipher_suite = reply.get('cipher')
+                break
+            self.writer.close()
+        else:
+            raise ConnectionError(reply.get('message', 'Authentication failed'))
+        self.writer.write(encode_json({'room': room}))
+        while True:
+            frame_type, payload = await self.read_frame(pending)
+            if frame_type == FRAME_JSON and json.loads(payload).get('type') == 'room_change':
+                return pending
+
+    def send_chat(self, text):
+        self.writer.write(encode_chat(self.encryption.encrypt(text, self.compression, self.cipher_suite)))
+
+    async def receive(self, pending):
+        try:
+            while True:
+                frame_type, payload = await self.read_frame(pending)
+                if frame_type == FRAME_CHAT:
+                    self.on_chat(self.encryption.decrypt(payload))
+                elif frame_type == FRAME_JSON:
+                    control = json.loads(payload)
+                    if control.get('type') == 'throttled':
+                        self.stats.throttled += 1
+                    elif control.get('type') == 'ping':
+                        self.writer.write(encode_json({'type': 'pong'}))
+                    waiter = self.uploads.get(control.get('upload_id'))
+                    if waiter and not waiter.done():
+                        waiter.set_result(control)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+    def on_chat(self, line):
+        # "[HH:MM:SS] user: LOADGEN <perf_counter> ..."
+        _, _, text = line.partition(': ')
+        if text.startswith(TAG + ' '):
+            self.stats.delivered += 1
+            self.stats.latencies.append(time.perf_counter() - float(text.split(' ', 2)[1]))
+
+    async def upload_reply(self, upload_id, timeout=30):
+        waiter = self.uploads[upload_id] = asyncio.get_running_loop().create_future()
+        try:
+            return await asyncio.wait_for(waiter, timeout)
+        finally:
+            self.uploads.pop(upload_id, None)
+
+    async def upload(self):
+        data = os.urandom(self.args.attachment_kb * 1024)
+        sha256 = hashlib.sha256(data).hexdigest()
+        upload_id = next(self.upload_ids)
+        reply = asyncio.ensure_future(self.upload_reply(upload_id))
+        self.writer.write(encode_json({'type': 'upload_start', 'upload_id': upload_id, 'sha256': sha256,
+                                       'size': len(data), 'name': 'load.bin'}))
+        if (await reply)['type'] == 'upload_ready':
+            reply = asyncio.ensure_future(self.upload_reply(upload_id))
+            for offset in range(0, len(data), ATTACHMENT_CHUNK):
+                block = data[offset:offset + ATTACHMENT_CHUNK]
+                self.writer.write(encode_blob(upload_id, self.encryption.encrypt(block, suite=self.cipher_suite)))
+                await self.writer.drain()
+            self.writer.write(encode_json({'type': 'upload_end', 'upload_id': upload_id}))
+            await reply
+        self.stats.uploads += 1
+
+    async def act(self, rooms, weights):
+        roll = self.rng.random()
+        args = self.args
+        if roll < args.join_ratio:
+            self.send_chat(f"/join {self.rng.choices(rooms, weights)[0]}")
+            self.stats.commands += 1
+        elif roll < args.join_ratio + args.users_ratio:
+            self.send_chat('/users')
+            self.stats.commands += 1
+        elif roll < args.join_ratio + args.users_ratio + args.attachment_ratio:
+            await self.upload()
+        else:
+            self.send_chat(f"{TAG} {time.perf_counter():.6f} {'x' * args.message_size}")
+            self.stats.sent += 1
+        await self.writer.drain()
+
+    async def run(self, rooms, weights, connect_slots, start_event, deadline):
+        async with connect_slots:
+            started = time.perf_counter()
+            try:
+                pending = await self.login(self.rng.choices(rooms, weights)[0])
+            except (OSError, ConnectionError, ValueError) as e:
+                self.stats.connect_failures += 1
+                if self.args.verbose:
+                    print(f"{self.username}: {e}")
+                return
+            self.stats.connect_times.append(time.perf_counter() - started)
+        receiver = asyncio.ensure_future(self.receive(pending))
+        await start_event.wait()
+        try:
+            while time.perf_counter() < deadline[0]:
+                # Poisson arrivals at the configured per-user rate
+                await asyncio.sleep(self.rng.expovariate(self.args.rate))
+                await self.act(rooms, weights)
+        except (OSError, ConnectionError, asyncio.TimeoutError) as e:
+            self.stats.errors += 1
+            if self.args.verbose:
+                print(f"{self.username}: {e}")
+        # Let in-flight messages arrive before hanging up
+        await asyncio.sleep(self.args.drain)
+        receiver.cancel()
+        self.writer.close()
+
+
+async def sample_rss(pid, stats, interval=0.5):
+    while True:
+        stats.peak_rss = max(stats.peak_rss, process_rss(pid))
+        await asyncio.sleep(interval)
+
+
+async def main_async(args):
+    rooms, weights = parse_rooms(args.rooms)
+    stats = Stats()
+    encryption = EncryptionManager()
+    connect_slots = asyncio.Semaphore(args.connect_concurrency)
+    start_event = asyncio.Event()
+    deadline = [float('inf')]
+    sampler = asyncio.ensure_future(sample_rss(args.server_pid, stats)) if args.server_pid else None
+
+    users = [SimulatedUser(args, i, stats, encryption) for i in range(args.users)]
+    tasks = [asyncio.ensure_future(user.run(rooms, weights, connect_slots, start_event, deadline)) for user in users]
+    connect_started = time.perf_counter()
+    while len(stats.connect_times) + stats.connect_failures < args.users:
+        await asyncio.sleep(0.05)
+    connect_elapsed = time.perf_counter() - connect_started
+    rss_before = process_rss(args.server_pid) if args.server_pid else 0
+
+    started = time.perf_counter()
+    deadline[0] = started + args.duration
+    start_event.set()
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started - args.drain
+    if sampler:
+        sampler.cancel()
+
+    ms = [latency * 1000 for latency in stats.latencies]
+    print(f"users: {len(stats.connect_times)} connected, {stats.connect_failures} failed, "
+          f"all in {connect_elapsed:.2f}s")
+    print(f"connect: p50 {percentile(stats.connect_times, 50) * 1000:.1f}ms "
+          f"p95 {percentile(stats.connect_times, 95) * 1000:.1f}ms p99 {percentile(stats.connect_times, 99) * 1000:.1f}ms")
+    print(f"sent: {stats.sent} messages ({stats.sent / elapsed:,.0f}/s), {stats.commands} commands, "
+          f"{stats.uploads} uploads, {stats.errors} errors, {stats.throttled} throttle notices")
+    print(f"delivered: {stats.delivered} ({stats.delivered / elapsed:,.0f}/s)")
+    print(f"fan-out latency: p50 {percentile(ms, 50):.1f}ms p95 {percentile(ms, 95):.1f}ms "
+          f"p99 {percentile(ms, 99):.1f}ms max {max(ms, default=float('nan')):.1f}ms")
+    if args.server_pid:
+        print(f"server RSS: {rss_before / 2 ** 20:.1f} MiB after connect, peak {stats.peak_rss / 2 ** 20:.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5555)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--rooms', default='general=0.6,random=0.3,support=0.1',
+                        help="rooms to join with relative weights")
+    parser.add_argument('--rate', type=float, default=1.0, help="actions per second per user")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds of sending after everyone connected")
+    parser.add_argument('--message-size', type=int, default=40, help="padding bytes per chat message")
+    parser.add_argument('--join-ratio', type=float, default=0.02, help="share of actions that are /join")
+    parser.add_argument('--users-ratio', type=float, default=0.02, help="share of actions that are /users")
+    parser.add_argument('--attachment-ratio', type=float, default=0.0, help="share of actions that upload a file")
+    parser.add_argument('--attachment-kb', type=int, default=256)
+    parser.add_argument('--ciphers', type=lambda s: s.split(','), default=CIPHER_SUITES,
+                        help="cipher suites to offer, comma-separated")
+    parser.add_argument('--connect-concurrency', type=int, default=32,
+                        help="logins in flight at once (each costs the server a KDF)")
+    parser.add_argument('--prefix', default=f"load{os.getpid()}_", help="username prefix")
+    parser.add_argument('--password', default='load-test-password')
+    parser.add_argument('--server-pid', type=int, help="sample this process's RSS (and its workers')")
+    parser.add_argument('--drain', type=float, default=1.0, help="seconds to keep receiving after sending stops")
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+import json
+import struct
+from collections import deque
+
+# Wire format: every frame is
+#   4-byte big-endian payload length | 1-byte frame type | payload
+# so a reader never has to guess where one message ends or whether a blob is
+# JSON or ciphertext.
+HEADER = struct.Struct('>IB')
+HEADER_SIZE = HEADER.size
+# FRAME_BLOB payloads start with the upload/fetch id they belong to
+BLOB_HEADER = struct.Struct('>I')
+# FRAME_SEQ payloads start with the message's id, its sequence number in the room
+SEQ_HEADER = struct.Struct('>Q')
+
+FRAME_JSON = 1   # plain JSON control message (auth, room changes, history)
+FRAME_CHAT = 2   # encrypted chat payload
+FRAME_BLOB = 3   # attachment chunk: 4-byte transfer id + encrypted bytes
+FRAME_SEQ = 4    # room message for resumable sessions: 8-byte message id + encrypted chat payload
+FRAME_RECORD = 5  # encrypted message record (see records.py), for clients that negotiated records
+
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+RECV_SIZE = 65536
+
+
+class ProtocolError(Exception):
+    """Raised when the peer sends a malformed or oversized frame."""
+
+
+def encode_frame(frame_type, payload):
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame too large: {len(payload)} bytes")
+    return HEADER.pack(len(payload), frame_type) + payload
+
+
+def encode_json(data):
+    return encode_frame(FRAME_JSON, json.dumps(data).encode('utf-8'))
+
+
+def encode_chat(token):
+    return encode_frame(FRAME_CHAT, token)
+
+
+def encode_record_frame(token):
+    return encode_frame(FRAME_RECORD, token)
+
+
+def encode_blob(transfer_id, token):
+    return encode_frame(FRAME_BLOB, BLOB_HEADER.pack(transfer_id) + token)
+
+
+def decode_blob(payload):
+    """Split a FRAME_BLOB payload into (transfer id, encrypted chunk)."""
+    (transfer_id,) = BLOB_HEADER.unpack_from(payload)
+    return transfer_id, payload[BLOB_HEADER.size:]
+
+
+def encode_seq(seq, token):
+    return encode_frame(FRAME_SEQ, SEQ_HEADER.pack(seq) + token)
+
+
+def decode_seq(payload):
+    """Split a FRAME_SEQ payload into (message id, encrypted chat payload)."""
+    (seq,) = SEQ_HEADER.unpack_from(payload)
+    return seq, payload[SEQ_HEADER.size:]
+
+
+class FrameDecoder:
+    """Incremental decoder: feed it whatever recv() returned, get whole frames back."""
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.buffer = bytearray()
+        self.max_frame_size = max_frame_size
+
+    def feed(self, data):
+        """Append received bytes and return every complete (type, payload) frame."""
+        self.buffer += data
+        frames = []
+        offset = 0
+        buffered = len(self.buffer)
+        while buffered - offset >= HEADER_SIZE:
+            length, frame_type = HEADER.unpack_from(self.buffer, offset)
+            if length > self.max_frame_size:
+                raise ProtocolError(f"Frame too large: {length} bytes")
+            end = offset + HEADER_SIZE + length
+            if end > buffered:
+                break
+            frames.append((frame_type, bytes(self.buffer[offset + HEADER_SIZE:end])))
+            offset = end
+        if offset:
+            del self.buffer[:offset]
+        return frames
+
+    def unread(self, frames=()):
+        """The bytes fed in but not yet handled: `frames` decoded but not processed, then any partial frame."""
+        return b''.join(encode_frame(frame_type, payload) for frame_type, payload in frames) + bytes(self.buffer)
+
+
+class FrameReader:
+    """Blocking frame reader for a plain socket, buffering frames between calls."""
+
+    def __init__(self, sock, recv_size=RECV_SIZE):
+        self.sock = sock
+        self.recv_size = recv_size
+        self.decoder = FrameDecoder()
+        self.pending = deque()
+
+    def read_frame(self):
+        """Return the next (type, payload) frame, or None when the peer closes."""
+        while not self.pending:
+            data = self.sock.recv(self.recv_size)
+            if not data:
+                return None
+            self.pending.extend(self.decoder.feed(data))
+        return self.pending.popleft()
+
+    def unread(self):
+        return self.decoder.unread(self.pending)
+
+    def read_json(self):
+        frame = self.read_frame()
+        if frame is None:
+            raise ConnectionError("Connection closed")
+        frame_type, payload = frame
+        if frame_type != FRAME_JSON:
+            raise ProtocolError("Expected a JSON control frame")
+        return json.loads(payload.decode('utf-8'))
@@ -0,0 +1,345 @@
+import asyncio
+import json
+import logging
+import os
+import signal
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from auth import AuthBusyError
+from outbound import SlowConsumerError
+from protocol import FRAME_BLOB, FRAME_CHAT, FRAME_JSON, RECV_SIZE, FrameDecoder, ProtocolError, encode_json
+from server import CONNECTIONS_TOTAL, ChatServer
+
+logger = logging.getLogger('chat.server')
+
+
+class StreamConnection:
+    """Socket-like wrapper around an asyncio stream.
+
+    ChatServer's broadcast and command code only calls sendall()/close() on
+    a client, so wrapping the StreamWriter lets the async server reuse it
+    unchanged. While the transport keeps up, sendall() hands frames straight
+    to it; once its buffer passes the high-water mark frames go to a bounded
+    OutboundQueue instead, which a writer task per connection empties each
+    time the transport drains. Calls made from worker threads are handed
+    back to the loop.
+    """
+
+    def __init__(self, reader, writer, loop, queue):
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop
+        self.queue = queue
+        self.loop_thread = threading.get_ident()
+        self.address = writer.get_extra_info('peername')
+        self.ready = asyncio.Event()
+        self.writer_task = loop.create_task(self.write_loop())
+
+    def _on_loop(self):
+        return threading.get_ident() == self.loop_thread
+
+    def sendall(self, data):
+        if self.queue.closed:
+            raise ConnectionError("Connection closed")
+        if self._on_loop():
+            self._enqueue(data)
+        else:
+            self.loop.call_soon_threadsafe(self._enqueue_quietly, data)
+        return None
+
+    send = sendall
+
+    def _enqueue(self, data):
+        transport = self.writer.transport
+        if not self.queue and not self.queue.closed and \
+                transport.get_write_buffer_size() < transport.get_write_buffer_limits()[1]:
+            self.writer.write(data)
+            return
+        try:
+            self.queue.put(data, can_block=False)
+        except SlowConsumerError:
+            self.abort()
+            raise
+        self.ready.set()
+
+    def _enqueue_quietly(self, data):
+        try:
+            self._enqueue(data)
+        except ConnectionError:
+            pass
+
+    async def write_loop(self):
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                await self.writer.drain()
+                frames = self.queue.get_nowait()
+                if frames:
+                    self.writer.writelines(frames)
+                elif self.queue.closed:
+                    break
+        except (ConnectionError, OSError):
+            self.queue.close(discard=True)
+        finally:
+            self.writer.close()
+
+    def _wake(self):
+        self.ready.set()
+
+    def close(self):
+        """Stop accepting frames; queued frames are flushed before the stream closes."""
+        self.queue.close()
+        if self._on_loop():
+            self._wake()
+        else:
+            self.loop.call_soon_threadsafe(self._wake)
+
+    def abort(self):
+        """Drop queued frames and tear the transport down immediately."""
+        self.queue.close(discard=True)
+        if self._on_loop():
+            self._abort_transport()
+        else:
+            self.loop.call_soon_threadsafe(self._abort_transport)
+
+    def _abort_transport(self):
+        self.writer.transport.abort()
+        self.ready.set()
+
+    def stop_reading(self):
+        """Take no more bytes off the socket: the reader returns what it has buffered, then end of stream."""
+        self.writer.transport.pause_reading()
+        self.reader.feed_eof()
+
+    async def detach(self):
+        """Flush what is queued, then let go of the socket without ending the connection (for a hot restart).
+
+        Returns a duplicate of the socket's descriptor for the new owner, or
+        None if the connection is already gone.
+        """
+        try:
+            fd = os.dup(self.writer.get_extra_info('socket').fileno())
+        except OSError:
+            return None
+        self.queue.close()
+        self.ready.set()
+        try:
+            await self.writer_task
+            # The transport closes its own descriptor, no shutdown(), once its buffer is written
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError):
+            os.close(fd)
+            return None
+        return fd
+
+
+class AsyncChatServer(ChatServer):
+    """ChatServer variant that serves every client from one asyncio event loop.
+
+    Sockets are multiplexed by the loop instead of getting a thread each, so
+    idle connections only cost their buffers. SQLite work still blocks, so it
+    runs on a small bounded thread pool.
+    """
+
+    def __init__(self, host='0.0.0.0', port=5555, backlog=1024, db_workers=4, **options):
+        super().__init__(host, port, backlog, **options)
+        self.executor = ThreadPoolExecutor(max_workers=db_workers, thread_name_prefix='chat-db')
+        self.loop = None
+        self.stopping = None
+        self.tcp_server = None
+        self.handlers = set()
+
+    def call_soon(self, func, *args):
+        if self.loop is None:
+            func(*args)
+            return
+        try:
+            self.loop.call_soon_threadsafe(func, *args)
+        except RuntimeError:
+            pass  # Loop already closed during shutdown
+
+    async def run_blocking(self, func, *args):
+        return await self.loop.run_in_executor(self.executor, func, *args)
+
+    async def read_frames(self, reader, decoder, timeout=None):
+        """Read one buffered chunk and return every frame it completed."""
+        while True:
+            read = reader.read(RECV_SIZE)
+            data = await (asyncio.wait_for(read, timeout) if timeout else read)
+            if not data:
+                raise ConnectionError("Connection closed")
+            frames = decoder.feed(data)
+            if frames:
+                return frames
+
+    async def read_json(self, reader, decoder, pending):
+        if not pending:
+            pending.extend(await self.read_frames(reader, decoder, timeout=30.0))
+        frame_type, payload = pending.popleft()
+        if frame_type != FRAME_JSON:
+            raise ProtocolError("Expected a JSON control frame")
+        return json.loads(payload.decode('utf-8'))
+
+    async def dispatch_frame(self, conn, frame_type, payload):
+        if frame_type == FRAME_CHAT:
+            if not self.admit(conn, messages=1, bytes=len(payload)):
+                return
+            message = self.encryption.decrypt(payload)
+            if not message:
+                return
+            if message.startswith('/'):
+                await self.run_blocking(self.handle_command, message, conn)
+            else:
+                self.process_message(conn, message)
+        elif frame_type == FRAME_JSON:
+            control = json.loads(payload.decode('utf-8'))
+            if self.admit_control(conn, control):
+                await self.run_blocking(self.handle_control, conn, control)
+        elif frame_type == FRAME_BLOB:
+            if await self.pace_blob(conn, payload):
+                await self.run_blocking(self.receive_upload_chunk, conn, payload)
+        else:
+            raise ProtocolError(f"Unknown frame type {frame_type}")
+
+    async def pace_blob(self, conn, payload):
+        """admit_blob() for the event loop: wait for the transfer tokens without holding up other connections."""
+        wait = self.transfer_wait(conn, len(payload))
+        while wait and wait != float('inf') and self.running:
+            await asyncio.sleep(wait)
+            wait = self.transfer_wait(conn, len(payload))
+        if wait:
+            self.refuse_chunk(conn, payload)
+        return not wait
+
+    async def handle_connection(self, reader, writer, session=None, carry=b''):
+        self.handlers.add(asyncio.current_task())
+        conn = StreamConnection(reader, writer, self.loop, self.new_outbound_queue())
+        address = conn.address
+        decoder = FrameDecoder()
+        pending = deque()
+        serving = parked = False
+        try:
+            if session is not None:
+                pending.extend(decoder.feed(carry))
+                await self.run_blocking(self.adopt_client, conn, session)
+            else:
+                CONNECTIONS_TOTAL.inc()
+                logger.debug("Accepted connection from %s", address)
+                auth = await self.read_json(reader, decoder, pending)
+                try:
+                    action, username, future = self.submit_auth(auth)
+                    success = await asyncio.wrap_future(future)
+                    message = self.auth_message(action, success)
+                except AuthBusyError as e:
+                    success, message = False, str(e)
+
+                if not success:
+                    conn.sendall(encode_json({'status': 'failed', 'message': message}))
+                    return
+
+                encoding = self.negotiate(auth)
+                self.add_client(conn, username, encoding)
+                conn.sendall(self.login_reply(message, encoding, success))
+
+                room_request = await self.read_json(reader, decoder, pending)
+                # Entering a room can read history from SQLite (a resume with a gap), so off the loop like the mailbox
+                room_choice = await self.run_blocking(self.enter_room, conn, room_request)
+                conn.sendall(await self.run_blocking(self.entry_payload, conn, room_choice, room_request))
+                conn.sendall(self.roster_payload(room_choice))
+                await self.run_blocking(self.deliver_mailbox, conn, username)
+
+            serving = True
+            while self.running:
+                if not pending:
+                    if self.draining:
+                        conn.stop_reading()
+                    pending.extend(await self.read_frames(reader, decoder))
+                self.heartbeats.seen(conn)
+                while pending:
+                    await self.dispatch_frame(conn, *pending.popleft())
+        except ConnectionError:
+            # During a hot restart stop_reading() ends the stream once the buffered bytes are handled
+            parked = serving and self.draining and self.park(conn, decoder.unread(pending))
+        except (asyncio.TimeoutError, json.JSONDecodeError, ProtocolError):
+            pass
+        except Exception as e:
+            logger.warning("Client error (%s): %s", address, e)
+        finally:
+            if not parked:
+                self.remove_client(conn)
+                conn.close()
+            self.handlers.discard(asyncio.current_task())
+
+    async def adopt_connection(self, sock, session, carry):
+        """Serve a connection handed over by the process this one replaced (see ChatServer.hand_off)."""
+        try:
+            reader, writer = await asyncio.open_connection(sock=sock)
+        except OSError:
+            sock.close()
+            return
+        await self.handle_connection(reader, writer, session, carry)
+
+    def stop_accepting(self):
+        self.call_soon(self.tcp_server.close)
+
+    def stop_reading(self, clients):
+        for client in clients:
+            self.call_soon(client.stop_reading)
+
+    def detach_client(self, client):
+        future = asyncio.run_coroutine_threadsafe(client.detach(), self.loop)
+        try:
+            return future.result(self.handoff_timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            client.abort()
+            return None
+
+    def stop(self):
+        super().stop()
+        self.call_soon(self.stopping.set)
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(sig, self.stopping.set)
+            except (NotImplementedError, RuntimeError):
+                pass  # Windows: fall back to KeyboardInterrupt
+
+        self.server.setblocking(False)
+        server = self.tcp_server = await asyncio.start_server(self.handle_connection, sock=self.server)
+        for sock, session, carry in self.inherited_clients:
+            self.loop.create_task(self.adopt_connection(sock, session, carry))
+        self.inherited_clients = []
+        async with server:
+            await self.stopping.wait()
+            server.close()
+            await self.close_connections()
+
+    async def close_connections(self, timeout=5.0):
+        """Close every client, letting queued frames flush, then wait for the handlers to finish."""
+        with self.lock:
+            connections = list(self.clients)
+        for conn in connections:
+            conn.close()
+        handlers = list(self.handlers)
+        if handlers:
+            done, still_running = await asyncio.wait(handlers, timeout=timeout)
+            for task in still_running:
+                task.cancel()
+
+    def start(self):
+        self.running = True
+        logger.info("Async chat server started on %s:%s", self.host, self.port)
+        logger.info("Available rooms: %s", ', '.join(self.rooms))
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            logger.info("Keyboard interrupt received. Shutting down server...")
+        finally:
+            self.executor.shutdown(wait=True)
+            self.shutdown()
@@ -0,0 +1,96 @@
+import hashlib
+import os
+import re
+import tempfile
+
+CHUNK_SIZE = 64 * 1024
+MAX_RANGE = 1024 * 1024
+
+SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+def file_reference(sha256, size, name):
+    """Chat line that stands in for an attachment; receivers fetch the blob on demand."""
+    return f"[FILE]{sha256}:{size}:{name}"
+
+
+class AttachmentError(Exception):
+    """Raised for invalid, oversized or corrupt attachments."""
+
+
+class Upload:
+    """One in-progress upload, streamed to a temp file and hashed as it arrives."""
+
+    def __init__(self, store, sha256, size, name):
+        self.store = store
+        self.sha256 = sha256
+        self.size = size
+        self.name = name
+        self.received = 0
+        self.digest = hashlib.sha256()
+        fd, self.temp_path = tempfile.mkstemp(dir=store.temp_dir)
+        self.file = os.fdopen(fd, 'wb')
+
+    def write(self, chunk):
+        self.received += len(chunk)
+        if self.received > self.size:
+            self.abort()
+            raise AttachmentError("Upload exceeds its declared size")
+        self.digest.update(chunk)
+        self.file.write(chunk)
+
+    def commit(self):
+        """Verify the upload and move it into the store under its hash."""
+        self.file.close()
+        if self.received != self.size or self.digest.hexdigest() != self.sha256:
+            os.remove(self.temp_path)
+            raise AttachmentError("Upload is incomplete or does not match its SHA-256")
+        path = self.store.path_for(self.sha256)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self.temp_path, path)
+
+    def abort(self):
+        if not self.file.closed:
+            self.file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+class BlobStore:
+    """Content-addressed attachment store: each file lives once under attachments/ab/<sha256>."""
+
+    def __init__(self, root='attachments', max_size=25 * 1024 * 1024):
+        self.root = root
+        self.max_size = max_size
+        self.temp_dir = os.path.join(root, 'tmp')
+        os.makedirs(self.temp_dir, exist_ok=True)
+
+    def path_for(self, sha256):
+        if not SHA256_RE.match(sha256):
+            raise AttachmentError("Invalid SHA-256")
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def exists(self, sha256):
+        return os.path.exists(self.path_for(sha256))
+
+    def size(self, sha256):
+        return os.path.getsize(self.path_for(sha256))
+
+    def begin(self, sha256, size, name):
+        self.path_for(sha256)
+        if size <= 0 or size > self.max_size:
+            raise AttachmentError(f"Attachments must be between 1 byte and {self.max_size} bytes")
+        return Upload(self, sha256, size, name)
+
+    def read_range(self, sha256, offset, length):
+        """Yield the bytes of [offset, offset + length) in CHUNK_SIZE pieces, capped at MAX_RANGE."""
+        length = min(length, MAX_RANGE)
+        with open(self.path_for(sha256), 'rb') as f:
+            f.seek(offset)
+            remaining = length
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
@@ -0,0 +1,308 @@
+import base64
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def _unb64(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+class PasswordVerifier:
+    """Interface for password hashing schemes.
+
+    Stored hashes are self-describing strings ("<scheme>$..."), so a verifier
+    can tell whether a stored hash is its own or needs upgrading.
+    """
+
+    scheme = None
+
+    def hash(self, password):
+        raise NotImplementedError
+
+    def verify(self, password, stored):
+        raise NotImplementedError
+
+    def owns(self, stored):
+        return stored.startswith(self.scheme + '$')
+
+    def needs_rehash(self, stored):
+        return not self.owns(stored)
+
+
+class ScryptVerifier(PasswordVerifier):
+    """Memory-hard scrypt (n=2**14, r=8, p=1 by default, ~16 MiB per hash)."""
+
+    scheme = 'scrypt'
+
+    def __init__(self, n=2 ** 14, r=8, p=1, length=32):
+        self.n, self.r, self.p, self.length = n, r, p, length
+
+    def _derive(self, password, salt, n, r, p, length):
+        return Scrypt(salt=salt, length=length, n=n, r=r, p=p).derive(password.encode('utf-8'))
+
+    def hash(self, password):
+        salt = os.urandom(16)
+        key = self._derive(password, salt, self.n, self.r, self.p, self.length)
+        return f"{self.scheme}${self.n}${self.r}${self.p}${_b64(salt)}${_b64(key)}"
+
+    def verify(self, password, stored):
+        _, n, r, p, salt, key = stored.split('$')
+        expected = _unb64(key)
+        derived = self._derive(password, _unb64(salt), int(n), int(r), int(p), len(expected))
+        return hmac.compare_digest(derived, expected)
+
+    def needs_rehash(self, stored):
+        if not self.owns(stored):
+            return True
+        _, n, r, p, _, _ = stored.split('$')
+        return (int(n), int(r), int(p)) != (self.n, self.r, self.p)
+
+
+class PBKDF2Verifier(PasswordVerifier):
+    """PBKDF2-HMAC-SHA256, for deployments that cannot afford scrypt's memory."""
+
+    scheme = 'pbkdf2_sha256'
+
+    def __init__(self, iterations=390000, length=32):
+        self.iterations, self.length = iterations, length
+
+    def _derive(self, password, salt, iterations, length):
+        kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=length, salt=salt, iterations=iterations)
+        return kdf.derive(password.encode('utf-8'))
+
+    def hash(self, password):
+        salt = os.urandom(16)
+        key = self._derive(password, salt, self.iterations, self.length)
+        return f"{self.scheme}${self.iterations}${_b64(salt)}${_b64(key)}"
+
+    def verify(self, password, stored):
+        _, iterations, salt, key = stored.split('$')
+        expected = _unb64(key)
+        derived = self._derive(password, _unb64(salt), int(iterations), len(expected))
+        return hmac.compare_digest(derived, expected)
+
+    def needs_rehash(self, stored):
+        if not self.owns(stored):
+            return True
+        return int(stored.split('$')[1]) != self.iterations
+
+
+class LegacySHA256Verifier(PasswordVerifier):
+    """Unsalted sha256 hex digests written by older versions; only ever verified, then upgraded."""
+
+    scheme = 'sha256'
+
+    def owns(self, stored):
+        return len(stored) == 64 and '$' not in stored
+
+    def hash(self, password):
+        raise ValueError("Refusing to create new unsalted sha256 hashes")
+
+    def verify(self, password, stored):
+        return hmac.compare_digest(hashlib.sha256(password.encode('utf-8')).hexdigest(), stored)
+
+
+VERIFIERS = {
+    'scrypt': ScryptVerifier,
+    'pbkdf2': PBKDF2Verifier,
+}
+
+
+class AuthBusyError(Exception):
+    """Raised when too many password checks are already queued."""
+
+
+class Authenticator:
+    """Password registration and login on top of a pluggable PasswordVerifier.
+
+    KDF work runs on a bounded worker pool with a cap on queued requests, so
+    a reconnect storm can neither block the accept path nor queue unbounded
+    work. Recent successful logins are remembered in a small LRU as an HMAC
+    of the password under a per-process key; a repeat login with the same
+    password skips both SQLite and the KDF. Entries expire after `cache_ttl`
+    seconds and are dropped when the password changes.
+    """
+
+    def __init__(self, db, verifier=None, workers=None, max_pending=256, cache_size=1024, cache_ttl=600):
+        self.db = db
+        self.verifier = verifier or ScryptVerifier()
+        self.legacy = [ScryptVerifier(), PBKDF2Verifier(), LegacySHA256Verifier()]
+        self.executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 2,
+                                           thread_name_prefix='chat-auth')
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.cache = OrderedDict()  # {username: (token, stored_hash, expires_at)}
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.cache_key = os.urandom(32)
+        self.lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def submit(self, func, *args):
+        """Run a blocking auth call on the worker pool. Returns a Future."""
+        if not self.slots.acquire(blocking=False):
+            raise AuthBusyError("Server busy, try again shortly")
+        future = self.executor.submit(func, *args)
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def _token(self, username, password):
+        return hmac.new(self.cache_key, f"{username}\0{password}".encode('utf-8'), hashlib.sha256).digest()
+
+    def _cached(self, username, password):
+        with self.lock:
+            entry = self.cache.get(username)
+            if entry is None or entry[2] < time.monotonic():
+                self.cache.pop(username, None)
+                self.cache_misses += 1
+                return False
+            if not hmac.compare_digest(entry[0], self._token(username, password)):
+                self.cache_misses += 1
+                return False
+            self.cache.move_to_end(username)
+            self.cache_hits += 1
+            return True
+
+    def _remember(self, username, password, stored):
+        with self.lock:
+            self.cache[username] = (self._token(username, password), stored, time.monotonic() + self.cache_ttl)
+            self.cache.move_to_end(username)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def invalidate(self, username):
+        with self.lock:
+            self.cache.pop(username, None)
+
+    def stored_hash(self, username):
+        """The user's stored password hash, from the login cache when it is there."""
+        with self.lock:
+            entry = self.cache.get(username)
+            if entry is not None and entry[2] >= time.monotonic():
+                return entry[1]
+        return self.db.get_password_hash(username)
+
+    def _verifier_for(self, stored):
+        if self.verifier.owns(stored):
+            return self.verifier
+        for verifier in self.legacy:
+            if verifier.owns(stored):
+                return verifier
+        return None
+
+    def _check(self, username, password):
+        stored = self.db.get_password_hash(username)
+        if stored is None:
+            # Burn the same KDF time for unknown users so timing does not reveal them
+            self.verifier.hash(password)
+            return None
+        verifier = self._verifier_for(stored)
+        if verifier is None or not verifier.verify(password, stored):
+            return None
+        return stored
+
+    def login(self, username, password):
+        """Blocking login check. Returns True on success."""
+        if self._cached(username, password):
+            return True
+        stored = self._check(username, password)
+        if stored is None:
+            return False
+        if self.verifier.needs_rehash(stored):
+            stored = self.verifier.hash(password)
+            self.db.set_password_hash(username, stored)
+        self._remember(username, password, stored)
+        return True
+
+    def register(self, username, password):
+        """Blocking registration. Returns False if the username is taken."""
+        stored = self.verifier.hash(password)
+        if not self.db.register_user(username, stored):
+            return False
+        self._remember(username, password, stored)
+        return True
+
+    def change_password(self, username, old_password, new_password):
+        if self._check(username, old_password) is None:
+            return False
+        self.invalidate(username)
+        if not self.db.set_password_hash(username, self.verifier.hash(new_password)):
+            return False
+        self.invalidate(username)
+        return True
+
+    def stats(self):
+        with self.lock:
+            return {'cache_size': len(self.cache), 'cache_hits': self.cache_hits, 'cache_misses': self.cache_misses}
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+class SessionTokens:
+    """Signed, expiring session tokens that let a dropped client reconnect without its password.
+
+    A token is "<username>.<expiry>.<mac>" (base64url username), the MAC an
+    HMAC-SHA256 over the username, the expiry and the user's stored password
+    hash. So tokens need no server-side state, are accepted by every worker
+    sharing the encryption `key` (and after a restart), and a password
+    change revokes them all. Checking one costs an HMAC and at most one
+    indexed SELECT, never a KDF. `stored_hash(username)` looks up the
+    current password hash.
+    """
+
+    def __init__(self, key, stored_hash, ttl=86400):
+        # A key of its own, so the shared encryption key never signs anything directly
+        self.secret = hmac.new(key, b'chat session tokens', hashlib.sha256).digest()
+        self.stored_hash = stored_hash
+        self.ttl = ttl
+
+    def _mac(self, username, expires, stored):
+        message = f"{username}\0{expires}\0{stored}".encode('utf-8')
+        return hmac.new(self.secret, message, hashlib.sha256).digest()
+
+    def issue(self, username):
+        stored = self.stored_hash(username)
+        if stored is None:
+            return None
+        expires = int(time.time()) + self.ttl
+        return f"{_b64(username.encode('utf-8'))}.{expires}.{_b64(self._mac(username, expires, stored))}"
+
+    @staticmethod
+    def username_of(token):
+        """The username a token claims, unverified; '' if it is malformed."""
+        try:
+            return _unb64(token.split('.')[0]).decode('utf-8')
+        except (ValueError, AttributeError):
+            return ''
+
+    def verify(self, token):
+        """Return the token's username if it is genuine, unexpired and the password is unchanged, else None."""
+        try:
+            encoded, expires, mac = token.split('.')
+            username, expires, mac = _unb64(encoded).decode('utf-8'), int(expires), _unb64(mac)
+        except (ValueError, AttributeError):
+            return None
+        if expires < time.time():
+            return None
+        stored = self.stored_hash(username)
+        if stored is None or not hmac.compare_digest(mac, self._mac(username, expires, stored)):
+            return None
+        return username
+
+    def renew(self, token):
+        """Blocking resume check. Returns a fresh token for the same user, or False."""
+        username = self.verify(token)
+        return username is not None and self.issue(username) or False
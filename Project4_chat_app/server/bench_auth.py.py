@@ -0,0 +1,53 @@
+"""Reconnect-storm benchmark for the login path.
+
+Registers N users in a scratch database, then has all of them log in at
+once twice: first with a cold verification cache (every login pays SQLite
+plus the KDF), then again with a warm one, and prints logins per second.
+
+    python bench_auth.py --users 500 --scheme scrypt
+"""
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import wait
+from auth import VERIFIERS, Authenticator
+from database import Database
+
+
+def storm(auth, users):
+    started = time.perf_counter()
+    futures = [auth.submit(auth.login, user, f"pw-{user}") for user in users]
+    wait(futures)
+    elapsed = time.perf_counter() - started
+    failed = sum(1 for f in futures if not f.result())
+    return elapsed, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--scheme', choices=sorted(VERIFIERS), default='scrypt')
+    parser.add_argument('--workers', type=int, default=None, help="auth pool size (default: CPU count)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'))
+        users = [f"user{i}" for i in range(args.users)]
+        auth = Authenticator(db, VERIFIERS[args.scheme](), workers=args.workers, max_pending=args.users)
+        wait([auth.submit(auth.register, user, f"pw-{user}") for user in users])
+        auth.close()
+
+        # Fresh authenticator: empty cache, like right after a restart
+        auth = Authenticator(db, VERIFIERS[args.scheme](), workers=args.workers, max_pending=args.users)
+        for label in ('cold cache', 'warm cache'):
+            elapsed, failed = storm(auth, users)
+            print(f"{label:>10}: {args.users} logins in {elapsed:.3f}s "
+                  f"({args.users / elapsed:,.0f}/s, {failed} failed)")
+        print(f"cache: {auth.stats()}")
+        auth.close()
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""Encrypt/decrypt throughput and ciphertext size for each cipher suite.
+
+For each message size, every suite encrypts and then decrypts the same
+payload repeatedly. The script prints messages per second in each direction
+and the bytes a token adds on top of the plaintext.
+
+    python bench_ciphers.py --sizes 32,256,4096,65536 --seconds 0.5
+"""
+import argparse
+import os
+import time
+from cryptography.fernet import Fernet
+from ciphers import SUITES
+
+
+def rate(func, arg, seconds):
+    count = 0
+    started = time.perf_counter()
+    deadline = started + seconds
+    while True:
+        for _ in range(100):
+            func(arg)
+        count += 100
+        now = time.perf_counter()
+        if now >= deadline:
+            return count / (now - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='32,256,4096,65536', help="comma-separated plaintext sizes in bytes")
+    parser.add_argument('--seconds', type=float, default=0.5, help="time spent per suite, size and direction")
+    args = parser.parse_args()
+
+    key = Fernet.generate_key()
+    suites = {name: cls(key) for name, cls in SUITES.items()}
+    print(f"{'suite':>18} {'size':>7} {'encrypt/s':>11} {'decrypt/s':>11} {'MB/s enc':>9} {'overhead':>9}")
+    for size in (int(s) for s in args.sizes.split(',')):
+        plaintext = os.urandom(size)
+        for name, suite in suites.items():
+            token = suite.encrypt(plaintext)
+            assert suite.decrypt(token) == plaintext
+            enc = rate(suite.encrypt, plaintext, args.seconds)
+            dec = rate(suite.decrypt, token, args.seconds)
+            print(f"{name:>18} {size:>7} {enc:>11,.0f} {dec:>11,.0f} {enc * size / 1e6:>9.1f} "
+                  f"{len(token) - size:>8}B")
+
+
+if __name__ == "__main__":
+    main()
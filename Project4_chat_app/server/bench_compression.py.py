@@ -0,0 +1,72 @@
+"""Compression ratio and CPU cost per codec on chat-sized messages.
+
+Samples come from the messages table of an existing database (--db) or,
+without one, from a small synthetic corpus. Each codec compresses every
+sample and the script prints the bytes saved and microseconds per message,
+plus a zlib variant primed with a dictionary built from the samples.
+
+    python bench_compression.py --db chat_app.db --limit 5000
+"""
+import argparse
+import random
+import sqlite3
+import time
+import zlib
+from compression import CODECS, DEFAULT_THRESHOLD, Codec, build_dictionary
+
+WORDS = ("hello hi hey everyone thanks ok yes no lol the and that this with for you have can "
+         "meeting tomorrow deploy build failed works now check the logs https://example.com/issue").split()
+
+
+def load_samples(db_path, limit):
+    if db_path:
+        conn = sqlite3.connect(db_path)
+        try:
+            rows = conn.execute("SELECT message FROM messages ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        finally:
+            conn.close()
+        return [row[0].encode('utf-8') for row in rows]
+    rng = random.Random(0)
+    return [("[12:00:00] user%d: " % rng.randrange(50) + ' '.join(rng.choices(WORDS, k=rng.randrange(3, 60))))
+            .encode('utf-8') for _ in range(limit)]
+
+
+def measure(codec, samples, threshold):
+    raw = packed = compressed = 0
+    started = time.perf_counter()
+    for sample in samples:
+        raw += len(sample)
+        if len(sample) < threshold:
+            packed += len(sample)
+            continue
+        out = codec.compress(sample)
+        compressed += 1
+        # The stage sends the original when compression does not shrink it
+        packed += min(len(out) + 2, len(sample))
+    elapsed = time.perf_counter() - started
+    return raw, packed, compressed, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', help="read sample messages from this chat database")
+    parser.add_argument('--limit', type=int, default=2000)
+    parser.add_argument('--threshold', type=int, default=DEFAULT_THRESHOLD)
+    args = parser.parse_args()
+
+    samples = load_samples(args.db, args.limit)
+    if not samples:
+        parser.error("no sample messages found")
+    codecs = dict(CODECS)
+    codecs['zlib-trained'] = Codec('zlib-trained', b't', zdict=build_dictionary(
+        s.decode('utf-8', 'replace') for s in samples))
+
+    print(f"{len(samples)} messages, threshold {args.threshold} bytes, zlib {zlib.ZLIB_VERSION}")
+    for name, codec in codecs.items():
+        raw, packed, compressed, elapsed = measure(codec, samples, args.threshold)
+        print(f"{name:>13}: ratio {packed / raw:.3f}, {compressed} compressed, "
+              f"{elapsed / len(samples) * 1e6:.1f} us/msg")
+
+
+if __name__ == "__main__":
+    main()
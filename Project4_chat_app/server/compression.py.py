@@ -0,0 +1,130 @@
+import threading
+import time
+import zlib
+from collections import Counter
+
+# Compressed plaintexts start with a NUL byte (which chat text never does)
+# followed by a one-byte codec id; anything else is uncompressed UTF-8.
+MARKER = b'\x00'
+MAX_DECOMPRESSED_SIZE = 16 * 1024 * 1024
+DEFAULT_THRESHOLD = 128
+
+# Preset dictionary of strings common in chat traffic. zlib primes its window
+# with it, so even short messages find back-references. Both ends must use
+# the same bytes; build_dictionary() makes a replacement from real history.
+DEFAULT_DICTIONARY = (
+    b"https://www. .com .png .jpg [FILE] joined the chat! left the chat joined the room left the room "
+    b"Users in room  thanks thank you please sorry hello hi hey everyone ok okay yes no what why how "
+    b"when where who is are was were the and that this with for you your have has can could would "
+    b"should will just like know think good great nice lol haha :) :( :D "
+)
+
+
+class Codec:
+    def __init__(self, name, codec_id, level=6, zdict=None):
+        self.name = name
+        self.codec_id = codec_id
+        self.level = level
+        self.zdict = zdict
+
+    def compress(self, data):
+        if self.zdict:
+            compressor = zlib.compressobj(self.level, zdict=self.zdict)
+        else:
+            compressor = zlib.compressobj(self.level)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data):
+        if self.zdict:
+            decompressor = zlib.decompressobj(zdict=self.zdict)
+        else:
+            decompressor = zlib.decompressobj()
+        result = decompressor.decompress(data, MAX_DECOMPRESSED_SIZE)
+        if decompressor.unconsumed_tail:
+            raise ValueError("Decompressed payload too large")
+        return result
+
+
+CODECS = {
+    'zlib-dict': Codec('zlib-dict', b'd', zdict=DEFAULT_DICTIONARY),
+    'zlib': Codec('zlib', b'z'),
+}
+CODECS_BY_ID = {codec.codec_id: codec for codec in CODECS.values()}
+# In order of preference when negotiating
+SUPPORTED = ['zlib-dict', 'zlib']
+
+
+def negotiate(offered):
+    """Pick the first codec we support from the peer's offer, or None for no compression."""
+    if not isinstance(offered, list):
+        return None
+    for name in SUPPORTED:
+        if name in offered:
+            return name
+    return None
+
+
+def build_dictionary(samples, size=4096):
+    """Build a preset dictionary from sample messages out of their most frequent words."""
+    words = Counter()
+    for sample in samples:
+        words.update(sample.split())
+    out = bytearray()
+    for word, _ in words.most_common():
+        piece = word.encode('utf-8') + b' '
+        if len(out) + len(piece) > size:
+            break
+        # zlib finds matches near the end of the dictionary most cheaply, so
+        # the most common words end up last
+        out[:0] = piece
+    return bytes(out)
+
+
+class CompressionStage:
+    """Optional compress-before-encrypt stage with per-codec byte and CPU counters."""
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD):
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.counters = {name: {'messages': 0, 'skipped': 0, 'bytes_in': 0, 'bytes_out': 0, 'cpu_seconds': 0.0}
+                         for name in CODECS}
+
+    def compress(self, data, codec_name):
+        """Return the plaintext to encrypt: compressed with a marker, or `data` unchanged."""
+        if not codec_name:
+            return data
+        codec = CODECS[codec_name]
+        counters = self.counters[codec_name]
+        if len(data) < self.threshold:
+            with self.lock:
+                counters['skipped'] += 1
+            return data
+        started = time.perf_counter()
+        compressed = MARKER + codec.codec_id + codec.compress(data)
+        elapsed = time.perf_counter() - started
+        shrunk = len(compressed) < len(data)
+        with self.lock:
+            # The CPU was spent either way, but only what is sent compressed counts towards the ratio
+            counters['cpu_seconds'] += elapsed
+            if not shrunk:
+                counters['skipped'] += 1
+                return data
+            counters['messages'] += 1
+            counters['bytes_in'] += len(data)
+            counters['bytes_out'] += len(compressed)
+        return compressed
+
+    @staticmethod
+    def decompress(data):
+        """Undo compress(); plaintexts without the marker pass through unchanged."""
+        if not data.startswith(MARKER):
+            return data
+        codec = CODECS_BY_ID.get(data[1:2])
+        if codec is None:
+            raise ValueError("Unknown compression codec")
+        return codec.decompress(data[2:])
+
+    def stats(self):
+        with self.lock:
+            return {name: dict(c, ratio=round(c['bytes_out'] / c['bytes_in'], 3) if c['bytes_in'] else None)
+                    for name, c in self.counters.items()}
@@ -1,48 +1,145 @@
+import functools
+import logging
+import queue
 import sqlite3
-from hashlib import sha256
 import threading
+import time
 import os
-from datetime import datetime
+from contextlib import contextmanager
+from metrics import histogram
+from records import Record, render
+
+logger = logging.getLogger(__name__)
+
+DB_SECONDS = histogram('chat_db_seconds', "SQLite call latency by operation", ['op'])
+POOL_WAIT_SECONDS = histogram('chat_db_pool_wait_seconds', "Time spent waiting for a SQLite connection, by pool",
+                              ['pool'])
+
+
+def timed(op):
+    """Record the wall time of every call in chat_db_seconds{op=...}."""
+    observe = DB_SECONDS.labels(op).observe
+
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(time.perf_counter() - started)
+        return wrapper
+    return decorate
+
 
 class Database:
-    def __init__(self, db_name='chat_app.db'):
-        self.local = threading.local()
+    """The chat database: a fixed set of SQLite connections shared by every thread.
+
+    Reads (history, search, auth lookups) borrow one of `readers` query-only
+    connections from a pool; every write goes through the one writer
+    connection, one transaction at a time. So the number of connections
+    never depends on how many users are connected, and writes queue on a
+    Python lock instead of contending for SQLite's WAL write lock. Each
+    connection keeps every statement this class runs prepared.
+    """
+
+    # Comfortably more than the distinct statements below, search's filter variants included
+    statement_cache_size = 96
+    # A reader waiting longer than this for a pooled connection gives up with an error
+    pool_timeout = 30.0
+
+    def __init__(self, db_name='chat_app.db', readers=4):
         self.db_name = db_name
         self.print_db_path()
+        self.closed = False
+        self.writer = self.connect()
+        self.writer_lock = threading.Lock()
         self.create_tables()
+        self.reader_count = readers
+        # LIFO, so the busiest connections stay warm in cache
+        self.readers = queue.LifoQueue()
+        for _ in range(readers):
+            self.readers.put(self.connect(read_only=True))
 
     def print_db_path(self):
-        """Print the absolute path of the database for debugging."""
-        print(f"📂 Database location: {os.path.abspath(self.db_name)}")
+        """Log the absolute path of the database for debugging."""
+        logger.info("📂 Database location: %s", os.path.abspath(self.db_name))
 
-    def get_conn(self):
-        """Get or create a thread-local SQLite connection."""
-        if not hasattr(self.local, 'conn'):
-            try:
-                self.local.conn = sqlite3.connect(self.db_name, check_same_thread=False)
-                self.local.conn.row_factory = sqlite3.Row
-                self.local.conn.execute("PRAGMA journal_mode=WAL")
-                self.local.conn.execute("PRAGMA foreign_keys=ON")
-            except sqlite3.Error as e:
-                print(f"🚨 Database connection failed: {e}")
-                raise
-        return self.local.conn
-
-    def close_conn(self):
-        """Close the thread-local connection if it exists."""
-        if hasattr(self.local, 'conn'):
+    def connect(self, read_only=False):
+        """Open one SQLite connection; pooled connections move between threads, one at a time."""
+        try:
+            conn = sqlite3.connect(self.db_name, check_same_thread=False,
+                                   cached_statements=self.statement_cache_size)
+            conn.row_factory = sqlite3.Row
+            if read_only:
+                conn.execute("PRAGMA query_only=ON")
+            else:
+                # Only takes effect on a new file (before WAL mode writes its header);
+                # RetentionJob converts older databases the first time it compacts
+                conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            return conn
+        except sqlite3.Error as e:
+            logger.error("🚨 Database connection failed: %s", e)
+            raise
+
+    @contextmanager
+    def reading(self):
+        """Borrow a read-only connection from the pool for the duration of the block."""
+        if self.closed:
+            raise sqlite3.ProgrammingError("Database is closed")
+        started = time.perf_counter()
+        try:
+            conn = self.readers.get(timeout=self.pool_timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError("Timed out waiting for a database connection")
+        finally:
+            POOL_WAIT_SECONDS.labels('read').observe(time.perf_counter() - started)
+        try:
+            yield conn
+        finally:
+            self.readers.put(conn)
+
+    @contextmanager
+    def writing(self, transaction=True):
+        """Hold the writer connection for the block, as one transaction committed when it exits cleanly."""
+        started = time.perf_counter()
+        with self.writer_lock:
+            POOL_WAIT_SECONDS.labels('write').observe(time.perf_counter() - started)
+            if self.closed:
+                raise sqlite3.ProgrammingError("Database is closed")
+            if not transaction:
+                yield self.writer
+                return
+            with self.writer:
+                yield self.writer
+
+    def pool_stats(self):
+        return {'readers': self.reader_count, 'idle_readers': self.readers.qsize()}
+
+    def close(self):
+        """Close the writer and, as they come back to the pool, every reader."""
+        with self.writer_lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.writer.close()
+        for _ in range(self.reader_count):
             try:
-                self.local.conn.close()
-                print("🛑 Database connection closed.")
-            except sqlite3.Error as e:
-                print(f"🚨 Error closing connection: {e}")
-            finally:
-                del self.local.conn
+                self.readers.get(timeout=self.pool_timeout).close()
+            except queue.Empty:
+                logger.error("🚨 A database reader was never returned to the pool")
+                break
+        logger.debug("🛑 Database connections closed.")
 
     def create_tables(self):
         """Create required tables if they do not exist."""
         try:
-            with self.get_conn() as conn:
+            with self.writing() as conn:
+                new_index = conn.execute(
+                    "SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'"
+                ).fetchone() is None
                 conn.executescript('''
                     CREATE TABLE IF NOT EXISTS users (
                         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -57,257 +154,435 @@ class Database:
                         username TEXT NOT NULL,
                         message TEXT NOT NULL,
                         timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                        kind INTEGER NOT NULL DEFAULT 0,
+                        sent_at INTEGER,
                         FOREIGN KEY(username) REFERENCES users(username)
                     );
 
-                    CREATE INDEX IF NOT EXISTS idx_messages_room ON messages(room);
+                    -- (room, id) serves both the room filter and keyset ordering;
+                    -- it makes the old single-column room index redundant
+                    DROP INDEX IF EXISTS idx_messages_room;
+                    CREATE INDEX IF NOT EXISTS idx_messages_room_id ON messages(room, id);
                     CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages(timestamp);
+                    -- Lets the retention job find a room's expired rows without scanning the rest
+                    CREATE INDEX IF NOT EXISTS idx_messages_room_timestamp ON messages(room, timestamp);
+
+                    -- Attachment blobs live on disk, content-addressed by sha256
+                    CREATE TABLE IF NOT EXISTS attachments (
+                        sha256 TEXT PRIMARY KEY,
+                        size INTEGER NOT NULL,
+                        uploaded_by TEXT NOT NULL,
+                        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                    );
+
+                    -- Rooms users created at runtime; the defaults are seeded so every room is listed here
+                    CREATE TABLE IF NOT EXISTS rooms (
+                        name TEXT PRIMARY KEY,
+                        created_by TEXT,
+                        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                    );
+                    INSERT OR IGNORE INTO rooms (name) VALUES ('general'), ('random'), ('support');
+
+                    -- Direct messages waiting for offline users. The primary key is the
+                    -- (recipient, seq) index: a login reads its backlog in order with one
+                    -- range seek and clears each delivered batch with another
+                    CREATE TABLE IF NOT EXISTS mailbox (
+                        recipient TEXT NOT NULL,
+                        seq INTEGER NOT NULL,
+                        sender TEXT NOT NULL,
+                        message TEXT NOT NULL,
+                        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                        sent_at INTEGER,
+                        PRIMARY KEY (recipient, seq)
+                    ) WITHOUT ROWID;
+
+                    -- Full-text index over messages. External content: the text is
+                    -- stored once, in messages, and the triggers keep the index in step
+                    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                        message, username, room,
+                        content='messages', content_rowid='id',
+                        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+                    );
+                    CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+                        INSERT INTO messages_fts (rowid, message, username, room)
+                        VALUES (new.id, new.message, new.username, new.room);
+                    END;
+                    CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+                        INSERT INTO messages_fts (messages_fts, rowid, message, username, room)
+                        VALUES ('delete', old.id, old.message, old.username, old.room);
+                    END;
+                    CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF message ON messages BEGIN
+                        INSERT INTO messages_fts (messages_fts, rowid, message, username, room)
+                        VALUES ('delete', old.id, old.message, old.username, old.room);
+                        INSERT INTO messages_fts (rowid, message, username, room)
+                        VALUES (new.id, new.message, new.username, new.room);
+                    END;
                 ''')
+                if new_index:
+                    # Index whatever history predates the search table, once
+                    conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+                    logger.info("🔎 Built the search index")
+                self.migrate_to_records(conn)
         except sqlite3.Error as e:
-            print(f"🚨 Table creation failed: {e}")
+            logger.error("🚨 Table creation failed: %s", e)
             raise
 
-    def hash_password(self, password):
-        """Hash a plain-text password."""
-        return sha256(password.encode()).hexdigest()
+    @staticmethod
+    def migrate_to_records(conn):
+        """Bring tables from before structured records up to date, once.
+
+        Adds the kind and sent_at (epoch ms) columns, fills sent_at from the
+        stored timestamp, and strips the "[HH:MM:SS] user: " prefix older
+        versions saved in front of every message body, all in SQL.
+        """
+        if 'sent_at' not in {row['name'] for row in conn.execute("PRAGMA table_info(mailbox)")}:
+            conn.execute("ALTER TABLE mailbox ADD COLUMN sent_at INTEGER")
+        if 'sent_at' in {row['name'] for row in conn.execute("PRAGMA table_info(messages)")}:
+            return
+        conn.execute("ALTER TABLE messages ADD COLUMN kind INTEGER NOT NULL DEFAULT 0")
+        conn.execute("ALTER TABLE messages ADD COLUMN sent_at INTEGER")
+        updated = conn.execute('''
+            UPDATE messages SET
+                sent_at = CAST(strftime('%s', timestamp) AS INTEGER) * 1000,
+                message = CASE
+                    WHEN substr(message, 1, 1) = '[' AND substr(message, 10, 2) = '] '
+                         AND substr(message, 12, length(username) + 2) = username || ': '
+                    THEN substr(message, 14 + length(username))
+                    ELSE message
+                END
+        ''').rowcount
+        logger.info("🧱 Converted %d stored messages to structured records", updated)
+
+    @staticmethod
+    def record(row, room=None):
+        """A Record from a messages row, or from an in-memory record dict with the same keys."""
+        return Record(row['id'], room or row['room'], row['username'], row['sent_at'] or 0, row['kind'],
+                      row['message'])
 
-    def store_message(self, room, username, message):
-        """Store a message in the database."""
+    @timed('insert_batch')
+    def store_messages(self, rows):
+        """Store a batch of (id, room, username, message, sent_at, kind) rows in one transaction.
+
+        The UTC timestamp column that retention and search filter on is derived from sent_at by SQLite.
+        """
         try:
-            with self.get_conn() as conn:
-                conn.execute(
-                    "INSERT INTO messages (room, username, message) VALUES (?, ?, ?)",
-                    (room, username, message)
+            with self.writing() as conn:
+                conn.executemany(
+                    "INSERT INTO messages (id, room, username, message, sent_at, kind, timestamp) "
+                    "VALUES (?1, ?2, ?3, ?4, ?5, ?6, strftime('%Y-%m-%d %H:%M:%S', ?5 / 1000, 'unixepoch'))",
+                    rows
                 )
-            print(f"💾 Message saved: {username}@{room} → {message[:50]}...")
             return True
         except sqlite3.Error as e:
-            print(f"🚨 Error saving message: {e}")
+            logger.error("🚨 Error saving %d messages: %s", len(rows), e)
             return False
 
-    def get_messages(self, room, limit=100):
-        """Retrieve the last `limit` messages from a given room."""
+    @timed('max_id')
+    def max_message_id(self):
+        """Return the highest message id ever stored, or 0 for a new database.
+
+        Retention can empty the table, so this also asks sqlite_sequence,
+        where AUTOINCREMENT keeps the largest id the table ever held: ids are
+        never handed out twice, and resumed sessions never see them go back.
+        """
+        with self.reading() as conn:
+            return conn.execute('''
+                SELECT MAX((SELECT COALESCE(MAX(id), 0) FROM messages),
+                           COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'messages'), 0))
+            ''').fetchone()[0]
+
+    @timed('history_page')
+    def get_history_page(self, room, before_id=None, limit=100):
+        """Return up to `limit` messages of `room` older than message id `before_id`.
+
+        Keyset pagination on the (room, id) index: every page is a single index
+        seek however far back it is, unlike OFFSET scans. Returns (rows, has_more)
+        with rows oldest first.
+        """
         try:
-            conn = self.get_conn()
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT username, message, timestamp
-                FROM messages
-                WHERE room = ?
-                ORDER BY timestamp DESC
-                LIMIT ?
-            ''', (room, limit))
-
-            results = []
-            for row in cursor.fetchall():
-                timestamp = row['timestamp']
-                if isinstance(timestamp, str):
-                    try:
-                        timestamp = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
-                    except ValueError:
-                        pass
-                formatted_time = timestamp.strftime("%Y-%m-%d %H:%M:%S") if isinstance(timestamp, datetime) else timestamp
-                results.append(f"[{formatted_time}] {row['username']}: {row['message']}")
-            return results[::-1]
+            with self.reading() as conn:
+                if before_id is None:
+                    rows = conn.execute('''
+                        SELECT id, username, message, sent_at, kind
+                        FROM messages
+                        WHERE room = ?
+                        ORDER BY id DESC
+                        LIMIT ?
+                    ''', (room, limit + 1)).fetchall()
+                else:
+                    rows = conn.execute('''
+                        SELECT id, username, message, sent_at, kind
+                        FROM messages
+                        WHERE room = ? AND id < ?
+                        ORDER BY id DESC
+                        LIMIT ?
+                    ''', (room, before_id, limit + 1)).fetchall()
+            has_more = len(rows) > limit
+            return rows[:limit][::-1], has_more
         except sqlite3.Error as e:
-            print(f"🚨 Error retrieving messages: {e}")
-            return []
+            logger.error("🚨 Error retrieving messages: %s", e)
+            return [], False
+
+    @timed('history_since')
+    def get_messages_after(self, room, after_id, limit=1000):
+        """Return up to `limit` messages of `room` newer than message id `after_id`, oldest first.
 
-    def register_user(self, username, password):
-        """Register a new user with a hashed password."""
+        The catch-up query of a resumed session: one seek on the (room, id) index.
+        """
         try:
-            with self.get_conn() as conn:
-                conn.execute(
-                    "INSERT INTO users (username, password) VALUES (?, ?)",
-                    (username, self.hash_password(password))
-                )
-            print(f"✅ User registered: {username}")
-            return True
-        except sqlite3.IntegrityError:
-            print(f"⚠️ Username already exists: {username}")
-            return False
+            with self.reading() as conn:
+                return conn.execute('''
+                    SELECT id, username, message, sent_at, kind
+                    FROM messages
+                    WHERE room = ? AND id > ?
+                    ORDER BY id
+                    LIMIT ?
+                ''', (room, after_id, limit)).fetchall()
         except sqlite3.Error as e:
-            print(f"🚨 Error registering user: {e}")
-            return False
+            logger.error("🚨 Error retrieving messages: %s", e)
+            return []
+
+    @timed('search')
+    def search_messages(self, match, room=None, since=None, until=None, limit=20, offset=0, candidates=5000):
+        """Return up to `limit` messages matching the FTS5 query `match`, best first.
 
-    def validate_user(self, username, password):
-        """Validate a username and password combination."""
+        Only the most recent `candidates` hits are ranked (by bm25), so a
+        term that matches half the table costs no more than a rare one. The
+        room is indexed too, so `match` should carry a room column filter
+        when `room` is given; that narrows the hits before the cap, and
+        `room`, `since` and `until` (timestamps as stored, UTC) are then
+        checked exactly on the joined rows. Returns (rows, has_more), each
+        row with its room and score.
+        """
+        filters, params = [], [match, candidates]
+        if room is not None:
+            filters.append("AND m.room = ?")
+            params.append(room)
+        if since is not None:
+            filters.append("AND m.timestamp >= ?")
+            params.append(since)
+        if until is not None:
+            filters.append("AND m.timestamp < ?")
+            params.append(until)
+        params += [limit + 1, offset]
         try:
-            conn = self.get_conn()
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT 1 FROM users WHERE username = ? AND password = ?",
-                (username, self.hash_password(password))
-            )
-            is_valid = cursor.fetchone() is not None
-            print(f"{'✅' if is_valid else '❌'} Login attempt: {username}")
-            return is_valid
+            with self.reading() as conn:
+                rows = conn.execute(f'''
+                    SELECT m.id, m.room, m.username, m.message, m.sent_at, m.kind, hits.rank AS score
+                    FROM (
+                        SELECT rowid, rank FROM messages_fts
+                        WHERE messages_fts MATCH ?
+                        ORDER BY rowid DESC
+                        LIMIT ?
+                    ) AS hits
+                    JOIN messages m ON m.id = hits.rowid
+                    WHERE 1 {' '.join(filters)}
+                    ORDER BY hits.rank
+                    LIMIT ? OFFSET ?
+                ''', params).fetchall()
+            return rows[:limit], len(rows) > limit
         except sqlite3.Error as e:
-            print(f"🚨 Error validating user: {e}")
-            return False
+            logger.error("🚨 Error searching messages: %s", e)
+            return [], False
 
-import sqlite3
-from hashlib import sha256
-import threading
-import os
-from datetime import datetime
+    @timed('retention_rooms')
+    def message_rooms(self):
+        """Return the names of all rooms with stored messages."""
+        with self.reading() as conn:
+            rows = conn.execute("SELECT DISTINCT room FROM messages").fetchall()
+        return [row['room'] for row in rows]
 
-class Database:
-    def __init__(self, db_name='chat_app.db'):
-        self.local = threading.local()
-        self.db_name = db_name
-        self.print_db_path()
-        self.create_tables()
+    @timed('retention_select')
+    def messages_before(self, room, cutoff, limit=500):
+        """Return up to `limit` of the oldest messages of `room` stamped before `cutoff`, oldest first."""
+        with self.reading() as conn:
+            return conn.execute('''
+                SELECT id, room, username, message, timestamp, kind, sent_at
+                FROM messages
+                WHERE room = ? AND timestamp < ?
+                ORDER BY timestamp, id
+                LIMIT ?
+            ''', (room, cutoff, limit)).fetchall()
 
-    def print_db_path(self):
-        """Print the absolute path of the database for debugging."""
-        print(f"📂 Database location: {os.path.abspath(self.db_name)}")
+    @timed('retention_delete')
+    def delete_messages(self, ids):
+        """Delete messages by id in one transaction (the search index follows via trigger)."""
+        with self.writing() as conn:
+            conn.executemany("DELETE FROM messages WHERE id = ?", ((message_id,) for message_id in ids))
 
-    def get_conn(self):
-        """Get or create a thread-local SQLite connection."""
-        if not hasattr(self.local, 'conn'):
-            try:
-                self.local.conn = sqlite3.connect(self.db_name, check_same_thread=False)
-                self.local.conn.row_factory = sqlite3.Row
-                self.local.conn.execute("PRAGMA journal_mode=WAL")
-                self.local.conn.execute("PRAGMA foreign_keys=ON")
-            except sqlite3.Error as e:
-                print(f"🚨 Database connection failed: {e}")
-                raise
-        return self.local.conn
-
-    def close_conn(self):
-        """Close the thread-local connection if it exists."""
-        if hasattr(self.local, 'conn'):
-            try:
-                self.local.conn.close()
-                print("🛑 Database connection closed.")
-            except sqlite3.Error as e:
-                print(f"🚨 Error closing connection: {e}")
-            finally:
-                del self.local.conn
+    def pragma(self, statement):
+        """Run a PRAGMA on the writer, outside any transaction, and return its first row, if any."""
+        with self.writing(transaction=False) as conn:
+            return conn.execute(f"PRAGMA {statement}").fetchone()
 
-    def create_tables(self):
-        """Create required tables if they do not exist."""
-        try:
-            with self.get_conn() as conn:
-                conn.executescript('''
-                    CREATE TABLE IF NOT EXISTS users (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        username TEXT UNIQUE NOT NULL,
-                        password TEXT NOT NULL,
-                        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                    );
+    @timed('checkpoint')
+    def checkpoint(self, mode='TRUNCATE'):
+        """Copy the WAL back into the database; TRUNCATE also shrinks the -wal file. Returns (busy, wal pages, copied)."""
+        return tuple(self.pragma(f"wal_checkpoint({mode})"))
 
-                    CREATE TABLE IF NOT EXISTS messages (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        room TEXT NOT NULL,
-                        username TEXT NOT NULL,
-                        message TEXT NOT NULL,
-                        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY(username) REFERENCES users(username)
-                    );
+    @timed('incremental_vacuum')
+    def incremental_vacuum(self, pages):
+        """Return up to `pages` free pages to the filesystem. Returns how many free pages remain."""
+        with self.writing(transaction=False) as conn:
+            conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+            return conn.execute("PRAGMA freelist_count").fetchone()[0]
 
-                    CREATE INDEX IF NOT EXISTS idx_messages_room ON messages(room);
-                    CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages(timestamp);
-                ''')
-        except sqlite3.Error as e:
-            print(f"🚨 Table creation failed: {e}")
-            raise
+    @timed('vacuum')
+    def vacuum(self):
+        """Rebuild the whole file (e.g. so a new auto_vacuum setting takes effect)."""
+        with self.writing(transaction=False) as conn:
+            conn.execute("VACUUM")
 
-    def hash_password(self, password):
-        """Hash a plain-text password."""
-        return sha256(password.encode()).hexdigest()
+    def get_messages(self, room, limit=100):
+        """Retrieve the last `limit` messages from a given room, rendered as text lines."""
+        rows, _ = self.get_history_page(room, limit=limit)
+        return [render(self.record(row, room)) for row in rows]
 
-    def store_message(self, room, username, message):
-        """Store a message in the database."""
+    @timed('record_attachment')
+    def record_attachment(self, sha256, size, username):
+        """Remember an attachment blob; a no-op if the same content was uploaded before."""
         try:
-            with self.get_conn() as conn:
+            with self.writing() as conn:
                 conn.execute(
-                    "INSERT INTO messages (room, username, message) VALUES (?, ?, ?)",
-                    (room, username, message)
+                    "INSERT OR IGNORE INTO attachments (sha256, size, uploaded_by) VALUES (?, ?, ?)",
+                    (sha256, size, username)
                 )
-            print(f"💾 Message saved: {username}@{room} → {message[:50]}...")
             return True
         except sqlite3.Error as e:
-            print(f"🚨 Error saving message: {e}")
+            logger.error("🚨 Error recording attachment: %s", e)
             return False
 
-    def get_messages(self, room, limit=100):
-        """Retrieve the last `limit` messages from a given room."""
+    @timed('list_rooms')
+    def list_rooms(self):
+        """Return every room as rows of (name, created_by), oldest first."""
         try:
-            conn = self.get_conn()
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT username, message, timestamp
-                FROM messages
-                WHERE room = ?
-                ORDER BY timestamp DESC
-                LIMIT ?
-            ''', (room, limit))
-
-            results = []
-            for row in cursor.fetchall():
-                timestamp = row['timestamp']
-                if isinstance(timestamp, str):
-                    try:
-                        timestamp = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
-                    except ValueError:
-                        pass
-                formatted_time = timestamp.strftime("%Y-%m-%d %H:%M:%S") if isinstance(timestamp, datetime) else timestamp
-                results.append(f"[{formatted_time}] {row['username']}: {row['message']}")
-            return results[::-1]
+            with self.reading() as conn:
+                return conn.execute(
+                    "SELECT name, created_by FROM rooms ORDER BY created_at, rowid"
+                ).fetchall()
         except sqlite3.Error as e:
-            print(f"🚨 Error retrieving messages: {e}")
+            logger.error("🚨 Error listing rooms: %s", e)
             return []
 
+    @timed('create_room')
+    def create_room(self, name, created_by):
+        """Persist a new room. Returns False if the name is already taken."""
+        try:
+            with self.writing() as conn:
+                conn.execute("INSERT INTO rooms (name, created_by) VALUES (?, ?)", (name, created_by))
+            logger.info("🏠 Room created: %s by %s", name, created_by)
+            return True
+        except sqlite3.IntegrityError:
+            return False
+        except sqlite3.Error as e:
+            logger.error("🚨 Error creating room: %s", e)
+            return False
 
-    def authenticate_user(self, username, password):
-        conn = self.get_conn()
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE username = ? AND password = ?", (username, password))
-        return cursor.fetchone() is not None
+    @timed('delete_room')
+    def delete_room(self, name):
+        """Forget a room; its messages stay in the messages table."""
+        try:
+            with self.writing() as conn:
+                conn.execute("DELETE FROM rooms WHERE name = ?", (name,))
+            logger.info("🗑️ Room deleted: %s", name)
+            return True
+        except sqlite3.Error as e:
+            logger.error("🚨 Error deleting room: %s", e)
+            return False
 
-    def add_user(self, username, password):
-        conn = self.get_conn()
-        cursor = conn.cursor()
+    @timed('mail_store')
+    def store_mail(self, record):
+        """Append a direct message record to its recipient's mailbox, numbered after the last one waiting there."""
         try:
-            cursor.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, password))
-            conn.commit()
+            with self.writing() as conn:
+                conn.execute('''
+                    INSERT INTO mailbox (recipient, seq, sender, message, sent_at)
+                    SELECT ?1, COALESCE(MAX(seq), 0) + 1, ?2, ?3, ?4 FROM mailbox WHERE recipient = ?1
+                ''', (record.room, record.sender, record.body, record.ts))
             return True
-        except sqlite3.IntegrityError:
+        except sqlite3.Error as e:
+            logger.error("🚨 Error storing direct message: %s", e)
             return False
 
+    @timed('mail_batch')
+    def mailbox_batch(self, recipient, limit=100):
+        """Return the oldest `limit` messages waiting for `recipient`, in order."""
+        try:
+            with self.reading() as conn:
+                return conn.execute('''
+                    SELECT seq, sender, message, sent_at
+                    FROM mailbox
+                    WHERE recipient = ?
+                    ORDER BY seq
+                    LIMIT ?
+                ''', (recipient, limit)).fetchall()
+        except sqlite3.Error as e:
+            logger.error("🚨 Error reading mailbox: %s", e)
+            return []
+
+    @timed('mail_delete')
+    def delete_mail(self, recipient, through_seq):
+        """Remove `recipient`'s delivered messages, up to and including `through_seq`."""
+        try:
+            with self.writing() as conn:
+                conn.execute("DELETE FROM mailbox WHERE recipient = ? AND seq <= ?", (recipient, through_seq))
+            return True
+        except sqlite3.Error as e:
+            logger.error("🚨 Error clearing mailbox: %s", e)
+            return False
 
-    def register_user(self, username, password):
-        """Register a new user with a hashed password."""
+    @timed('register_user')
+    def register_user(self, username, password_hash):
+        """Register a new user with an already-derived password hash."""
         try:
-            with self.get_conn() as conn:
+            with self.writing() as conn:
                 conn.execute(
                     "INSERT INTO users (username, password) VALUES (?, ?)",
-                    (username, self.hash_password(password))
+                    (username, password_hash)
                 )
-            print(f"✅ User registered: {username}")
+            logger.info("✅ User registered: %s", username)
             return True
         except sqlite3.IntegrityError:
-            print(f"⚠️ Username already exists: {username}")
+            logger.info("⚠️ Username already exists: %s", username)
             return False
         except sqlite3.Error as e:
-            print(f"🚨 Error registering user: {e}")
+            logger.error("🚨 Error registering user: %s", e)
             return False
 
-    def validate_user(self, username, password):
-        """Validate a username and password combination."""
+    @timed('user_lookup')
+    def get_password_hash(self, username):
+        """Return the stored password hash for `username`, or None if there is no such user."""
         try:
-            conn = self.get_conn()
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT 1 FROM users WHERE username = ? AND password = ?",
-                (username, self.hash_password(password))
-            )
-            is_valid = cursor.fetchone() is not None
-            print(f"{'✅' if is_valid else '❌'} Login attempt: {username}")
-            return is_valid
+            with self.reading() as conn:
+                row = conn.execute(
+                    "SELECT password FROM users WHERE username = ?", (username,)
+                ).fetchone()
+            return row['password'] if row else None
+        except sqlite3.Error as e:
+            logger.error("🚨 Error looking up user: %s", e)
+            return None
+
+    @timed('user_lookup')
+    def user_exists(self, username):
+        try:
+            with self.reading() as conn:
+                return conn.execute(
+                    "SELECT 1 FROM users WHERE username = ?", (username,)
+                ).fetchone() is not None
+        except sqlite3.Error as e:
+            logger.error("🚨 Error looking up user: %s", e)
+            return False
+
+    @timed('set_password')
+    def set_password_hash(self, username, password_hash):
+        """Replace the stored password hash for `username`."""
+        try:
+            with self.writing() as conn:
+                cursor = conn.execute(
+                    "UPDATE users SET password = ? WHERE username = ?",
+                    (password_hash, username)
+                )
+            return cursor.rowcount == 1
         except sqlite3.Error as e:
-            print(f"🚨 Error validating user: {e}")
+            logger.error("🚨 Error updating password: %s", e)
             return False
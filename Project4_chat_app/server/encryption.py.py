@@ -4,13 +4,20 @@ from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 import base64
 import logging
+import time
 from typing import Union, Optional, Dict, Any
 from getpass import getpass
+from ciphers import DEFAULT_SUITE, CipherSuites
+from compression import CompressionStage
+from metrics import histogram
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+ENCRYPT_SECONDS = histogram('chat_encrypt_seconds', "Compress + encrypt time per payload, by cipher suite", ['suite'])
+DECRYPT_SECONDS = histogram('chat_decrypt_seconds', "Decrypt + decompress time per chat payload")
+
 class EncryptionManager:
     # Development key - override with environment variable in production
     DEFAULT_KEY = b'CdkW6E-EpEDi3B_fI3NKFrjZEG3FyhM3kyehQ2kuU5c='
@@ -26,7 +33,8 @@ class EncryptionManager:
             key_env_var: Environment variable name to check for key
         """
         self.key = self._load_key(key, key_env_var)
-        self.cipher = Fernet(self.key)
+        self.cipher = CipherSuites(self.key)
+        self.compression = CompressionStage()
         logger.info("Encryption manager initialized with %s key source", 
                    "provided" if key else "environment" if os.getenv(key_env_var) else "default")
 
@@ -74,8 +82,13 @@ class EncryptionManager:
         except (ValueError, TypeError):
             return False
 
-    def encrypt(self, message: Union[str, bytes]) -> bytes:
-        """Encrypt message with proper type checking."""
+    def encrypt(self, message: Union[str, bytes], codec: Optional[str] = None, suite: Optional[str] = None) -> bytes:
+        """Encrypt message with proper type checking.
+
+        If `codec` names a negotiated compression codec, the message is
+        compressed first (messages under the compression threshold are not).
+        `suite` picks the negotiated cipher suite; Fernet if not given.
+        """
         if not message:
             raise ValueError("Cannot encrypt empty message")
             
@@ -84,7 +97,10 @@ class EncryptionManager:
             raise TypeError("Message must be str or bytes")
 
         try:
-            return self.cipher.encrypt(message_bytes)
+            started = time.perf_counter()
+            token = self.cipher.encrypt(self.compression.compress(message_bytes, codec), suite)
+            ENCRYPT_SECONDS.labels(suite or DEFAULT_SUITE).observe(time.perf_counter() - started)
+            return token
         except Exception as e:
             logger.error("Encryption failed: %s", str(e))
             raise
@@ -98,7 +114,10 @@ class EncryptionManager:
             if not isinstance(encrypted_message, bytes):
                 raise TypeError("Encrypted message must be str or bytes")
                 
-            return self.cipher.decrypt(encrypted_message).decode('utf-8')
+            started = time.perf_counter()
+            plaintext = self.compression.decompress(self.cipher.decrypt(encrypted_message))
+            DECRYPT_SECONDS.observe(time.perf_counter() - started)
+            return plaintext.decode('utf-8')
         except InvalidToken as e:
             logger.warning("Decryption failed - invalid token")
             raise
@@ -106,6 +125,14 @@ class EncryptionManager:
             logger.error("Decryption error: %s", str(e))
             raise
 
+    def decrypt_bytes(self, encrypted_message: bytes) -> bytes:
+        """Decrypt a binary payload (attachment chunks) without decoding it as text."""
+        try:
+            return self.cipher.decrypt(encrypted_message)
+        except InvalidToken:
+            logger.warning("Decryption failed - invalid token")
+            raise
+
     # Additional utility methods remain unchanged...
     # (generate_key_from_password, generate_new_key, encrypt_dict, decrypt_dict, etc.)
 
@@ -0,0 +1,456 @@
+"""Federation: several chat server nodes acting as one cluster through a relay.
+
+Every node connects to one relay process over TCP and subscribes only to
+the rooms it has members in (plus one topic per locally connected user,
+for direct messages, and the cluster topic for room list changes). Chat
+messages are posted to the relay, which gives each one the next message
+id and sends it to every node subscribed to the room, the posting node
+included, so all nodes see a room's messages in the same order with the
+same ids. The posting node persists it; the others only update their
+history ring and deliver it. Nodes share the database the way sharded
+workers do, so users, rooms, history and mailboxes are the same on every
+node, and capacity grows by adding nodes behind a TCP load balancer.
+
+The relay is deliberately small: it routes frames by topic without
+parsing their JSON, numbers posts, keeps the last `retain` posts of each
+room and each node's latest roster of it, and replays both to a node
+subscribing to the room, so a node that was not in a room catches up on
+its recent history and on who is there. Run it with:
+
+    python federation.py --port 7000
+
+and start each node with `python server.py --relay relayhost:7000`.
+"""
+import argparse
+import json
+import logging
+import socket
+import struct
+import threading
+import time
+import weakref
+from collections import deque
+from database import Database
+from outbound import DROP_OLDEST, OutboundQueue, QueuedConnection
+from protocol import FRAME_JSON, FrameReader, ProtocolError, encode_frame, encode_json
+from records import TEXT, Record, notice, now_ms
+
+logger = logging.getLogger(__name__)
+
+# Every relay frame is a FRAME_JSON whose payload starts with this header and
+# the topic, so the relay can route without parsing the JSON that follows:
+# verb, flags, source node (filled in by the relay), message id (filled in
+# by the relay for posts) and the topic's length.
+HEADER = struct.Struct('>BBhQH')
+
+HELLO = 1     # node -> relay: {'max_id': highest message id it knows}
+WELCOME = 2   # relay -> node: its node number in the source field
+SUB = 3
+UNSUB = 4
+PUB = 5       # forward to the topic's other subscribers
+POST = 6      # number, retain and forward to every subscriber and the poster
+BOUNCED = 7   # relay -> node: a PUB with BOUNCE that nobody else subscribes to
+
+RETAIN = 1    # PUB: keep as the source node's latest state for the topic
+BOUNCE = 2    # PUB: hand back to the sender if no other node subscribes
+REPLAY = 4    # set by the relay on catch-up frames sent to a new subscriber
+
+CLUSTER = '*'
+RELAY_QUEUE_SIZE = 65536
+RECONNECT_DELAY = 1.0
+
+
+def encode_relay(verb, topic, body=None, flags=0, source=0, message_id=0):
+    topic = topic.encode('utf-8')
+    payload = json.dumps(body).encode('utf-8') if body is not None else b''
+    return encode_frame(FRAME_JSON, HEADER.pack(verb, flags, source, message_id, len(topic)) + topic + payload)
+
+
+def restamp(payload, verb, source, message_id=0, flags=0):
+    """A node's frame payload with the relay's verb, source node and message id in its header, as a frame."""
+    _, own_flags, _, _, topic_length = HEADER.unpack_from(payload)
+    return encode_frame(FRAME_JSON, HEADER.pack(verb, own_flags | flags, source, message_id, topic_length)
+                        + payload[HEADER.size:])
+
+
+def decode_relay(payload):
+    """(verb, flags, source, message id, topic, raw JSON body) of a relay frame's payload."""
+    verb, flags, source, message_id, topic_length = HEADER.unpack_from(payload)
+    start = HEADER.size + topic_length
+    return verb, flags, source, message_id, payload[HEADER.size:start].decode('utf-8'), payload[start:]
+
+
+def user_topic(username):
+    return '@' + username
+
+
+class RelayBroker:
+    """The relay: topic-routed pub/sub between nodes, over TCP.
+
+    Writes to each node go through an OutboundQueue, so one slow node never
+    stalls the others. Posts are numbered and fanned out under one lock, so
+    every subscriber receives a room's posts in id order.
+    """
+
+    def __init__(self, host='0.0.0.0', port=7000, retain=100):
+        self.retain = retain
+        self.next_id = 1
+        self.nodes = {}  # {node: QueuedConnection}
+        self.topics = {}  # {topic: {node: None}}
+        self.logs = {}  # {topic: deque of numbered POST payloads}
+        self.states = {}  # {topic: {node: RETAIN payload}}
+        self.lock = threading.Lock()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(64)
+        self.running = False
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self._accept_loop, name='chat-relay-accept', daemon=True).start()
+
+    def _accept_loop(self):
+        while self.running:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                break
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._serve, args=(conn,), name='chat-relay-node', daemon=True).start()
+
+    def _send(self, nodes, frame):
+        for node in nodes:
+            try:
+                node.sendall(frame)
+            except ConnectionError:
+                pass
+
+    def _serve(self, conn):
+        reader = FrameReader(conn)
+        peer = QueuedConnection(conn, OutboundQueue(RELAY_QUEUE_SIZE, DROP_OLDEST))
+        node = None
+        try:
+            frame = reader.read_frame()
+            verb, _, _, _, _, body = decode_relay(frame[1]) if frame else (None,) * 6
+            if verb != HELLO:
+                return
+            with self.lock:
+                node = next(n for n in range(len(self.nodes) + 1) if n not in self.nodes)
+                self.nodes[node] = peer
+                self.next_id = max(self.next_id, int(json.loads(body).get('max_id', 0)) + 1)
+            peer.sendall(encode_relay(WELCOME, '', source=node))
+            logger.info("Node %d joined the relay", node)
+            while True:
+                frame = reader.read_frame()
+                if frame is None:
+                    break
+                self._handle(node, peer, frame[1])
+        except (OSError, ConnectionError, ProtocolError, ValueError, struct.error) as e:
+            logger.warning("Relay node %s error: %s", node, e)
+        finally:
+            if node is not None:
+                self._forget(node, peer)
+            peer.close()
+
+    def _handle(self, node, peer, payload):
+        verb, flags, _, _, topic, body = decode_relay(payload)
+        if verb == SUB:
+            with self.lock:
+                self.topics.setdefault(topic, {})[node] = None
+                # Catch-up: the other nodes' state for the topic, then its recent posts
+                replay = [(PUB, source, 0, state) for source, state in self.states.get(topic, {}).items()
+                          if source != node]
+                replay += [(POST, source, message_id, post) for source, message_id, post in self.logs.get(topic, ())]
+                # Under the lock, so no new post can overtake the catch-up
+                for verb, source, message_id, payload in replay:
+                    peer.sendall(restamp(payload, verb, source, message_id, REPLAY))
+        elif verb == UNSUB:
+            with self.lock:
+                subscribers = self.topics.get(topic, {})
+                subscribers.pop(node, None)
+                if not subscribers:
+                    self.topics.pop(topic, None)
+        elif verb == POST:
+            with self.lock:
+                message_id, self.next_id = self.next_id, self.next_id + 1
+                frame = restamp(payload, POST, node, message_id)
+                log = self.logs.get(topic)
+                if log is None:
+                    log = self.logs[topic] = deque(maxlen=self.retain)
+                log.append((node, message_id, payload))
+                targets = [self.nodes[n] for n in self.topics.get(topic, {}) if n in self.nodes and n != node]
+                # The poster gets its post back even if it left the room meanwhile: it persists it
+                self._send(targets + [peer], frame)
+        elif verb == PUB:
+            with self.lock:
+                if flags & RETAIN:
+                    self.states.setdefault(topic, {})[node] = payload
+                targets = [self.nodes[n] for n in self.topics.get(topic, {}) if n in self.nodes and n != node]
+                if targets:
+                    self._send(targets, restamp(payload, PUB, node))
+                elif flags & BOUNCE:
+                    self._send([peer], restamp(payload, BOUNCED, node))
+
+    def _forget(self, node, peer):
+        """Drop a node that went away, and tell its rooms that its members are gone."""
+        with self.lock:
+            if self.nodes.get(node) is peer:
+                del self.nodes[node]
+            for topic in list(self.topics):
+                self.topics[topic].pop(node, None)
+                if not self.topics[topic]:
+                    del self.topics[topic]
+            cleared = [topic for topic, states in self.states.items() if states.pop(node, None) is not None]
+            for topic in cleared:
+                targets = [self.nodes[n] for n in self.topics.get(topic, {}) if n in self.nodes]
+                self._send(targets, encode_relay(PUB, topic, {'op': 'roster', 'room': topic, 'users': []},
+                                                 source=node))
+        logger.info("Node %d left the relay", node)
+
+    def close(self):
+        self.running = False
+        self.sock.close()
+        with self.lock:
+            nodes = list(self.nodes.values())
+        for node in nodes:
+            node.close()
+
+
+class FederationBus:
+    """A node's connection to the relay, and the cross-node half of ChatServer.
+
+    Plays the same part as ShardBus, for nodes that may run on different
+    hosts: subscriptions follow local membership (roster_changed), posts
+    are numbered by the relay, and each room's roster is published as
+    retained state so a node entering the room learns who is there.
+    """
+
+    def __init__(self, host, port):
+        self.address = (host, port)
+        self.index = None  # node number, given by the relay
+        self.server = None
+        self.conn = None
+        self.closing = False
+        self.senders = weakref.WeakValueDictionary()  # {id(conn): conn} for echo suppression
+        self.subscribed = set()  # rooms and user topics
+        self.published = {}  # {room: [usernames]} as last published
+        self.rosters = {}  # {room: {node: [usernames]}}
+        self.last_id = 0
+        self.lock = threading.Lock()
+        self.roster_lock = threading.Lock()  # keeps subscribe/unsubscribe requests in the order they were decided
+
+    def message_ids(self):
+        # Ids come from the relay; the writer's own counter is unused
+        return ()
+
+    def attach(self, server):
+        self.server = server
+        self._connect()
+
+    def _connect(self):
+        sock = socket.create_connection(self.address)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        max_id = max(self.server.db.max_message_id(), self.last_id)
+        sock.sendall(encode_relay(HELLO, '', {'max_id': max_id}))
+        reader = FrameReader(sock)
+        frame = reader.read_frame()
+        if frame is None:
+            raise ConnectionError("Relay closed the connection")
+        verb, _, node, _, _, _ = decode_relay(frame[1])
+        if verb != WELCOME:
+            raise ProtocolError("Relay did not welcome us")
+        self.index = node
+        previous, self.conn = self.conn, QueuedConnection(sock, OutboundQueue(RELAY_QUEUE_SIZE, DROP_OLDEST))
+        if previous is not None:
+            # The link that failed: stop its writer thread and release its socket
+            previous.abort()
+        with self.roster_lock:
+            self.subscribed.clear()
+            self.published.clear()
+        with self.lock:
+            self.rosters.clear()
+        self._send(SUB, CLUSTER)
+        threading.Thread(target=self._read_loop, args=(reader,), name='chat-relay', daemon=True).start()
+        logger.info("Joined the relay at %s:%s as node %d", *self.address, node)
+        self.roster_changed()
+
+    def _send(self, verb, topic, body=None, flags=0):
+        try:
+            self.conn.sendall(encode_relay(verb, topic, body, flags))
+        except ConnectionError:
+            pass
+
+    def publish(self, message):
+        """Send a cluster-wide event (room list changes, password changes) to every other node."""
+        self._send(PUB, CLUSTER, message)
+
+    def post(self, room, username, message, sender, kind=TEXT):
+        """Send a chat message to the relay for numbering; it comes back as a 'message' to persist and deliver."""
+        self.senders[id(sender)] = sender
+        record = {'room': room, 'username': username, 'message': message, 'sent_at': now_ms(), 'kind': kind}
+        self._send(POST, room, {'op': 'message', 'record': record, 'sender': id(sender)})
+
+    def notice(self, room, message):
+        self._send(PUB, room, {'op': 'notice', 'room': room, 'message': message})
+
+    def presence(self, room, diff):
+        self._send(PUB, room, {'op': 'presence', 'room': room, 'diff': diff})
+
+    def forward_direct(self, record, sender):
+        """Send a direct message toward whichever node the recipient is on.
+
+        Returns False if there is no such user. If nobody has them connected
+        the relay bounces it back, and it goes to their mailbox from here.
+        """
+        if not self.server.db.user_exists(record.room):
+            return False
+        self.senders[id(sender)] = sender
+        self._send(PUB, user_topic(record.room), {'op': 'direct', 'record': record, 'sender': id(sender)}, BOUNCE)
+        return True
+
+    def roster_changed(self):
+        """Follow local membership: subscribe to rooms and users that are here, publish changed rosters, and unsubscribe from the rest."""
+        with self.roster_lock:
+            roster = {room: sorted(set(users)) for room, users in self.server.local_roster().items()}
+            users = {user_topic(username) for usernames in roster.values() for username in usernames}
+            changed = {room: usernames for room, usernames in roster.items()
+                       if usernames != self.published.get(room, [])}
+            changed.update({room: [] for room in self.published if room not in roster})
+            self.published = {room: usernames for room, usernames in roster.items() if usernames}
+            wanted = set(self.published) | users
+            joining, leaving = wanted - self.subscribed, self.subscribed - wanted
+            self.subscribed = wanted
+            for topic in joining:
+                if not topic.startswith('@'):
+                    # What was said while we were away is in the database; the relay replays what is not yet
+                    self.server.history.warm([topic])
+                self._send(SUB, topic)
+            for room, usernames in changed.items():
+                self._send(PUB, room, {'op': 'roster', 'room': room, 'users': usernames}, RETAIN)
+            for topic in leaving:
+                self._send(UNSUB, topic)
+
+    def update_roster(self, room, source, users, replayed):
+        """Take a node's roster of a room. Local members hear about the people in a catch-up roster, or
+        the people of a node that went away, as a presence diff; ordinary changes reached them as diffs already."""
+        with self.lock:
+            rosters = self.rosters.setdefault(room, {})
+            before = set(rosters.get(source, ()))
+            if users:
+                rosters[source] = users
+            else:
+                rosters.pop(source, None)
+            elsewhere = {user for node_users in rosters.values() for user in node_users}
+        if users and not replayed:
+            return
+        members = self.server.rooms.get(room)
+        local = set(members.usernames()) if members is not None else set()
+        diff = {'joined': sorted(set(users) - before - local),
+                'left': sorted(before - set(users) - elsewhere - local)}
+        diff = {key: names for key, names in diff.items() if names}
+        if diff:
+            self.server.deliver_presence(room, encode_json({'type': 'presence', 'room': room, **diff}))
+
+    def remote_users(self, room):
+        with self.lock:
+            return [user for users in self.rosters.get(room, {}).values() for user in users]
+
+    def _read_loop(self, reader):
+        try:
+            while True:
+                frame = reader.read_frame()
+                if frame is None:
+                    break
+                verb, flags, source, message_id, _, body = decode_relay(frame[1])
+                self.server.call_soon(self.handle, verb, flags, source, message_id, json.loads(body))
+        except (OSError, ConnectionError, ProtocolError, ValueError) as e:
+            logger.error("Relay connection error: %s", e)
+        self._reconnect()
+
+    def _reconnect(self):
+        """Rejoin the relay after losing it; messages posted in the meantime are lost."""
+        while not self.closing:
+            time.sleep(RECONNECT_DELAY)
+            try:
+                self._connect()
+                return
+            except (OSError, ConnectionError, ProtocolError) as e:
+                logger.warning("Relay unreachable: %s", e)
+
+    def handle(self, verb, flags, source, message_id, message):
+        op = message.get('op')
+        try:
+            if verb == BOUNCED and op == 'direct':
+                # Nobody has the recipient connected
+                record = Record(*message['record'])
+                self.server.db.store_mail(record)
+                sender = self.senders.get(message['sender'])
+                if sender is not None:
+                    sender.sendall(self.server.encrypt_for(
+                        sender, f"{record.room} is offline and will get it at their next login"))
+            elif op == 'message':
+                record = dict(message['record'], id=message_id)
+                self.last_id = max(self.last_id, message_id)
+                sender = self.senders.get(message['sender']) if source == self.index else None
+                if source == self.index and not flags & REPLAY:
+                    # The relay numbered our post: we are the node that writes it
+                    self.server.store_record(record)
+                # Replayed posts may already be in the ring
+                if self.server.history.insert(record['room'], record):
+                    self.server.deliver(record['room'], Database.record(record), sender)
+            elif op == 'presence':
+                frame = encode_json({'type': 'presence', 'room': message['room'], **message['diff']})
+                self.server.deliver_presence(message['room'], frame)
+            elif op == 'notice':
+                self.server.deliver(message['room'], notice(message['room'], message['message']))
+            elif op == 'roster':
+                self.update_roster(message['room'], source, message['users'], flags & REPLAY)
+            elif op == 'direct':
+                record = Record(*message['record'])
+                # They may have logged off since the relay routed it
+                if not self.server.deliver_direct(record):
+                    self.server.db.store_mail(record)
+            elif op == 'invalidate':
+                self.server.auth.invalidate(message['username'])
+            elif op == 'room_created':
+                self.server.rooms.add_local(message['room'], message['created_by'])
+                self.server.rooms_changed()
+            elif op == 'room_deleted':
+                room = self.server.rooms.remove_local(message['room'])
+                if room is not None:
+                    self.server.close_room(room)
+                self.server.rooms_changed()
+        except Exception as e:
+            logger.error("Relay error handling %s: %s", op, e)
+
+    def close(self):
+        self.closing = True
+        if self.conn:
+            self.conn.close()
+
+
+def main():
+    from logs import configure_logging
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=7000)
+    parser.add_argument('--retain', type=int, default=100, help="recent messages kept per room for catch-up")
+    parser.add_argument('--log-level', default='info')
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+    relay = RelayBroker(args.host, args.port, args.retain)
+    relay.start()
+    logger.info("Relay listening on %s:%s", args.host, args.port)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        relay.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""Hot restart: hand the listening socket and live connections to a replacement process.
+
+A server started with --hot-restart PATH listens on the Unix socket PATH.
+Starting a second server with the same PATH (a deploy) makes it connect
+there first and take over instead of binding the port itself:
+
+1. The old process passes its listening socket over the Unix socket as
+   SCM_RIGHTS ancillary data and stops accepting. Connections arriving
+   from then on wait in the kernel's listen backlog until the new
+   process accepts them, so none are refused.
+2. Every client handler stops reading between two frames ("parks"), the
+   old process flushes each client's outbound queue and sends its socket
+   with its session state (user, room, negotiated codec, cipher and
+   framing, /history cursor) and any bytes it had read but not handled.
+3. It closes its write-behind queue, so every message it numbered is in
+   SQLite, says 'done' and exits. Only then does the new process open the
+   database, so its message ids carry on where the old ones stopped, and
+   it serves the inherited clients as if they had never left.
+
+Clients see no disconnect; ones that did not park in time (say, halfway
+through logging in) are closed by the old process and reconnect with their
+session token. Each message is one protocol frame (FRAME_JSON) carrying at
+most one descriptor, sent with the frame's first byte. Unix only.
+"""
+import base64
+import json
+import logging
+import os
+import select
+import socket
+import threading
+from collections import deque
+from metrics import counter
+from protocol import FRAME_JSON, RECV_SIZE, FrameDecoder, ProtocolError, encode_json
+
+logger = logging.getLogger('chat.handoff')
+
+HANDED_OFF = counter('chat_handoff_connections_total', "Client connections passed to a replacement process by a "
+                     "hot restart, by outcome", ['result'])
+
+MAX_FDS = 4  # descriptors accepted per recvmsg; each message carries at most one
+
+
+def readable(sock, timeout):
+    """Wait up to `timeout` seconds for `sock` to have data (or EOF) without reading any of it."""
+    poller = select.poll()
+    poller.register(sock, select.POLLIN)
+    return bool(poller.poll(timeout * 1000))
+
+
+class Channel:
+    """The Unix socket between the old and the new process: JSON frames, some with a descriptor attached."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.decoder = FrameDecoder()
+        self.frames = deque()
+        self.fds = deque()
+
+    def send(self, message, fd=None):
+        frame = encode_json({**message, 'fd': True} if fd is not None else message)
+        if fd is None:
+            self.sock.sendall(frame)
+            return
+        sent = socket.send_fds(self.sock, [frame], [fd])
+        if sent < len(frame):
+            self.sock.sendall(frame[sent:])
+
+    def receive(self):
+        """Return the next (message, descriptor or None), or (None, None) when the peer hangs up.
+
+        A descriptor arrives with its frame's first byte, so by the time the
+        whole frame has been read it is the oldest one not yet claimed.
+        """
+        while not self.frames:
+            data, fds, _, _ = socket.recv_fds(self.sock, RECV_SIZE, MAX_FDS)
+            self.fds.extend(fds)
+            if not data:
+                return None, None
+            self.frames.extend(self.decoder.feed(data))
+        frame_type, payload = self.frames.popleft()
+        if frame_type != FRAME_JSON:
+            raise ProtocolError("Expected a JSON control frame")
+        message = json.loads(payload.decode('utf-8'))
+        fd = self.fds.popleft() if message.get('fd') and self.fds else None
+        return message, fd
+
+    def close(self):
+        for fd in self.fds:
+            os.close(fd)
+        self.fds.clear()
+        self.sock.close()
+
+
+def take_over(path, timeout=30.0):
+    """Take the listening socket and live connections of the server running with hot restart at `path`.
+
+    Returns (listening socket or None, [(client socket, session, carry)]),
+    or None if no server is listening at `path` (a cold start). Blocks
+    until the old process has drained, at most `timeout` seconds between
+    messages.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+    sock.settimeout(timeout)
+    channel = Channel(sock)
+    listener, clients = None, []
+    try:
+        channel.send({'type': 'takeover', 'pid': os.getpid()})
+        while True:
+            message, fd = channel.receive()
+            if message is None:
+                logger.warning("Hot restart: the old server hung up before it finished handing over")
+                break
+            if message['type'] == 'listener' and fd is not None:
+                listener = socket.socket(fileno=fd)
+            elif message['type'] == 'client' and fd is not None:
+                clients.append((socket.socket(fileno=fd), message['session'], base64.b64decode(message['carry'])))
+            elif message['type'] == 'done':
+                break
+            elif fd is not None:
+                os.close(fd)
+    except (OSError, ProtocolError, ValueError) as e:
+        logger.error("Hot restart: handover interrupted: %s", e)
+    finally:
+        channel.close()
+    logger.info("Hot restart: took over the listening socket and %d live connection(s)", len(clients))
+    return listener, clients
+
+
+class HandoffListener:
+    """Waits at `path` for the process replacing this one, then lets `hand_off(channel)` give it everything."""
+
+    def __init__(self, path, hand_off):
+        self.path = path
+        self.hand_off = hand_off
+        self.sock = None
+        self.thread = threading.Thread(target=self._run, name='chat-handoff', daemon=True)
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # Left behind by a server that did not shut down cleanly
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(1)
+        self.thread.start()
+        logger.info("Hot restart: start another server with --hot-restart %s to replace this one", self.path)
+
+    def _run(self):
+        try:
+            conn, _ = self.sock.accept()
+        except OSError:
+            return  # Closed by shutdown
+        # The replacement binds the path for its own successor once it has taken over
+        self.close()
+        channel = Channel(conn)
+        try:
+            conn.settimeout(30.0)
+            message, fd = channel.receive()
+            if fd is not None:
+                os.close(fd)
+            if not message or message.get('type') != 'takeover':
+                logger.warning("Hot restart: unexpected handshake on %s", self.path)
+                return
+            logger.info("Hot restart: process %s is taking over", message.get('pid'))
+            self.hand_off(channel)
+        except (OSError, ProtocolError, ValueError) as e:
+            logger.error("Hot restart: handover failed: %s", e)
+        finally:
+            channel.close()
+
+    def close(self):
+        if self.sock is None:
+            return
+        sock, self.sock = self.sock, None
+        try:
+            sock.shutdown(socket.SHUT_RDWR)  # Wakes the accept() in _run
+        except OSError:
+            pass
+        sock.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
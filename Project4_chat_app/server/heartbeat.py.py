@@ -0,0 +1,54 @@
+import time
+from protocol import encode_json
+
+PING = encode_json({'type': 'ping'})
+
+
+class HeartbeatMonitor:
+    """Application-level liveness for connections whose client answers pings.
+
+    Every frame a client sends stamps its last-seen time (a dict store, no
+    timer work). One timer per connection on the shared TimerWheel checks
+    that stamp: a connection quiet for `ping_interval` seconds gets a ping,
+    and one still quiet `dead_after` seconds after it was last heard from
+    is handed to `reap(conn)`. So sleeping laptops and connections dropped
+    by a NAT are closed even though their sockets never report an error.
+    """
+
+    def __init__(self, wheel, reap, ping_interval=30, dead_after=90):
+        self.wheel = wheel
+        self.reap = reap
+        self.ping_interval = ping_interval
+        self.dead_after = dead_after
+        self.last_seen = {}  # {conn: monotonic time of the last frame received}
+
+    def track(self, conn):
+        self.last_seen[conn] = time.monotonic()
+        self.wheel.schedule(('heartbeat', conn), self.ping_interval, self._due)
+
+    def seen(self, conn):
+        if conn in self.last_seen:
+            self.last_seen[conn] = time.monotonic()
+
+    def forget(self, conn):
+        if self.last_seen.pop(conn, None) is not None:
+            self.wheel.cancel(('heartbeat', conn))
+
+    def _due(self, key):
+        conn = key[1]
+        last = self.last_seen.get(conn)
+        if last is None:
+            return
+        quiet = time.monotonic() - last
+        if quiet >= self.dead_after:
+            self.forget(conn)
+            self.reap(conn)
+            return
+        if quiet >= self.ping_interval:
+            try:
+                conn.sendall(PING)
+            except ConnectionError:
+                pass
+            self.wheel.schedule(key, self.dead_after - quiet, self._due)
+        else:
+            self.wheel.schedule(key, self.ping_interval - quiet, self._due)
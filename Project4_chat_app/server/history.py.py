@@ -0,0 +1,103 @@
+import threading
+from collections import deque
+
+
+class RoomHistory:
+    """Bounded in-memory ring buffer of the most recent messages in each room.
+
+    Warmed from SQLite at startup and appended to as messages are sent, so
+    joins and room changes are served from memory instead of the database.
+    The latest-page frame for each room is serialized once per framing
+    (records or text lines) and reused until the next message arrives in
+    that room.
+    """
+
+    def __init__(self, db, size=100):
+        self.db = db
+        self.size = size
+        self.rooms = {}
+        self.snapshots = {}  # {room: {framing: cached serialization}}
+        self.lock = threading.Lock()
+
+    def warm(self, rooms):
+        """Load the latest `size` messages of every room from the database."""
+        for room in rooms:
+            rows, _ = self.db.get_history_page(room, limit=self.size)
+            buffer = deque((dict(row) for row in rows), maxlen=self.size)
+            with self.lock:
+                self.rooms[room] = buffer
+                self.snapshots.pop(room, None)
+
+    def append(self, room, record):
+        with self.lock:
+            buffer = self.rooms.get(room)
+            if buffer is None:
+                buffer = self.rooms[room] = deque(maxlen=self.size)
+            buffer.append(record)
+            self.snapshots.pop(room, None)
+
+    def insert(self, room, record):
+        """Add a record that may arrive twice or out of id order (replayed by the federation relay).
+
+        Returns False, leaving the buffer alone, if it was already there or
+        is older than the whole buffer.
+        """
+        with self.lock:
+            buffer = self.rooms.get(room)
+            if buffer is None:
+                buffer = self.rooms[room] = deque(maxlen=self.size)
+            if buffer and record['id'] <= buffer[-1]['id']:
+                if any(other['id'] == record['id'] for other in buffer):
+                    return False
+                if len(buffer) == self.size and record['id'] < buffer[0]['id']:
+                    return False
+                records = sorted([*buffer, record], key=lambda other: other['id'])
+                self.rooms[room] = deque(records[-self.size:], maxlen=self.size)
+            else:
+                buffer.append(record)
+            self.snapshots.pop(room, None)
+        return True
+
+    def drop(self, room):
+        """Forget a deleted room's buffer; its messages stay in the database."""
+        with self.lock:
+            self.rooms.pop(room, None)
+            self.snapshots.pop(room, None)
+
+    def recent(self, room):
+        """Return (records oldest first, has_more) for the latest page of `room`."""
+        with self.lock:
+            buffer = self.rooms.get(room, ())
+            # A full buffer means older messages may be waiting in the database
+            return list(buffer), len(buffer) >= self.size
+
+    def since(self, room, after_id, limit):
+        """Records of `room` newer than message id `after_id`, oldest first, or None if more than `limit` are.
+
+        Served from the buffer when it reaches back far enough; otherwise the
+        database supplies the gap and the buffer the messages not yet flushed.
+        """
+        with self.lock:
+            buffer = list(self.rooms.get(room, ()))
+        if len(buffer) < self.size or buffer[0]['id'] <= after_id:
+            newer = [record for record in buffer if record['id'] > after_id]
+        else:
+            newer = [dict(row) for row in self.db.get_messages_after(room, after_id, limit + 1)]
+            last_id = newer[-1]['id'] if newer else after_id
+            newer += [record for record in buffer if record['id'] > last_id]
+        return newer if len(newer) <= limit else None
+
+    def snapshot(self, room, build, framing=None):
+        """Return the cached `framing` serialization of the latest page, building it with `build(records, has_more)` if stale."""
+        with self.lock:
+            cached = self.snapshots.get(room, {}).get(framing)
+        if cached is not None:
+            return cached
+        records, has_more = self.recent(room)
+        cached = build(records, has_more)
+        with self.lock:
+            # Only cache if no message arrived while we were building
+            buffer = self.rooms.get(room, ())
+            if (buffer[-1] if buffer else None) is (records[-1] if records else None):
+                self.snapshots.setdefault(room, {})[framing] = cached
+        return cached
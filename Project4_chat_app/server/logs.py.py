@@ -0,0 +1,51 @@
+import logging
+import threading
+import time
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
+LEVELS = ('debug', 'info', 'warning', 'error')
+
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket per call site: at most `burst` records at once, refilled at `rate` per second.
+
+    Records are keyed on logger, level and the unformatted message, so a
+    flood of one error (say, every client of a dead room failing at once)
+    is throttled without hiding unrelated lines. The first record let
+    through after a quiet spell reports how many were dropped.
+    """
+
+    def __init__(self, rate=5.0, burst=20, max_keys=4096):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = {}  # {key: [tokens, last refill, suppressed]}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, record.levelno, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                if len(self.buckets) >= self.max_keys:
+                    self.buckets.clear()
+                bucket = self.buckets[key] = [self.burst, now, 0]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            suppressed, bucket[2] = bucket[2], 0
+        if suppressed:
+            record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+        return True
+
+
+def configure_logging(level='info', rate=5.0, burst=20):
+    """Set the root log level and rate-limit every handler."""
+    logging.basicConfig(level=level.upper(), format=LOG_FORMAT, force=True)
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(RateLimitFilter(rate, burst))
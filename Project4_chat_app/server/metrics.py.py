@@ -0,0 +1,228 @@
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from tens of microseconds (encryption) to seconds (slow SQLite)
+DEFAULT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    """A named metric with optional labels; children per label value tuple are created on first use."""
+
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.new_child())
+        return child
+
+    def new_child(self):
+        raise NotImplementedError
+
+    def samples(self):
+        """Yield (suffix, label string, value) for the exposition format."""
+        with self.lock:
+            children = list(self.children.items())
+        for values, child in children:
+            yield from child.samples(self.labelnames, values)
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, names, values):
+        yield '', _format_labels(names, values), self.value
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def new_child(self):
+        return _Value()
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self, names, values):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            yield '_bucket', _format_labels(names, values, [('le', repr(bound))]), cumulative
+        cumulative += counts[-1]
+        yield '_bucket', _format_labels(names, values, [('le', '+Inf')]), cumulative
+        yield '_sum', _format_labels(names, values), total
+        yield '_count', _format_labels(names, values), cumulative
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def new_child(self):
+        return _Histogram(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+
+class CallbackMetric(Metric):
+    """Gauge or counter whose values are read from `func()` at scrape time.
+
+    `func` returns a number, or a dict of {label value tuple: number} for
+    labelled metrics. Used for state that already lives elsewhere (queue
+    depths, connection counts), so the hot path does no extra bookkeeping.
+    """
+
+    def __init__(self, name, help_text, func, labelnames=(), kind='gauge'):
+        super().__init__(name, help_text, labelnames)
+        self.func = func
+        self.kind = kind
+
+    def samples(self):
+        result = self.func()
+        if not isinstance(result, dict):
+            result = {(): result}
+        for values, value in result.items():
+            yield '', _format_labels(self.labelnames, values), value
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            # Re-registering a name (e.g. a second server in one process) replaces the old callback
+            self.metrics[metric.name] = metric
+        return metric
+
+    def expose(self):
+        """Render every metric in the Prometheus text exposition format."""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                samples = list(metric.samples())
+            except Exception as e:
+                logger.warning("Metric %s failed: %s", metric.name, e)
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, labels, value in samples:
+                lines.append(f"{metric.name}{suffix}{labels} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help_text, labelnames=()):
+    return REGISTRY.register(Counter(name, help_text, labelnames))
+
+
+def gauge(name, help_text, labelnames=()):
+    return REGISTRY.register(Gauge(name, help_text, labelnames))
+
+
+def histogram(name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, help_text, labelnames, buckets))
+
+
+def callback(name, help_text, func, labelnames=(), kind='gauge'):
+    return REGISTRY.register(CallbackMetric(name, help_text, func, labelnames, kind))
+
+
+class MetricsServer:
+    """Serves REGISTRY at http://host:port/metrics from a daemon thread."""
+
+    def __init__(self, host='127.0.0.1', port=9108, registry=REGISTRY):
+        registry_ = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/metrics', '/'):
+                    self.send_error(404)
+                    return
+                body = registry_.expose().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug("metrics %s - %s", self.address_string(), format % args)
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='chat-metrics', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        logger.info("Metrics on http://%s:%s/metrics", *self.httpd.server_address[:2])
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,178 @@
+import os
+import socket
+import threading
+import time
+from collections import deque
+
+# What to do when a client's outbound queue is full
+DROP_OLDEST = 'drop_oldest'   # discard the oldest queued frame to make room
+DISCONNECT = 'disconnect'     # treat the client as dead and drop the connection
+BLOCK = 'block'               # wait up to block_ms for room, then disconnect
+POLICIES = (DROP_OLDEST, DISCONNECT, BLOCK)
+
+
+class SlowConsumerError(ConnectionError):
+    """Raised when a client cannot keep up with its outbound traffic."""
+
+
+class OutboundQueue:
+    """Bounded, thread-safe queue of encoded frames waiting to go to one client."""
+
+    def __init__(self, maxsize=256, policy=DROP_OLDEST, block_ms=200):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.block_ms = block_ms
+        self.frames = deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+        self.overflow_since = None
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, frame, can_block=True):
+        """Queue a frame, applying the slow consumer policy if the queue is full.
+
+        Callers that must never block (the asyncio loop) pass can_block=False;
+        for them the block policy becomes a grace period of block_ms during
+        which the queue may overflow before the client is disconnected.
+        """
+        with self.cond:
+            if self.closed:
+                raise ConnectionError("Connection closed")
+            if len(self.frames) >= self.maxsize:
+                self._make_room(can_block)
+            else:
+                self.overflow_since = None
+            self.frames.append(frame)
+            self.cond.notify_all()
+
+    def _make_room(self, can_block):
+        if self.policy == DROP_OLDEST:
+            self.frames.popleft()
+            self.dropped += 1
+            return
+        if self.policy == BLOCK:
+            if can_block:
+                deadline = time.monotonic() + self.block_ms / 1000
+                while len(self.frames) >= self.maxsize and not self.closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                if self.closed:
+                    raise ConnectionError("Connection closed")
+                if len(self.frames) < self.maxsize:
+                    return
+            else:
+                now = time.monotonic()
+                if self.overflow_since is None:
+                    self.overflow_since = now
+                if now - self.overflow_since < self.block_ms / 1000:
+                    return
+        self._close(discard=True)
+        raise SlowConsumerError(f"Outbound queue full ({self.maxsize} frames)")
+
+    def get_batch(self):
+        """Block until frames are queued and return all of them; [] once closed and empty."""
+        with self.cond:
+            while not self.frames and not self.closed:
+                self.cond.wait()
+            return self._take()
+
+    def get_nowait(self):
+        with self.cond:
+            return self._take()
+
+    def _take(self):
+        frames = list(self.frames)
+        self.frames.clear()
+        self.cond.notify_all()
+        return frames
+
+    def close(self, discard=False):
+        with self.cond:
+            self._close(discard)
+
+    def _close(self, discard):
+        self.closed = True
+        if discard:
+            self.frames.clear()
+        self.cond.notify_all()
+
+
+class QueuedConnection:
+    """Socket wrapper whose sends only enqueue; a dedicated thread does the blocking writes.
+
+    A client with a full TCP window therefore only ever stalls its own writer
+    thread, never broadcast or the server lock.
+    """
+
+    def __init__(self, sock, queue):
+        self.sock = sock
+        self.queue = queue
+        self.detached = False
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def sendall(self, data):
+        try:
+            self.queue.put(data)
+        except SlowConsumerError:
+            self.abort()
+            raise
+        return None
+
+    send = sendall
+
+    def _write_loop(self):
+        try:
+            while True:
+                frames = self.queue.get_batch()
+                if not frames:
+                    break
+                self.sock.sendall(b''.join(frames))
+        except OSError:
+            self.queue.close(discard=True)
+        finally:
+            if not self.detached:
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            self.sock.close()
+
+    def close(self):
+        """Stop accepting frames; whatever is already queued is flushed before the socket closes."""
+        self.queue.close()
+
+    def detach(self, timeout=5.0):
+        """Flush what is queued, then let go of the socket without ending the connection (for a hot restart).
+
+        Returns a duplicate of the socket's descriptor for the new owner, or
+        None if the socket is already closed or the flush did not finish in
+        time (the connection is then aborted).
+        """
+        try:
+            fd = os.dup(self.sock.fileno())
+        except OSError:
+            return None
+        self.detached = True
+        self.queue.close()
+        self.writer.join(timeout)
+        if self.writer.is_alive():
+            os.close(fd)
+            self.abort()
+            return None
+        return fd
+
+    def abort(self):
+        """Drop queued frames and tear the socket down immediately."""
+        self.queue.close(discard=True)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
@@ -0,0 +1,120 @@
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from records import TEXT, now_ms
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriter:
+    """Write-behind persistence stage for chat messages.
+
+    Handler threads only append to an in-memory queue; one background thread
+    writes the queue to SQLite with executemany in a single transaction every
+    `batch_size` messages or `flush_interval_ms` milliseconds, whichever comes
+    first, so one fsync covers a whole batch instead of every line. Message
+    ids are handed out here rather than by SQLite, so a message has its final
+    id before it is written.
+    """
+
+    def __init__(self, db, batch_size=200, flush_interval_ms=50, first_id=None, id_step=1):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.pending = deque()
+        self.cond = threading.Condition()
+        self.running = True
+        # Sharded workers share the table, so each takes every id_step-th id from a common start
+        self.ids = itertools.count(db.max_message_id() + 1 if first_id is None else first_id, id_step)
+
+        # Counters
+        self.enqueued = 0
+        self.written = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.total_flush_time = 0.0
+        self.max_flush_time = 0.0
+        self.last_flush_time = 0.0
+
+        self.thread = threading.Thread(target=self._run, name='chat-db-writer', daemon=True)
+        self.thread.start()
+
+    def enqueue(self, room, username, message, kind=TEXT):
+        """Queue a message for the next batch and return its record. Never touches the database."""
+        with self.cond:
+            record = {'id': next(self.ids), 'room': room, 'username': username, 'message': message,
+                      'sent_at': now_ms(), 'kind': kind}
+            self.append(record)
+        return record
+
+    def append(self, record):
+        """Queue a record that already has its id, such as one numbered by the federation relay."""
+        with self.cond:
+            if not self.running:
+                raise RuntimeError("Message writer is closed")
+            self.pending.append((record['id'], record['room'], record['username'], record['message'],
+                                 record['sent_at'], record['kind']))
+            self.enqueued += 1
+            if len(self.pending) >= self.batch_size:
+                self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                if self.running and len(self.pending) < self.batch_size:
+                    self.cond.wait(self.flush_interval)
+                if not self.running and not self.pending:
+                    break
+            if not self.flush() and self.pending:
+                # The batch failed and was put back; back off before retrying
+                if not self.running:
+                    break
+                time.sleep(self.flush_interval)
+
+    def flush(self):
+        """Write everything queued so far in one transaction. Returns the number of rows written."""
+        with self.cond:
+            if not self.pending:
+                return 0
+            batch = list(self.pending)
+            self.pending.clear()
+
+        started = time.perf_counter()
+        if not self.db.store_messages(batch):
+            with self.cond:
+                self.pending.extendleft(reversed(batch))
+                self.failed_flushes += 1
+            return 0
+        elapsed = time.perf_counter() - started
+
+        with self.cond:
+            self.written += len(batch)
+            self.flushes += 1
+            self.total_flush_time += elapsed
+            self.last_flush_time = elapsed
+            self.max_flush_time = max(self.max_flush_time, elapsed)
+        return len(batch)
+
+    def close(self, timeout=10.0):
+        """Stop accepting messages and wait until the queue is durably flushed."""
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.thread.join(timeout)
+        if self.pending:
+            logger.error("🚨 %d queued messages could not be saved", len(self.pending))
+
+    def stats(self):
+        with self.cond:
+            return {
+                'queue_depth': len(self.pending),
+                'enqueued': self.enqueued,
+                'written': self.written,
+                'flushes': self.flushes,
+                'failed_flushes': self.failed_flushes,
+                'last_flush_ms': round(self.last_flush_time * 1000, 3),
+                'max_flush_ms': round(self.max_flush_time * 1000, 3),
+                'avg_flush_ms': round(self.total_flush_time * 1000 / self.flushes, 3) if self.flushes else 0.0,
+            }
@@ -0,0 +1,154 @@
+import threading
+import time
+from protocol import encode_json
+
+ACTIVE = 'active'
+IDLE = 'idle'
+
+
+class Presence:
+    """Who is in each room and whether they are active, pushed to members as batched diffs.
+
+    Joins, leaves and idle/active changes only mark a (room, user) dirty.
+    Every `window` seconds the flusher compares each dirty user's state with
+    what the room was last told and sends one 'presence' frame per room
+    listing who joined, left, went idle or came back, so a burst of joins
+    costs each member one frame per window instead of a full roster per
+    join. Someone entering a room gets the whole roster once ('roster');
+    every diff is idempotent, so a diff that overlaps that snapshot is
+    harmless. A user counts as idle when none of their connections in the
+    room has sent anything for `idle_after` seconds, which a lazy timer per
+    connection on the shared TimerWheel checks.
+
+    `deliver(room, frame, diff)` sends a flushed diff to the room's members.
+    """
+
+    def __init__(self, deliver, wheel, window=0.25, idle_after=300):
+        self.deliver = deliver
+        self.wheel = wheel
+        self.window = window
+        self.idle_after = idle_after
+        self.rooms = {}  # {room: {username: {conn: idle}}}
+        self.published = {}  # {room: {username: state}} as members were last told
+        self.dirty = {}  # {room: set of usernames}
+        self.sessions = {}  # {conn: (room, username)}
+        self.last_active = {}  # {conn: monotonic time of the last message}
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='chat-presence', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+
+    def _state(self, room, username):
+        conns = self.rooms.get(room, {}).get(username)
+        if not conns:
+            return None
+        return IDLE if all(conns.values()) else ACTIVE
+
+    def join(self, room, username, conn):
+        """Put a connection in `room`, taking it out of the room it was in before."""
+        with self.lock:
+            self._leave(conn)
+            self.sessions[conn] = (room, username)
+            self.rooms.setdefault(room, {}).setdefault(username, {})[conn] = False
+            self.last_active[conn] = time.monotonic()
+            self.dirty.setdefault(room, set()).add(username)
+        self.wheel.schedule(('idle', conn), self.idle_after, self._idle_due)
+
+    def leave(self, conn):
+        with self.lock:
+            self._leave(conn)
+        self.wheel.cancel(('idle', conn))
+
+    def _leave(self, conn):
+        session = self.sessions.pop(conn, None)
+        self.last_active.pop(conn, None)
+        if session is None:
+            return
+        room, username = session
+        users = self.rooms.get(room, {})
+        conns = users.get(username, {})
+        conns.pop(conn, None)
+        if not conns:
+            users.pop(username, None)
+        self.dirty.setdefault(room, set()).add(username)
+
+    def touch(self, conn):
+        """Note activity on a connection; called for every chat message, so it is lock-free unless the user was idle."""
+        self.last_active[conn] = time.monotonic()
+        session = self.sessions.get(conn)
+        if session is None:
+            return
+        room, username = session
+        conns = self.rooms.get(room, {}).get(username)
+        if conns and conns.get(conn):
+            with self.lock:
+                if conn in conns:
+                    conns[conn] = False
+                    self.dirty.setdefault(room, set()).add(username)
+            # The idle timer stopped when the connection went idle
+            self.wheel.schedule(('idle', conn), self.idle_after, self._idle_due)
+
+    def _idle_due(self, key):
+        conn = key[1]
+        with self.lock:
+            last = self.last_active.get(conn)
+            if last is None:
+                return
+            quiet = time.monotonic() - last
+            if quiet >= self.idle_after:
+                room, username = self.sessions[conn]
+                self.rooms[room][username][conn] = True
+                self.dirty.setdefault(room, set()).add(username)
+                return
+        self.wheel.schedule(key, self.idle_after - quiet, self._idle_due)
+
+    def roster(self, room):
+        """[(username, state)] the room was last told about, for a full 'roster' frame."""
+        with self.lock:
+            return sorted(self.published.get(room, {}).items())
+
+    def diffs(self):
+        """Collect and clear the pending changes. Returns {room: diff} with only non-empty lists."""
+        with self.lock:
+            dirty, self.dirty = self.dirty, {}
+            result = {}
+            for room, usernames in dirty.items():
+                published = self.published.setdefault(room, {})
+                diff = {'joined': [], 'left': [], 'idle': [], 'active': []}
+                for username in sorted(usernames):
+                    before, after = published.get(username), self._state(room, username)
+                    if before == after:
+                        continue
+                    if after is None:
+                        del published[username]
+                        diff['left'].append(username)
+                        continue
+                    published[username] = after
+                    if before is None:
+                        # Joiners are active unless also listed as idle
+                        diff['joined'].append(username)
+                        if after == IDLE:
+                            diff['idle'].append(username)
+                    else:
+                        diff[after].append(username)
+                if not published:
+                    del self.published[room]
+                if not self.rooms.get(room, True):
+                    del self.rooms[room]
+                diff = {key: names for key, names in diff.items() if names}
+                if diff:
+                    result[room] = diff
+        return result
+
+    def flush(self):
+        for room, diff in self.diffs().items():
+            self.deliver(room, encode_json({'type': 'presence', 'room': room, **diff}), diff)
+
+    def _run(self):
+        while not self.stopping.wait(self.window):
+            self.flush()
@@ -0,0 +1,116 @@
+import threading
+import time
+
+# (tokens per second, burst) per connection; a rate of 0 means unlimited
+DEFAULT_LIMITS = {
+    'messages': (5, 10),                     # chat frames, commands included
+    'bytes': (256 * 1024, 2 * 1024 * 1024),  # chat ciphertext bytes; the burst also caps one message
+    'commands': (1, 5),                      # /join, /create, /users, /history, /passwd, ...
+    # Attachment bytes, uploaded and fetched; the burst lets one whole attachment through
+    'transfer': (1024 * 1024, 25 * 1024 * 1024),
+}
+KINDS = tuple(DEFAULT_LIMITS)
+
+
+class FloodError(ConnectionError):
+    """Raised when a client keeps sending after being throttled."""
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic() if now is None else now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, amount):
+        """Seconds until `amount` tokens are available (after refill); inf if it exceeds the burst."""
+        if amount > self.burst:
+            return float('inf')
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+    def take(self, amount=1, now=None):
+        self.refill(time.monotonic() if now is None else now)
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+
+def parse_limit(spec):
+    """'[room:]kind=rate/burst' -> (room or None, kind, (rate, burst))"""
+    target, _, value = spec.partition('=')
+    room, _, kind = target.rpartition(':')
+    if kind not in KINDS:
+        raise ValueError(f"unknown rate limit kind {kind!r} (expected one of {', '.join(KINDS)})")
+    rate, _, burst = value.partition('/')
+    rate = float(rate)
+    return room or None, kind, (rate, float(burst) if burst else max(rate, 1))
+
+
+class RateLimiter:
+    """Token buckets per connection and per user, with per-room overrides.
+
+    Every charge must fit both the connection's bucket and the user's,
+    which is `user_factor` times larger so a user with a couple of open
+    clients is not throttled for that alone, while many connections under
+    one name still share one budget. One bucket per kind covers every room,
+    so moving between rooms (or creating new ones) never buys a fresh
+    budget; only a room with an override of a kind, made stricter or looser
+    than the default, keeps a bucket of its own for that kind.
+    """
+
+    def __init__(self, limits=None, room_limits=None, user_factor=2):
+        self.limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        self.room_limits = room_limits or {}
+        self.user_factor = user_factor
+        self.buckets = {}  # {scope: {(room or None, kind): TokenBucket}}; scope is ('conn', id) or ('user', name)
+        self.lock = threading.Lock()
+
+    def limit_for(self, room, kind):
+        return self.room_limits.get(room, {}).get(kind, self.limits[kind])
+
+    def _bucket(self, scope, room, kind, factor, now):
+        # Rooms without an override of this kind all share the default bucket
+        key = (room if kind in self.room_limits.get(room, {}) else None, kind)
+        buckets = self.buckets.setdefault(scope, {})
+        bucket = buckets.get(key)
+        if bucket is None:
+            rate, burst = self.limit_for(*key)
+            bucket = buckets[key] = TokenBucket(rate * factor, burst * factor, now)
+        bucket.refill(now)
+        return bucket
+
+    def charge(self, conn, username, room, amounts):
+        """Charge {kind: amount} all-or-nothing. Returns None if allowed, else (kind, seconds to wait)."""
+        now = time.monotonic()
+        with self.lock:
+            charged = []
+            for kind, amount in amounts.items():
+                if not self.limit_for(room, kind)[0]:
+                    continue
+                for scope, factor in ((('conn', id(conn)), 1), (('user', username), self.user_factor)):
+                    bucket = self._bucket(scope, room, kind, factor, now)
+                    if bucket.tokens < amount:
+                        return kind, bucket.wait_for(amount)
+                    charged.append((bucket, amount))
+            for bucket, amount in charged:
+                bucket.tokens -= amount
+        return None
+
+    def forget(self, conn, username):
+        """Drop a closed connection's buckets, and its user's if they have refilled completely."""
+        now = time.monotonic()
+        with self.lock:
+            self.buckets.pop(('conn', id(conn)), None)
+            user_buckets = self.buckets.get(('user', username), {})
+            for bucket in user_buckets.values():
+                bucket.refill(now)
+            if all(bucket.tokens >= bucket.burst for bucket in user_buckets.values()):
+                self.buckets.pop(('user', username), None)
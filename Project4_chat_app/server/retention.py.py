@@ -0,0 +1,289 @@
+"""Message retention: archive old messages, keep the hot table small, give the space back.
+
+Rooms keep messages for a configurable number of days (per room, with a
+default). A background job periodically moves older rows, in small
+batches, into one SQLite file per month under the archive directory and
+deletes them from `messages`. When chat traffic is low it then checkpoints
+the WAL and returns freed pages to the filesystem with incremental
+VACUUM, and reports how much space was reclaimed.
+
+Run it once from the command line (e.g. from cron while the server is down)
+with:
+
+    python retention.py --retain 90 --retain support=365
+"""
+import argparse
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from metrics import counter
+
+logger = logging.getLogger(__name__)
+
+TIMESTAMP = "%Y-%m-%d %H:%M:%S"
+AUTO_VACUUM_INCREMENTAL = 2
+ARCHIVE_COLUMNS = "id, room, username, message, timestamp, kind, sent_at"
+
+ARCHIVED = counter('chat_retention_archived_total', "Messages moved to the monthly archives, by room", ['room'])
+RECLAIMED = counter('chat_retention_reclaimed_bytes_total', "Bytes the database and WAL files shrank by after retention runs")
+
+
+def parse_retention(spec):
+    """'[room=]days' -> (room or None, days); 0 days keeps messages forever."""
+    room, _, days = spec.rpartition('=')
+    days = int(days)
+    if days < 0:
+        raise ValueError("days must be 0 (keep forever) or more")
+    return room or None, days
+
+
+def file_sizes(db_name):
+    """{'db': bytes, 'wal': bytes, 'shm': bytes} for a database and its WAL companions."""
+    sizes = {}
+    for kind, suffix in (('db', ''), ('wal', '-wal'), ('shm', '-shm')):
+        try:
+            sizes[kind] = os.path.getsize(db_name + suffix)
+        except OSError:
+            sizes[kind] = 0
+    return sizes
+
+
+def format_bytes(size):
+    for unit in ('B', 'KiB', 'MiB'):
+        if abs(size) < 1024:
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+
+class Archive:
+    """Monthly archive databases: <directory>/chat_archive_YYYY-MM.db, each with a messages table like the hot one."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.connections = {}  # {month: sqlite3.Connection}, open for the duration of one run
+
+    def path(self, month):
+        return os.path.join(self.directory, f"chat_archive_{month}.db")
+
+    def connection(self, month):
+        conn = self.connections.get(month)
+        if conn is None:
+            os.makedirs(self.directory, exist_ok=True)
+            conn = self.connections[month] = sqlite3.connect(self.path(month))
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY,
+                    room TEXT NOT NULL,
+                    username TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    timestamp DATETIME,
+                    kind INTEGER NOT NULL DEFAULT 0,
+                    sent_at INTEGER
+                )
+            ''')
+            if 'sent_at' not in {row[1] for row in conn.execute("PRAGMA table_info(messages)")}:
+                # Archives written before messages became structured records
+                conn.execute("ALTER TABLE messages ADD COLUMN kind INTEGER NOT NULL DEFAULT 0")
+                conn.execute("ALTER TABLE messages ADD COLUMN sent_at INTEGER")
+        return conn
+
+    def write(self, rows):
+        """Append rows to their month's archive and commit. Returns the set of files written.
+
+        A retry after a crash between archiving and deleting finds its rows
+        already archived and skips them, so each is archived exactly once.
+        A different message under an id the archive already holds raises
+        sqlite3.IntegrityError instead of being dropped, and none of that
+        month's rows are written, so they stay in the hot table.
+        """
+        by_month = {}
+        for row in rows:
+            by_month.setdefault(row['timestamp'][:7], []).append(tuple(row))
+        for month, month_rows in by_month.items():
+            conn = self.connection(month)
+            try:
+                with conn:
+                    conn.executemany(f"INSERT INTO messages ({ARCHIVE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                     month_rows)
+            except sqlite3.IntegrityError:
+                self.write_missing(month, conn, month_rows)
+        return {self.path(month) for month in by_month}
+
+    def write_missing(self, month, conn, rows):
+        """Archive the rows a previous run has not, checking that the ones it has are the same messages."""
+        with conn:
+            for row in rows:
+                archived = conn.execute(f"SELECT {ARCHIVE_COLUMNS} FROM messages WHERE id = ?", (row[0],)).fetchone()
+                if archived is None:
+                    conn.execute(f"INSERT INTO messages ({ARCHIVE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)", row)
+                elif archived != row:
+                    raise sqlite3.IntegrityError(f"{self.path(month)} already holds a different message #{row[0]}")
+
+    def close(self):
+        for conn in self.connections.values():
+            conn.close()
+        self.connections.clear()
+
+
+class RetentionJob:
+    """Background thread applying retention policies every `interval` seconds.
+
+    `retention` maps room names to days to keep, with None as the default
+    for unlisted rooms; rooms mapped to 0 (or missing, without a default)
+    are never archived. Each batch of `batch_size` rows is archived,
+    then deleted in its own short transaction, with `batch_pause` seconds
+    between batches so message writes never wait long. Compaction (WAL
+    checkpoint and incremental VACUUM) only runs while `activity()`, a
+    running count of messages, grows by no more than `quiet_rate` per
+    second, and stops as soon as traffic picks up again.
+    """
+
+    def __init__(self, db, retention, archive_dir='archive', interval=600, batch_size=500, batch_pause=0.05,
+                 quiet_rate=1.0, vacuum_pages=256, activity=None):
+        self.db = db
+        self.retention = dict(retention)
+        self.archive = Archive(archive_dir)
+        self.interval = interval
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.quiet_rate = quiet_rate
+        self.vacuum_pages = vacuum_pages
+        self.activity = activity
+        self.last_activity = (time.monotonic(), activity() if activity else 0)
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='chat-retention', daemon=True)
+        self.runs = 0
+        self.last_report = None
+
+    def days_for(self, room):
+        return self.retention.get(room, self.retention.get(None)) or 0
+
+    def start(self):
+        self.thread.start()
+        logger.info("Retention every %ss: %s", self.interval,
+                    ', '.join(f"{room or 'default'}={days}d" for room, days in self.retention.items()))
+
+    def stop(self, timeout=10.0):
+        self.stopping.set()
+        if self.thread.is_alive():
+            self.thread.join(timeout)
+
+    def _run(self):
+        try:
+            # First pass soon after startup, then every interval
+            wait = min(self.interval, 60)
+            while not self.stopping.wait(wait):
+                try:
+                    self.run_once()
+                except sqlite3.Error as e:
+                    logger.error("🚨 Retention run failed: %s", e)
+                wait = self.interval
+        finally:
+            self.archive.close()
+
+    def quiet(self):
+        """True if fewer than quiet_rate messages per second arrived since the last check."""
+        if self.activity is None:
+            return True
+        now, count = time.monotonic(), self.activity()
+        then, before = self.last_activity
+        self.last_activity = (now, count)
+        return (count - before) / max(now - then, 0.001) <= self.quiet_rate
+
+    def run_once(self):
+        """Archive expired messages of every room, compact if quiet, and report. Returns the report dict."""
+        before = file_sizes(self.db.db_name)
+        archived, files = Counter(), set()
+        now = datetime.now(timezone.utc)
+        for room in self.db.message_rooms():
+            days = self.days_for(room)
+            if not days:
+                continue
+            cutoff = (now - timedelta(days=days)).strftime(TIMESTAMP)
+            while not self.stopping.is_set():
+                rows = self.db.messages_before(room, cutoff, self.batch_size)
+                if not rows:
+                    break
+                files |= self.archive.write(rows)
+                self.db.delete_messages([row['id'] for row in rows])
+                archived[room] += len(rows)
+                ARCHIVED.labels(room).inc(len(rows))
+                self.stopping.wait(self.batch_pause)
+        self.archive.close()
+
+        compacted = self.compact()
+        after = file_sizes(self.db.db_name)
+        reclaimed = max(0, (before['db'] + before['wal']) - (after['db'] + after['wal']))
+        RECLAIMED.inc(reclaimed)
+        self.runs += 1
+        self.last_report = {
+            'archived': dict(archived),
+            'archive_files': sorted(files),
+            'compacted': compacted,
+            'before': before,
+            'after': after,
+            'reclaimed_bytes': reclaimed,
+        }
+        if archived or reclaimed:
+            logger.info("🧹 Retention: archived %d messages (%s) into %d file(s); db %s -> %s, WAL %s -> %s, "
+                        "reclaimed %s%s",
+                        sum(archived.values()), ', '.join(f"{room}: {n}" for room, n in archived.items()) or 'none',
+                        len(files), format_bytes(before['db']), format_bytes(after['db']),
+                        format_bytes(before['wal']), format_bytes(after['wal']), format_bytes(reclaimed),
+                        '' if compacted else " (compaction postponed: chat is busy)")
+        return self.last_report
+
+    def compact(self):
+        """Checkpoint the WAL and release free pages while traffic stays low. Returns False if postponed."""
+        if not self.quiet():
+            return False
+        if self.db.pragma("auto_vacuum")[0] != AUTO_VACUUM_INCREMENTAL:
+            # Older databases were created without auto_vacuum; switching needs one full VACUUM
+            logger.info("🧹 Enabling incremental vacuum (one full VACUUM)...")
+            self.db.pragma("auto_vacuum=INCREMENTAL")
+            self.db.vacuum()
+        self.db.checkpoint('TRUNCATE')
+        free_pages = self.db.pragma("freelist_count")[0]
+        while free_pages and not self.stopping.is_set():
+            free_pages = self.db.incremental_vacuum(self.vacuum_pages)
+            # Each step appends the moved pages to the WAL; fold them back in as we go
+            self.db.checkpoint('PASSIVE')
+            self.stopping.wait(self.batch_pause)
+            if not self.quiet():
+                break
+        busy, _, _ = self.db.checkpoint('TRUNCATE')
+        return not busy
+
+    def stats(self):
+        return {'runs': self.runs, 'last_report': self.last_report}
+
+
+def main():
+    from database import Database
+    from logs import configure_logging
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default='chat_app.db')
+    parser.add_argument('--archive-dir', default='archive')
+    parser.add_argument('--retain', action='append', default=[], metavar='[ROOM=]DAYS',
+                        help="days to keep messages, by default or for one room (repeatable)")
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+    configure_logging('info')
+    retention = dict(parse_retention(spec) for spec in args.retain)
+    job = RetentionJob(Database(args.db), retention, args.archive_dir, batch_size=args.batch_size, batch_pause=0)
+    report = job.run_once()
+    print(f"archived: {report['archived'] or 'nothing'}")
+    print(f"files: {', '.join(report['archive_files']) or 'none'}")
+    print(f"reclaimed: {format_bytes(report['reclaimed_bytes'])} "
+          f"(db {format_bytes(report['before']['db'])} -> {format_bytes(report['after']['db'])}, "
+          f"WAL {format_bytes(report['before']['wal'])} -> {format_bytes(report['after']['wal'])})")
+
+
+if __name__ == "__main__":
+    main()
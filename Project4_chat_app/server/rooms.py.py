@@ -0,0 +1,144 @@
+import re
+import threading
+
+DEFAULT_ROOMS = ('general', 'random', 'support')
+LOBBY = 'general'
+ROOM_NAME = re.compile(r'^[A-Za-z0-9_-]{1,32}$')
+
+
+class RoomError(Exception):
+    """A room could not be created, found or deleted; the message is shown to the user."""
+
+
+class Room:
+    """One chat room and its members, guarded by the room's own lock.
+
+    Members live in a dict keyed by connection (an insertion-ordered set),
+    so joining and leaving are O(1) however many members the room has, and
+    the lock is only held for that single dict operation or for the copy a
+    broadcast takes. Each member maps to (username, (codec, cipher suite),
+    framing), which is everything delivery needs without touching the
+    server lock; framing is 'records' for members that take message
+    records (FRAME_RECORD), 'sequenced' for text members that take message
+    ids (FRAME_SEQ) to resume a dropped session, or None. `sequencer` is
+    held while a message gets its id and is handed to the members, so every
+    member sees a room's messages in id order.
+    """
+
+    def __init__(self, name, created_by=None):
+        self.name = name
+        self.created_by = created_by
+        self.members = {}  # {connection: (username, encoding, framing)}
+        self.lock = threading.Lock()
+        self.sequencer = threading.Lock()
+        self.closed = False
+
+    def add(self, conn, username, encoding, framing=None):
+        """Add a member. Returns False if the room was deleted in the meantime."""
+        with self.lock:
+            if self.closed:
+                return False
+            self.members[conn] = (username, encoding, framing)
+            return True
+
+    def discard(self, conn):
+        """Remove a member. Returns True if it was in the room."""
+        with self.lock:
+            return self.members.pop(conn, None) is not None
+
+    def snapshot(self):
+        """[(connection, username, encoding, framing)] at this instant."""
+        with self.lock:
+            return [(conn, *member) for conn, member in self.members.items()]
+
+    def usernames(self):
+        with self.lock:
+            return [member[0] for member in self.members.values()]
+
+    def close(self):
+        """Refuse new members and return the connections that were still in the room."""
+        with self.lock:
+            self.closed = True
+            members = list(self.members)
+            self.members.clear()
+        return members
+
+
+class RoomRegistry:
+    """Every room, loaded from and persisted to the rooms table.
+
+    The registry lock only covers the name -> Room map, i.e. creating,
+    deleting and listing rooms; membership changes take just the one
+    room's lock. It is never held across a database write, which can wait
+    behind a write-behind flush, because every broadcast looks rooms up.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.rooms = {}  # {name: Room}
+        self.lock = threading.Lock()
+
+    def load(self):
+        rooms = {row['name']: Room(row['name'], row['created_by']) for row in self.db.list_rooms()}
+        for name in DEFAULT_ROOMS:
+            rooms.setdefault(name, Room(name))
+        with self.lock:
+            self.rooms = rooms
+
+    def get(self, name):
+        with self.lock:
+            return self.rooms.get(name)
+
+    def names(self):
+        with self.lock:
+            return list(self.rooms)
+
+    def items(self):
+        with self.lock:
+            return list(self.rooms.items())
+
+    def __iter__(self):
+        return iter(self.names())
+
+    def __contains__(self, name):
+        with self.lock:
+            return name in self.rooms
+
+    def create(self, name, created_by):
+        """Create and persist a room. Raises RoomError if the name is invalid or taken."""
+        if not ROOM_NAME.match(name or ''):
+            raise RoomError("Room names are 1-32 letters, digits, '-' or '_'")
+        if name in self:
+            raise RoomError(f"Room {name} already exists")
+        # The primary key settles races with concurrent creates, here and on other workers sharing the database
+        if not self.db.create_room(name, created_by):
+            raise RoomError(f"Room {name} already exists")
+        with self.lock:
+            return self.rooms.setdefault(name, Room(name, created_by))
+
+    def delete(self, name, requested_by):
+        """Delete a room on behalf of its creator and return it, still holding its members."""
+        room = self.get(name)
+        if room is None:
+            raise RoomError(f"No such room: {name}")
+        if name in DEFAULT_ROOMS:
+            raise RoomError(f"Room {name} cannot be deleted")
+        if room.created_by != requested_by:
+            raise RoomError(f"Only {room.created_by} can delete {name}")
+        self.db.delete_room(name)
+        with self.lock:
+            # A concurrent delete may have got here first
+            if self.rooms.get(name) is not room:
+                raise RoomError(f"No such room: {name}")
+            del self.rooms[name]
+        return room
+
+    def add_local(self, name, created_by):
+        """Mirror a room another worker created (it already persisted it)."""
+        with self.lock:
+            return self.rooms.setdefault(name, Room(name, created_by))
+
+    def remove_local(self, name):
+        """Mirror a room another worker deleted. Returns the Room, or None if unknown here."""
+        with self.lock:
+            return self.rooms.pop(name, None)
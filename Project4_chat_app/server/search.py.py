@@ -0,0 +1,86 @@
+import re
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+
+PAGE_SIZE = 20
+USAGE = "Usage: /search <terms> [room:<name>|room:all] [since:<date>] [until:<date>] [page:<n>]"
+
+# "quoted phrase" or a bare word; filters are bare words of the form key:value
+TOKEN = re.compile(r'"([^"]*)"|(\S+)')
+FILTERS = ('room', 'since', 'until', 'page')
+RELATIVE = re.compile(r'^(\d+)([mhdw])$')
+UNITS = {'m': 'minutes', 'h': 'hours', 'd': 'days', 'w': 'weeks'}
+TIMESTAMP = "%Y-%m-%d %H:%M:%S"
+
+SearchQuery = namedtuple('SearchQuery', 'match terms room since until page')
+
+
+class SearchError(ValueError):
+    """The /search arguments could not be parsed; the message is shown to the user."""
+
+
+def parse_time(value, end=False):
+    """'2026-10-01', '2026-10-01T12:30' or a relative '7d' / '12h' -> stored timestamp (UTC).
+
+    A bare date used as an upper bound covers that whole day.
+    """
+    relative = RELATIVE.match(value)
+    if relative:
+        moment = datetime.now(timezone.utc) - timedelta(**{UNITS[relative.group(2)]: int(relative.group(1))})
+        return moment.strftime(TIMESTAMP)
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            moment = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        if end and fmt == '%Y-%m-%d':
+            moment += timedelta(days=1)
+        return moment.strftime(TIMESTAMP)
+    raise SearchError(f"Cannot read {value!r} as a date (try 2026-10-01, 2026-10-01T12:30 or 7d)")
+
+
+def quote(text):
+    return '"' + text.replace('"', '""') + '"'
+
+
+def fts_term(term):
+    """Quote one user term for FTS5 so operators and punctuation are matched literally; 'foo*' stays a prefix query."""
+    if term.endswith('*') and len(term) > 1:
+        return quote(term[:-1]) + '*'
+    return quote(term)
+
+
+def parse_query(text, current_room):
+    """Split '/search' arguments into an FTS5 MATCH expression and filters.
+
+    Terms must all match (in the message or the sender's name); a search
+    covers the current room unless room:<name> or room:all says otherwise.
+    """
+    terms, options = [], {}
+    for phrase, word in TOKEN.findall(text):
+        key, sep, value = word.partition(':')
+        if word and sep and key in FILTERS and value:
+            options[key] = value
+        elif phrase or word:
+            terms.append(phrase or word)
+    if not terms:
+        raise SearchError(USAGE)
+
+    room = options.get('room', current_room)
+    room = None if room == 'all' else room
+    try:
+        page = max(1, int(options.get('page', 1)))
+    except ValueError:
+        raise SearchError(USAGE)
+    # The room column is indexed only to narrow by room; the terms never match it
+    match = f"{{message username}} : ({' '.join(fts_term(term) for term in terms)})"
+    if room is not None:
+        match = f"room : {quote(room)} AND {match}"
+    return SearchQuery(
+        match=match,
+        terms=terms,
+        room=room,
+        since=parse_time(options['since']) if 'since' in options else None,
+        until=parse_time(options['until'], end=True) if 'until' in options else None,
+        page=page,
+    )
@@ -1,131 +1,1067 @@
+import argparse
+import base64
+import logging
+import os
+import signal
 import socket
 import threading
 import json
+import time
+from contextlib import nullcontext
 from datetime import datetime
+from attachments import CHUNK_SIZE, MAX_RANGE, AttachmentError, BlobStore, file_reference
+from auth import VERIFIERS, AuthBusyError, Authenticator, SessionTokens
 from database import Database
+from ciphers import SUPPORTED as CIPHER_SUITES, negotiate as negotiate_cipher
+from compression import negotiate as negotiate_compression
 from encryption import EncryptionManager
+from logs import LEVELS, configure_logging
+from metrics import MetricsServer, callback, counter, histogram
+from heartbeat import HeartbeatMonitor
+from history import RoomHistory
+from persistence import MessageWriter
+from presence import Presence
+from ratelimit import DEFAULT_LIMITS, FloodError, RateLimiter, TokenBucket, parse_limit
+from retention import RetentionJob, file_sizes, parse_retention
+from rooms import LOBBY, RoomError, RoomRegistry
+from search import PAGE_SIZE as SEARCH_PAGE_SIZE, SearchError, parse_query
+from shards import run_workers
+from federation import FederationBus
+from handoff import HANDED_OFF, HandoffListener, readable, take_over
+from timers import TimerWheel
+from outbound import DROP_OLDEST, POLICIES, OutboundQueue, QueuedConnection
+from protocol import (FRAME_BLOB, FRAME_CHAT, FRAME_JSON, FrameReader, ProtocolError,
+                      decode_blob, encode_blob, encode_chat, encode_json, encode_record_frame, encode_seq)
+from records import DIRECT as DIRECT_MESSAGE, NOTICE, Record, encode_record, notice, now_ms, pack, render
 from dotenv import load_dotenv
 load_dotenv()  # Add at the top of server.py
+
+logger = logging.getLogger('chat.server')
+
+CONNECTIONS_TOTAL = counter('chat_connections_total', "TCP connections accepted")
+LOGINS = counter('chat_logins_total', "Login and registration attempts by result", ['action', 'result'])
+MESSAGES = counter('chat_messages_total', "Chat messages committed, by room", ['room'])
+DELIVERIES = counter('chat_deliveries_total', "Frames handed to client outbound queues by broadcast")
+BROADCAST_SECONDS = histogram('chat_broadcast_seconds', "Time to encrypt and enqueue one message for a room")
+REAPED = counter('chat_reaped_connections_total', "Connections closed for not answering heartbeats")
+DIRECT = counter('chat_direct_messages_total', "Direct messages by route: a local connection, another worker "
+                 "or the offline mailbox", ['route'])
+THROTTLED = counter('chat_throttled_total', "Frames and commands rejected by rate limits, by the limit hit", ['kind'])
+
+
 class ChatServer:
-    def __init__(self, host='0.0.0.0', port=5555):
+    history_page_size = 100
+    # A throttled client may keep sending this many rejected frames (refilled per second) before it is dropped
+    flood_strike_rate = 10
+    flood_strike_burst = 100
+    throttle_notice_interval = 1.0
+    # Presence diffs are batched over this many seconds
+    presence_window = 0.25
+    # A resumed session missing more messages than this gets the latest page instead
+    resume_max_messages = 1000
+    # Offline direct messages are delivered at login this many per frame
+    mailbox_batch_size = 100
+    # Uploads one connection may have in progress at once, each holding a temp file open
+    max_open_uploads = 4
+    # With hot restart on, idle threaded handlers look for a handover this often (seconds)
+    handoff_poll = 1.0
+    # How long a handover waits for every client to park, and for each one's outbound queue to flush
+    handoff_timeout = 5.0
+
+    def __init__(self, host='0.0.0.0', port=5555, backlog=5,
+                 outbound_queue_size=256, slow_consumer_policy=DROP_OLDEST, slow_consumer_block_ms=200,
+                 db_batch_size=200, db_flush_ms=50, password_scheme='scrypt',
+                 attachment_dir='attachments', max_attachment_mb=25, cipher_suites=CIPHER_SUITES, shard=None,
+                 metrics_host='127.0.0.1', metrics_port=None, rate_limits=None, room_rate_limits=None,
+                 retention=None, archive_dir='archive', retention_interval=600, idle_after=300,
+                 ping_interval=30, dead_after=90, session_ttl=86400, db_readers=4, hot_restart=None):
+        # Take over from the process being replaced before opening the database it is still flushing
+        inherited = take_over(hot_restart) if hot_restart else None
         self.host = host
         self.port = port
+        self.backlog = backlog
+        self.outbound_queue_size = outbound_queue_size
+        self.slow_consumer_policy = slow_consumer_policy
+        self.slow_consumer_block_ms = slow_consumer_block_ms
         self.server = None
-        self.clients = {}  # {client_socket: {username: str, room: str, joined_at: str}}
-        self.rooms = {'general': [], 'random': [], 'support': []}
-        self.lock = threading.Lock()
+        self.clients = {}  # {connection: {username: str, room: str, joined_at: str}}
+        self.user_index = {}  # {username: {connection: None}}, for routing direct messages
+        self.lock = threading.Lock()  # guards self.clients and self.user_index; each room has its own lock for its members
         self.running = False
-        self.db = Database()
+        self.draining = False  # set once a hot restart has begun handing this process's clients over
+        self.parked = {}  # {connection: bytes read but not handled} for clients waiting to be handed over
+        self.parked_changed = threading.Condition(self.lock)
+        self.accept_lock = threading.Lock()  # held across each accept(), so a handover can wait one out
+        self.stopped = threading.Event()
+        self.inherited_clients = inherited[1] if inherited else []  # [(socket, session, carry)] to adopt
+        self.db = Database(readers=db_readers)
+        self.rooms = RoomRegistry(self.db)
+        self.rooms.load()
+        self.bus = shard  # ShardBus for one of several worker processes, FederationBus for a cluster node
+        self.message_writer = MessageWriter(self.db, db_batch_size, db_flush_ms, *(shard.message_ids() if shard else ()))
+        self.history = RoomHistory(self.db, self.history_page_size)
+        self.history.warm(self.rooms)
+        self.auth = Authenticator(self.db, VERIFIERS[password_scheme]())
+        self.blobs = BlobStore(attachment_dir, max_attachment_mb * 1024 * 1024)
         self.encryption = EncryptionManager()
-        self.initialize_server()
-        print(f"Server initialized on {host}:{port}")
+        self.sessions = SessionTokens(self.encryption.key, self.auth.stored_hash, session_ttl)
+        self.cipher_suites = list(cipher_suites)
+        # Unless configured, the transfer burst is one attachment of the largest size allowed
+        transfer = (DEFAULT_LIMITS['transfer'][0], max_attachment_mb * 1024 * 1024)
+        self.limiter = RateLimiter({'transfer': transfer, **(rate_limits or {})}, room_rate_limits)
+        # One timer wheel drives every per-connection timeout: heartbeats and presence idling
+        self.timers = TimerWheel()
+        self.timers.start()
+        self.ping_interval = ping_interval
+        self.heartbeats = HeartbeatMonitor(self.timers, self.reap, ping_interval, dead_after)
+        self.presence = Presence(self.deliver_presence, self.timers, self.presence_window, idle_after)
+        self.presence.start()
+        self.initialize_server(inherited[0] if inherited else None)
+        if self.bus:
+            self.bus.attach(self)
+        self.retention = None
+        # Sharded workers and cluster nodes share one database, so only the first one archives it
+        if retention and any(retention.values()) and (not shard or shard.index == 0):
+            self.retention = RetentionJob(self.db, retention, archive_dir, retention_interval,
+                                          activity=lambda: self.message_writer.stats()['enqueued'])
+            self.retention.start()
+        self.register_metrics()
+        self.metrics_server = None
+        if metrics_port:
+            # Sharded workers each serve their own registry on consecutive ports
+            self.metrics_server = MetricsServer(metrics_host, metrics_port + (shard.index if shard else 0))
+            self.metrics_server.start()
+        self.hot_restart = None
+        if hot_restart:
+            self.hot_restart = HandoffListener(hot_restart, self.hand_off)
+            self.hot_restart.start()
+        logger.info("Server initialized on %s:%s", host, port)
+
+    def register_metrics(self):
+        """Expose state that already lives on the server as scrape-time metrics."""
+        def outbound(measure):
+            with self.lock:
+                return sum(measure(client.queue) for client in self.clients if hasattr(client, 'queue'))
+
+        def room_members():
+            return {(name,): len(room.members) for name, room in self.rooms.items()}
+
+        def compression(field):
+            return {(codec,): values[field] for codec, values in self.encryption.compression.stats().items()}
 
-    def initialize_server(self):
+        callback('chat_clients', "Authenticated clients", lambda: len(self.clients))
+        callback('chat_timers', "Timers pending on the timer wheel", lambda: len(self.timers))
+        callback('chat_room_members', "Clients in each room", room_members, ['room'])
+        callback('chat_outbound_queued_frames', "Frames waiting in client outbound queues", lambda: outbound(len))
+        callback('chat_outbound_dropped_frames', "Frames dropped by the slow consumer policy on open connections",
+                 lambda: outbound(lambda queue: queue.dropped))
+        callback('chat_writer_queue_depth', "Messages waiting for the write-behind flush",
+                 lambda: self.message_writer.stats()['queue_depth'])
+        callback('chat_writer_written_total', "Messages written to SQLite",
+                 lambda: self.message_writer.stats()['written'], kind='counter')
+        callback('chat_writer_failed_flushes_total', "Batches that failed and were retried",
+                 lambda: self.message_writer.stats()['failed_flushes'], kind='counter')
+        callback('chat_auth_cache_hits_total', "Logins answered from the verification cache",
+                 lambda: self.auth.stats()['cache_hits'], kind='counter')
+        callback('chat_db_idle_readers', "Pooled read-only SQLite connections not in use",
+                 lambda: self.db.pool_stats()['idle_readers'])
+        callback('chat_db_file_bytes', "Size of the SQLite database and its WAL files",
+                 lambda: {(kind,): size for kind, size in file_sizes(self.db.db_name).items()}, ['file'])
+        callback('chat_compression_bytes_in_total', "Plaintext bytes fed to each compression codec",
+                 lambda: compression('bytes_in'), ['codec'], kind='counter')
+        callback('chat_compression_bytes_out_total', "Compressed bytes produced by each codec",
+                 lambda: compression('bytes_out'), ['codec'], kind='counter')
+
+    def initialize_server(self, inherited=None):
+        if inherited is not None:
+            # Already bound and listening: the process we replaced passed it over (see hand_off)
+            self.server = inherited
+            self.server.settimeout(2)
+            return
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.bus:
+            # Every worker binds the same port; the kernel spreads new connections across them
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server.bind((self.host, self.port))
         self.server.settimeout(2)
-        self.server.listen(5)
+        self.server.listen(self.backlog)
+
+    def new_outbound_queue(self):
+        return OutboundQueue(self.outbound_queue_size, self.slow_consumer_policy, self.slow_consumer_block_ms)
 
     def broadcast(self, room, message, sender=None):
-        with self.lock:
-            clients_in_room = list(self.rooms.get(room, []))
-            encrypted_msg = self.encryption.encrypt(message)
+        """Send a notice to every member of a room, including those connected to other workers."""
+        self.deliver(room, notice(room, message), sender)
+        if self.bus:
+            self.bus.notice(room, message)
 
-            for client in clients_in_room:
-                if client != sender:
-                    try:
-                        client.send(encrypted_msg)
-                    except:
-                        self.remove_client(client)
+    @staticmethod
+    def frame_token(record, token, framing):
+        """Wrap an encrypted record (or its rendered text) in the frame type `framing` calls for.
 
-    def remove_client(self, client):
-        with self.lock:
-            if client not in self.clients:
-                return
+        Stored messages (those with an id) carry it to 'sequenced' members, so
+        they can resume a session.
+        """
+        if framing == 'records':
+            return encode_record_frame(token)
+        if framing == 'sequenced' and record.id:
+            return encode_seq(record.id, token)
+        return encode_chat(token)
 
-            user_info = self.clients[client]
-            username = user_info['username']
-            room = user_info['room']
+    def frame_record(self, record, encoding, framing):
+        """One record, encrypted and framed for a single client."""
+        payload = encode_record(record) if framing == 'records' else render(record)
+        return self.frame_token(record, self.encryption.encrypt(payload, *encoding), framing)
 
-            if room in self.rooms and client in self.rooms[room]:
-                self.rooms[room].remove(client)
-                self.broadcast(room, f"{username} left the chat")
+    def deliver(self, room, record, sender=None):
+        """Encrypt a record once per negotiated codec, cipher suite and framing and enqueue the frame for every local room member; never waits on a socket.
 
-            del self.clients[client]
+        Members that negotiated records get the binary record; the others get
+        the text render() makes of it, the same bytes for every one of them.
+        """
+        started = time.perf_counter()
+        members = self.rooms.get(room)
+        clients_in_room = members.snapshot() if members is not None else []
+        tokens = {}
+        frames = {}
+
+        dead = []
+        delivered = 0
+        for client, _, encoding, framing in clients_in_room:
+            if client != sender:
+                try:
+                    kind = (encoding, framing)
+                    if kind not in frames:
+                        body = (encoding, framing == 'records')
+                        if body not in tokens:
+                            payload = encode_record(record) if body[1] else render(record)
+                            tokens[body] = self.encryption.encrypt(payload, *encoding)
+                        frames[kind] = self.frame_token(record, tokens[body], framing)
+                    client.sendall(frames[kind])
+                    delivered += 1
+                except:
+                    dead.append(client)
+        DELIVERIES.inc(delivered)
+        BROADCAST_SECONDS.observe(time.perf_counter() - started)
+        for client in dead:
+            self.remove_client(client)
+
+    def deliver_presence(self, room, frame, diff=None):
+        """Send a batched presence diff to the room's local members, and to the other workers' if it was made here."""
+        members = self.rooms.get(room)
+        for client, *_ in (members.snapshot() if members is not None else []):
             try:
-                client.close()
-            except:
+                client.sendall(frame)
+            except ConnectionError:
                 pass
+        if self.bus and diff is not None:
+            self.bus.presence(room, diff)
 
-    def handle_client(self, client, address):
+    def roster_payload(self, room):
+        """The whole roster of a room, sent once to a client entering it; 'presence' diffs keep it current."""
+        users = self.presence.roster(room)
+        if self.bus:
+            known = {username for username, _ in users}
+            users += [(username, 'active') for username in self.bus.remote_users(room) if username not in known]
+        return encode_json({'type': 'roster', 'room': room, 'users': users})
+
+    def remove_client(self, client, announce=True):
+        """Forget a client; unless `announce` is False (it was handed over to another process), tell its room."""
+        with self.lock:
+            user_info = self.clients.pop(client, None)
+            if user_info is not None:
+                connections = self.user_index.get(user_info['username'], {})
+                connections.pop(client, None)
+                if not connections:
+                    self.user_index.pop(user_info['username'], None)
+            self.parked.pop(client, None)
+            self.parked_changed.notify_all()
+        if user_info is None:
+            return
         try:
-            client.settimeout(30.0)
-            auth_data = client.recv(4096).decode('utf-8')
-            auth = json.loads(auth_data)
+            client.close()
+        except:
+            pass
 
+        username = user_info['username']
+        room = user_info['room']
+        members = self.rooms.get(room) if room else None
+        left_room = members is not None and members.discard(client)
+        self.presence.leave(client)
+        self.heartbeats.forget(client)
+
+        self.limiter.forget(client, username)
+
+        for upload in user_info.get('uploads', {}).values():
+            upload.abort()
+
+        if left_room and announce:
+            self.members_changed()
+            self.broadcast(room, f"{username} left the chat")
+
+    def submit_auth(self, auth):
+        """Validate a login/register/resume request and queue the check on the auth pool.
+
+        Returns (action, username, future) where the future resolves to False
+        on failure, and on success to a session token if the client asked for
+        one (see login_session), True otherwise.
+        """
+        action = auth.get('action', '')
+        if action == 'resume':
+            token = auth.get('token', '')
+            if not isinstance(token, str) or not token:
+                raise ValueError("Invalid authentication data")
+            username = self.sessions.username_of(token)
+            task, args = self.sessions.renew, (token,)
+        else:
             username = auth.get('username', '').strip()
             password = auth.get('password', '')
-            action = auth.get('action', '')
-
             if not username or not password or action not in ('register', 'login'):
                 raise ValueError("Invalid authentication data")
+            check = self.auth.register if action == 'register' else self.auth.login
+            task, args = self.login_session, (check, username, password, bool(auth.get('resume')))
+
+        try:
+            future = self.auth.submit(task, *args)
+        except AuthBusyError:
+            LOGINS.labels(action, 'busy').inc()
+            raise
+        future.add_done_callback(lambda f: LOGINS.labels(
+            action, 'error' if f.exception() else 'ok' if f.result() else 'failed').inc())
+        return action, username, future
 
-            if action == 'register':
-                success = self.db.register_user(username, password)
-                message = "Registration successful" if success else "Username already exists"
+    def login_session(self, check, username, password, resumable):
+        """Auth pool task: check the password, then issue a session token if the client can resume sessions."""
+        if not check(username, password):
+            return False
+        return self.sessions.issue(username) if resumable else True
+
+    @staticmethod
+    def auth_message(action, success):
+        if action == 'resume':
+            return "Session resumed" if success else "Session expired, please log in again"
+        if action == 'register':
+            return "Registration successful" if success else "Username already exists"
+        return "Login successful" if success else "Invalid credentials"
+
+    def authenticate(self, auth):
+        """Check a login/register/resume request. Returns (success, message, username)."""
+        try:
+            action, username, future = self.submit_auth(auth)
+        except AuthBusyError as e:
+            return False, str(e), auth.get('username', '')
+        success = future.result()
+        return success, self.auth_message(action, success), username
+
+    def add_client(self, client, username, encoding=None):
+        with self.lock:
+            self.clients[client] = {'username': username, 'room': None, 'joined_at': datetime.now().isoformat(),
+                                    'compression': None, 'cipher': None, 'throttle_notice_at': 0.0,
+                                    'strikes': TokenBucket(self.flood_strike_rate, self.flood_strike_burst)}
+            self.clients[client].update(encoding or {})
+            self.user_index.setdefault(username, {})[client] = None
+        if self.clients[client].get('heartbeat'):
+            self.heartbeats.track(client)
+
+    def reap(self, client):
+        """Drop a connection that stopped answering pings, freeing its room slot and handler straight away."""
+        with self.lock:
+            info = self.clients.get(client)
+        REAPED.inc()
+        logger.info("Reaping unresponsive connection of %s", info['username'] if info else 'unknown user')
+        self.call_soon(self.drop_connection, client)
+
+    def drop_connection(self, client):
+        self.remove_client(client)
+        client.abort()
+
+    def negotiate(self, auth):
+        """Pick the compression codec, cipher suite, heartbeat interval and message framing for a connection from what its auth request offered.
+
+        Only clients that offer heartbeats are pinged (and reaped when they
+        stop answering). Clients that offer records get every message as a
+        record (FRAME_RECORD) and history as packed records, and do their own
+        formatting; text clients that can resume sessions get message ids
+        (FRAME_SEQ) with their chat messages.
+        """
+        resumable = auth.get('resume') or auth.get('action') == 'resume'
+        return {'compression': negotiate_compression(auth.get('compression')),
+                'cipher': negotiate_cipher(auth.get('ciphers'), self.cipher_suites),
+                'heartbeat': self.ping_interval if auth.get('heartbeat') else None,
+                'framing': 'records' if auth.get('records') else 'sequenced' if resumable else None}
+
+    def login_reply(self, message, encoding, session=None):
+        """The success reply to an auth request; `session` is the check's result, a token when one was issued."""
+        reply = {'status': 'success', 'message': message, 'rooms': self.rooms.names(), **encoding}
+        if isinstance(session, str):
+            reply.update(session=session, session_ttl=self.sessions.ttl)
+        return encode_json(reply)
+
+    def encoding_of(self, client):
+        """(compression codec, cipher suite) negotiated by a client. Call with self.lock held."""
+        info = self.clients.get(client, {})
+        return info.get('compression'), info.get('cipher')
+
+    def framing_of(self, client):
+        with self.lock:
+            return self.clients.get(client, {}).get('framing')
+
+    def frame_for(self, client, record):
+        """Encrypt and frame a record for one client, the way it negotiated."""
+        with self.lock:
+            encoding, framing = self.encoding_of(client), self.clients.get(client, {}).get('framing')
+        return self.frame_record(record, encoding, framing)
+
+    def encrypt_for(self, client, message):
+        """Encrypt a notice for one client using the codec, cipher suite and framing it negotiated."""
+        with self.lock:
+            room = self.clients.get(client, {}).get('room')
+        return self.frame_for(client, notice(room or '', message))
+
+    def enter_room(self, client, room_request):
+        """Place a freshly authenticated client in the room it asked for."""
+        room = self.rooms.get(room_request.get('room', LOBBY))
+        if room is None:
+            room = self.rooms.get(LOBBY)
+        _, room_choice, username = self.move_client(client, room)
+
+        self.members_changed()
+        self.broadcast(room_choice, f"{username} joined the chat!", sender=client)
+        return room_choice
+
+    def move_client(self, client, room):
+        """Move a client out of its current room into `room`, or the lobby if `room` was just deleted.
+
+        Only the two rooms' own locks are taken for the membership change, and
+        each for one dict operation. Returns (old room name, new room name,
+        username), or None if the client has disconnected.
+        """
+        with self.lock:
+            info = self.clients.get(client)
+            if info is None:
+                return None
+            old_room, username, encoding = info['room'], info['username'], self.encoding_of(client)
+            framing = info.get('framing')
+            info['room'] = room.name
+        previous = self.rooms.get(old_room) if old_room else None
+        if previous is not None:
+            previous.discard(client)
+        if not room.add(client, username, encoding, framing):
+            room = self.rooms.get(LOBBY)
+            room.add(client, username, encoding, framing)
+            with self.lock:
+                info['room'] = room.name
+        with self.lock:
+            gone = client not in self.clients
+        if gone:
+            # remove_client ran while we were moving it
+            room.discard(client)
+            return None
+        self.presence.join(room.name, username, client)
+        return old_room, room.name, username
+
+    def switch_room(self, client, room):
+        """Move a client to `room`, send it the room's latest history and tell both rooms."""
+        moved = self.move_client(client, room)
+        if moved is None:
+            return
+        old_room, new_room, username = moved
+        # First, so a federation node that just became subscribed to the room sends fresh history
+        self.members_changed()
+        client.sendall(self.room_change_payload(client, new_room))
+        client.sendall(self.roster_payload(new_room))
+
+        if old_room:
+            self.broadcast(old_room, f"{username} left the room", client)
+        self.broadcast(new_room, f"{username} joined the room", client)
+
+    def close_room(self, room):
+        """Send the local members of a deleted room back to the lobby."""
+        self.history.drop(room.name)
+        lobby = self.rooms.get(LOBBY)
+        for client in room.close():
+            if self.move_client(client, lobby) is None:
+                continue
+            try:
+                client.sendall(self.room_change_payload(client, LOBBY))
+                client.sendall(self.roster_payload(LOBBY))
+                client.sendall(self.encrypt_for(client, f"Room {room.name} was deleted"))
+            except ConnectionError:
+                pass
+        self.members_changed()
+
+    def rooms_changed(self, bus_message=None):
+        """Push the room list to every local client, and tell the other workers if the change was made here."""
+        payload = encode_json({'type': 'rooms', 'rooms': self.rooms.names()})
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            try:
+                client.sendall(payload)
+            except ConnectionError:
+                pass
+        if self.bus and bus_message:
+            self.bus.publish(bus_message)
+
+    def history_payload(self, msg_type, room, framing, before_id=None):
+        """Fetch one page of room history. Returns (oldest_id, encoded frame)."""
+        rows, has_more = self.db.get_history_page(room, before_id, self.history_page_size)
+        return self.encode_history(msg_type, room, rows, has_more, framing, before_id)
+
+    @staticmethod
+    def message_list(records, framing):
+        """{'records': [packed]} for clients that negotiated records, {'history': [lines]} for the others."""
+        if framing == 'records':
+            return {'records': [pack(record) for record in records]}
+        return {'history': [render(record) for record in records]}
+
+    def encode_history(self, msg_type, room, rows, has_more, framing, before_id=None, resumed_after=None):
+        oldest_id = rows[0]['id'] if rows else (before_id or 0)
+        payload = {
+            'type': msg_type,
+            'room': room,
+            **self.message_list([self.db.record(row, room) for row in rows], framing),
+            'oldest_id': oldest_id,
+            'latest_id': rows[-1]['id'] if rows else (resumed_after or 0),
+            'has_more': has_more,
+        }
+        if resumed_after is not None:
+            # Only what came after the client's last-seen message, to append to what it shows
+            payload['resumed'] = True
+        return oldest_id, encode_json(payload)
+
+    def search_payload(self, query, framing):
+        """Run a parsed /search and encode one ranked page of results."""
+        rows, has_more = self.db.search_messages(query.match, query.room, query.since, query.until,
+                                                 SEARCH_PAGE_SIZE, (query.page - 1) * SEARCH_PAGE_SIZE)
+        records = [self.db.record(row) for row in rows]
+        return encode_json({
+            'type': 'search_results',
+            'terms': query.terms,
+            'room': query.room,
+            'page': query.page,
+            'has_more': has_more,
+            'results': [{'id': record.id, 'room': record.room,
+                         **({'record': pack(record)} if framing == 'records' else {'line': render(record)})}
+                        for record in records],
+        })
+
+    def room_change_payload(self, client, room):
+        """Latest page of `room` from the in-memory buffer, remembering where /history should continue from."""
+        framing = self.framing_of(client)
+        oldest_id, payload = self.history.snapshot(
+            room, lambda records, has_more: self.encode_history('room_change', room, records, has_more, framing),
+            framing == 'records')
+        with self.lock:
+            if client in self.clients:
+                self.clients[client]['history_cursor'] = oldest_id
+        return payload
+
+    def entry_payload(self, client, room, room_request):
+        """History for a client entering `room` after login.
+
+        A resumed session back in the room it left, with the id of the last
+        message it saw ('since'), gets only the messages after that one and
+        keeps paging /history from where it was ('history_cursor'); everyone
+        else, and a session that missed too much, gets the latest page.
+        """
+        since = room_request.get('since')
+        if room_request.get('room') == room and isinstance(since, int):
+            records = self.history.since(room, since, self.resume_max_messages)
+            if records is not None:
+                cursor = room_request.get('history_cursor')
+                with self.lock:
+                    if client in self.clients and isinstance(cursor, int):
+                        self.clients[client]['history_cursor'] = cursor
+                _, payload = self.encode_history('room_change', room, records, False, self.framing_of(client),
+                                                 resumed_after=since)
+                return payload
+        return self.room_change_payload(client, room)
+
+    def connections_of(self, username):
+        """The connections `username` has open on this process: one lookup in the username index."""
+        with self.lock:
+            return list(self.user_index.get(username, ()))
+
+    def deliver_direct(self, record):
+        """Send a direct message record to every local connection of its recipient. Returns False if they have none here."""
+        delivered = False
+        for client in self.connections_of(record.room):
+            try:
+                client.sendall(self.frame_for(client, record))
+                delivered = True
+            except ConnectionError:
+                pass
+        return delivered
+
+    def send_direct(self, client, recipient, text):
+        """Route a /msg to the recipient alone: straight to their connections here, to the worker or node
+        they are connected to, or into their mailbox for their next login. The sender gets the line back."""
+        with self.lock:
+            sender = self.clients[client]['username']
+        record = Record(0, recipient, sender, now_ms(), DIRECT_MESSAGE, text)
+        if self.deliver_direct(record):
+            route = 'local'
+        elif self.bus and self.bus.forward_direct(record, client):
+            route = 'remote'
+        elif self.db.user_exists(recipient):
+            self.db.store_mail(record)
+            route = 'mailbox'
+        else:
+            client.sendall(self.encrypt_for(client, f"No such user: {recipient}"))
+            return
+        DIRECT.labels(route).inc()
+        client.sendall(self.frame_for(client, record))
+        if route == 'mailbox':
+            client.sendall(self.encrypt_for(client, f"{recipient} is offline and will get it at their next login"))
+
+    def deliver_mailbox(self, client, username):
+        """Send the direct messages `username` got while offline, oldest first, `mailbox_batch_size` per frame.
+
+        Each batch is deleted once it is queued for the client.
+        """
+        framing = self.framing_of(client)
+        while True:
+            rows = self.db.mailbox_batch(username, self.mailbox_batch_size)
+            if not rows:
+                return
+            # Mail left before messages became records was stored already rendered, without sent_at
+            records = [Record(0, username, row['sender'], row['sent_at'] or 0,
+                              NOTICE if row['sent_at'] is None else DIRECT_MESSAGE, row['message']) for row in rows]
+            if framing == 'records':
+                payload = {'records': [pack(record) for record in records]}
             else:
-                success = self.db.authenticate_user(username, password)
-                message = "Login successful" if success else "Invalid credentials"
+                payload = {'messages': [render(record) for record in records]}
+            client.sendall(encode_json({'type': 'mailbox', 'recipient': username, **payload}))
+            self.db.delete_mail(username, rows[-1]['seq'])
+            if len(rows) < self.mailbox_batch_size:
+                return
 
-            if not success:
-                client.send(json.dumps({'status': 'failed', 'message': message}).encode('utf-8'))
-                client.close()
+    def compose_message(self, client, message):
+        """Return (room, username, message) for a chat line sent by `client`; it is stored and sent as it was typed."""
+        with self.lock:
+            info = self.clients[client]
+            return info['room'], info['username'], message
+
+    def handle_control(self, client, control):
+        """Handle a JSON control frame sent after login."""
+        kind = control.get('type')
+        if kind == 'change_room' and control.get('room'):
+            self.handle_command(f"/join {control['room']}", client)
+        elif kind == 'upload_start':
+            self.start_upload(client, control)
+        elif kind == 'upload_end':
+            self.finish_upload(client, control)
+        elif kind == 'fetch':
+            self.send_attachment_range(client, control)
+
+    def admit(self, client, **amounts):
+        """Charge `amounts` ({kind: amount}) to the client's rate limits. Returns False if throttled."""
+        return self.throttle(client, amounts) is None
+
+    def throttle(self, client, amounts):
+        """Charge `amounts` to the client's rate limits. Returns None if allowed, else seconds until they would be.
+
+        A throttled client gets a 'throttled' notice at most once per
+        throttle_notice_interval; one that keeps flooding regardless is
+        disconnected with FloodError.
+        """
+        with self.lock:
+            info = self.clients.get(client)
+            if info is None:
+                return float('inf')
+            username, room = info['username'], info['room']
+        verdict = self.limiter.charge(client, username, room, amounts)
+        if verdict is None:
+            return None
+
+        kind, retry_after = verdict
+        THROTTLED.labels(kind).inc()
+        now = time.monotonic()
+        with self.lock:
+            if not info['strikes'].take(1, now):
+                raise FloodError(f"{username} kept flooding after being throttled")
+            notify = now - info['throttle_notice_at'] >= self.throttle_notice_interval
+            if notify:
+                info['throttle_notice_at'] = now
+        if notify:
+            client.sendall(encode_json({'type': 'throttled', 'kind': kind, 'room': room,
+                                        'retry_after': round(min(retry_after, 3600), 2)}))
+        return retry_after
+
+    def handle_frame(self, client, frame_type, payload):
+        if frame_type == FRAME_CHAT:
+            # Charged on the ciphertext, so throttled frames never cost a decryption
+            if not self.admit(client, messages=1, bytes=len(payload)):
                 return
+            message = self.encryption.decrypt(payload)
+            if message:
+                self.process_message(client, message)
+        elif frame_type == FRAME_JSON:
+            control = json.loads(payload.decode('utf-8'))
+            if self.admit_control(client, control):
+                self.handle_control(client, control)
+        elif frame_type == FRAME_BLOB:
+            if self.admit_blob(client, payload):
+                self.receive_upload_chunk(client, payload)
+        else:
+            raise ProtocolError(f"Unknown frame type {frame_type}")
 
-            with self.lock:
-                self.clients[client] = {'username': username, 'room': None, 'joined_at': datetime.now().isoformat()}
+    @staticmethod
+    def control_cost(control):
+        """What a JSON control frame is charged against the rate limits, as {kind: amount} for throttle().
+
+        Every control frame counts as a command, except that a fetch counts
+        the attachment bytes it asks for instead. Room changes run /join,
+        which charges itself, and heartbeat pongs are free: a client
+        answering pings is not busy.
+        """
+        kind = control.get('type')
+        if kind in ('change_room', 'pong'):
+            return {}
+        if kind == 'fetch':
+            return {'transfer': min(max(0, int(control.get('length', MAX_RANGE))), MAX_RANGE)}
+        return {'commands': 1}
+
+    def admit_control(self, client, control):
+        """Charge a control frame (see control_cost). A throttled fetch is answered with when to ask again."""
+        retry_after = self.throttle(client, self.control_cost(control))
+        if retry_after is None:
+            return True
+        if control.get('type') == 'fetch':
+            client.sendall(encode_json({'type': 'fetch_failed', 'request_id': control.get('request_id'),
+                                        'message': "Download throttled",
+                                        'retry_after': round(min(retry_after, 3600), 2)}))
+        return False
+
+    def transfer_wait(self, client, size):
+        """Charge `size` upload bytes to the transfer limit. Returns 0 once charged, else seconds to wait first.
+
+        Uploads are paced rather than refused, so this sends no notice and
+        counts no strike.
+        """
+        with self.lock:
+            info = self.clients.get(client)
+            if info is None:
+                return float('inf')
+            username, room = info['username'], info['room']
+        verdict = self.limiter.charge(client, username, room, {'transfer': size})
+        return 0 if verdict is None else verdict[1]
+
+    def refuse_chunk(self, client, payload):
+        """Fail the upload of a chunk too large for the transfer limit ever to admit."""
+        upload_id, _ = decode_blob(payload)
+        upload = self.pop_upload(client, upload_id)
+        if upload is not None:
+            upload.abort()
+            client.sendall(encode_json({'type': 'upload_failed', 'upload_id': upload_id,
+                                        'message': "Attachment chunk exceeds the transfer limit"}))
 
-            client.send(json.dumps({'status': 'success', 'message': message, 'rooms': list(self.rooms)}).encode('utf-8'))
+    def admit_blob(self, client, payload):
+        """Charge an upload chunk to the transfer limit, waiting for the tokens instead of dropping it.
 
-            room_data = client.recv(4096).decode('utf-8')
-            room_choice = json.loads(room_data).get('room', 'general')
-            if room_choice not in self.rooms:
-                room_choice = 'general'
+        Reading nothing more from the client meanwhile slows its sends down
+        through TCP flow control, so an upload over the limit takes longer
+        rather than failing.
+        """
+        wait = self.transfer_wait(client, len(payload))
+        while wait and wait != float('inf') and self.running:
+            time.sleep(wait)
+            wait = self.transfer_wait(client, len(payload))
+        if wait:
+            self.refuse_chunk(client, payload)
+        return not wait
 
+    def start_upload(self, client, control):
+        upload_id = int(control['upload_id'])
+        sha256 = str(control.get('sha256', '')).lower()
+        size = int(control.get('size', 0))
+        name = os.path.basename(str(control.get('name', ''))).replace('\n', ' ')[:200] or 'attachment'
+        upload = None
+        try:
+            if self.blobs.exists(sha256):
+                # Same content already stored: skip the transfer entirely
+                self.post_attachment(client, sha256, self.blobs.size(sha256), name)
+                client.sendall(encode_json({'type': 'upload_done', 'upload_id': upload_id, 'sha256': sha256, 'dedup': True}))
+                return
+            with self.lock:
+                self.check_upload_slot(client, upload_id)
+            upload = self.blobs.begin(sha256, size, name)
             with self.lock:
-                self.clients[client]['room'] = room_choice
-                self.rooms[room_choice].append(client)
+                if client in self.clients:
+                    self.check_upload_slot(client, upload_id)
+                    self.clients[client].setdefault('uploads', {})[upload_id] = upload
+                    upload = None
+            if upload is not None:
+                # The client left while the temp file was being created
+                upload.abort()
+                return
+        except AttachmentError as e:
+            if upload is not None:
+                upload.abort()
+            client.sendall(encode_json({'type': 'upload_failed', 'upload_id': upload_id, 'message': str(e)}))
+            return
+        client.sendall(encode_json({'type': 'upload_ready', 'upload_id': upload_id, 'chunk_size': CHUNK_SIZE}))
 
-            self.broadcast(room_choice, f"{username} joined the chat!", sender=client)
+    def check_upload_slot(self, client, upload_id):
+        """Refuse a reused upload id, or one upload too many, before a temp file is opened for it. Call with self.lock held."""
+        uploads = self.clients.get(client, {}).get('uploads', {})
+        if upload_id in uploads:
+            raise AttachmentError(f"Upload {upload_id} is already in progress")
+        if len(uploads) >= self.max_open_uploads:
+            raise AttachmentError(f"At most {self.max_open_uploads} uploads can be in progress at once")
 
-            history = self.db.get_messages(room_choice)
-            client.send(json.dumps({'type': 'room_change', 'room': room_choice, 'history': history}).encode('utf-8'))
+    def pop_upload(self, client, upload_id):
+        with self.lock:
+            return self.clients.get(client, {}).get('uploads', {}).pop(upload_id, None)
 
-            client.settimeout(None)
-            while self.running:
-                try:
-                    data = client.recv(4096)
-                    if not data:
-                        break
+    def receive_upload_chunk(self, client, payload):
+        upload_id, token = decode_blob(payload)
+        with self.lock:
+            upload = self.clients.get(client, {}).get('uploads', {}).get(upload_id)
+        if upload is None:
+            return
+        try:
+            upload.write(self.encryption.decrypt_bytes(token))
+        except AttachmentError as e:
+            self.pop_upload(client, upload_id)
+            client.sendall(encode_json({'type': 'upload_failed', 'upload_id': upload_id, 'message': str(e)}))
 
-                    message = self.encryption.decrypt(data)
-                    if not message:
-                        continue
+    def finish_upload(self, client, control):
+        upload_id = int(control['upload_id'])
+        upload = self.pop_upload(client, upload_id)
+        if upload is None:
+            return
+        try:
+            upload.commit()
+        except AttachmentError as e:
+            client.sendall(encode_json({'type': 'upload_failed', 'upload_id': upload_id, 'message': str(e)}))
+            return
+        self.post_attachment(client, upload.sha256, upload.size, upload.name)
+        client.sendall(encode_json({'type': 'upload_done', 'upload_id': upload_id, 'sha256': upload.sha256, 'dedup': False}))
 
-                    if message.startswith('/'):
-                        self.handle_command(message, client)
-                    else:
-                        timestamp = datetime.now().strftime('%H:%M:%S')
-                        full_msg = f"[{timestamp}] {username}: {message}"
-                        self.db.store_message(room_choice, full_msg)
-                        self.broadcast(room_choice, full_msg, sender=client)
-                except (socket.timeout, json.JSONDecodeError, ConnectionError):
-                    break
+    def post_attachment(self, client, sha256, size, name):
+        """Record the blob and send a small reference to the room in place of the file."""
+        with self.lock:
+            username = self.clients[client]['username']
+        self.db.record_attachment(sha256, size, username)
+        self.process_message(client, file_reference(sha256, size, name))
+
+    def send_attachment_range(self, client, control):
+        """Stream one range of a stored blob back to the client as FRAME_BLOB chunks."""
+        request_id = int(control['request_id'])
+        sha256 = str(control.get('sha256', '')).lower()
+        offset = max(0, int(control.get('offset', 0)))
+        with self.lock:
+            _, suite = self.encoding_of(client)
+        try:
+            size = self.blobs.size(sha256)
+            chunks = self.blobs.read_range(sha256, offset, int(control.get('length', MAX_RANGE)))
+            client.sendall(encode_json({'type': 'fetch_start', 'request_id': request_id, 'sha256': sha256,
+                                        'offset': offset, 'size': size}))
+            sent = 0
+            for chunk in chunks:
+                client.sendall(encode_blob(request_id, self.encryption.encrypt(chunk, suite=suite)))
+                sent += len(chunk)
+        except (AttachmentError, OSError) as e:
+            client.sendall(encode_json({'type': 'fetch_failed', 'request_id': request_id, 'message': str(e)}))
+            return
+        client.sendall(encode_json({'type': 'fetch_done', 'request_id': request_id, 'offset': offset, 'length': sent}))
+
+    def process_message(self, client, message):
+        self.presence.touch(client)
+        if message.startswith('/'):
+            self.handle_command(message, client)
+            return
+        room, username, message = self.compose_message(client, message)
+        if self.bus:
+            self.bus.post(room, username, message, client)
+        else:
+            self.commit_message(room, username, message, client)
+
+    def commit_message(self, room, username, message, sender=None):
+        """Persist a message, add it to the room's history and deliver it locally. Returns its record."""
+        members = self.rooms.get(room)
+        # Message ids double as the room's sequence numbers, so they must reach members in id order
+        with members.sequencer if members is not None else nullcontext():
+            record = self.message_writer.enqueue(room, username, message)
+            MESSAGES.labels(room).inc()
+            self.history.append(room, record)
+            self.deliver(room, self.db.record(record), sender)
+        return record
+
+    def store_record(self, record):
+        """Persist a message numbered elsewhere (by the federation relay); the caller delivers it."""
+        self.message_writer.append(record)
+        MESSAGES.labels(record['room']).inc()
+
+    def local_roster(self):
+        """{room: [usernames]} for the clients connected to this process."""
+        return {name: room.usernames() for name, room in self.rooms.items()}
+
+    def call_soon(self, func, *args):
+        """Run func from another thread in this server's own context: directly here, on the loop for AsyncChatServer."""
+        func(*args)
+
+    def members_changed(self):
+        if self.bus:
+            self.bus.roster_changed()
+
+    def handle_client(self, client, address, session=None, carry=b''):
+        """Serve one connection: log it in, or adopt it with its `session` if a hot restart handed it over."""
+        conn = QueuedConnection(client, self.new_outbound_queue())
+        reader = FrameReader(client)
+        parked = False
+        try:
+            if session is not None:
+                reader.pending.extend(reader.decoder.feed(carry))
+                self.adopt_client(conn, session)
+            else:
+                client.settimeout(30.0)
+                auth = reader.read_json()
+                success, message, username = self.authenticate(auth)
+
+                if not success:
+                    conn.sendall(encode_json({'status': 'failed', 'message': message}))
+                    return
+
+                encoding = self.negotiate(auth)
+                self.add_client(conn, username, encoding)
+                conn.sendall(self.login_reply(message, encoding, success))
+
+                room_request = reader.read_json()
+                room_choice = self.enter_room(conn, room_request)
+                conn.sendall(self.entry_payload(conn, room_choice, room_request))
+                conn.sendall(self.roster_payload(room_choice))
+                self.deliver_mailbox(conn, username)
+
+            parked = self.read_loop(conn, client, reader)
         except Exception as e:
-            print(f"Client error ({address}): {e}")
+            logger.warning("Client error (%s): %s", address, e)
         finally:
-            self.remove_client(client)
+            if not parked:
+                self.remove_client(conn)
+                conn.close()
+
+    def read_loop(self, conn, client, reader):
+        """Handle a client's frames until it leaves. Returns True if it parked for a hot restart instead."""
+        client.settimeout(None)
+        while self.running:
+            if self.draining:
+                return self.park(conn, reader.unread())
+            try:
+                # With hot restart on, wake up now and then to notice a handover has begun
+                if self.hot_restart and not reader.pending and not readable(client, self.handoff_poll):
+                    continue
+                frame = reader.read_frame()
+                if frame is None:
+                    break
+                self.heartbeats.seen(conn)
+                self.handle_frame(conn, *frame)
+            except (socket.timeout, json.JSONDecodeError, ConnectionError, ProtocolError):
+                break
+            except (OSError, ValueError):
+                if client.fileno() != -1:
+                    raise
+                break  # Closed by remove_client() while we waited
+        return False
+
+    def adopt_client(self, client, session):
+        """Seat a client handed over by the process this one replaced back in its room, without announcing it."""
+        encoding = {key: session.get(key) for key in ('compression', 'cipher', 'framing')}
+        encoding['heartbeat'] = self.ping_interval if session.get('heartbeat') else None
+        self.add_client(client, session['username'], encoding)
+        with self.lock:
+            self.clients[client]['joined_at'] = session['joined_at']
+            if session.get('history_cursor') is not None:
+                self.clients[client]['history_cursor'] = session['history_cursor']
+        room = self.rooms.get(session['room']) or self.rooms.get(LOBBY)
+        if self.move_client(client, room) is None:
+            return
+        self.members_changed()
+        if room.name != session['room']:
+            # Its room was deleted during the handover
+            client.sendall(self.room_change_payload(client, room.name))
+            client.sendall(self.roster_payload(room.name))
+
+    def session_state(self, client):
+        """What a new process needs to carry on serving `client` (see adopt_client), or None if it has left."""
+        with self.lock:
+            info = self.clients.get(client)
+            if info is None or not info['room']:
+                return None
+            return {key: info.get(key) for key in ('username', 'room', 'joined_at', 'compression', 'cipher',
+                                                   'heartbeat', 'framing', 'history_cursor')}
+
+    def park(self, client, carry):
+        """Stop serving a client during a hot restart, keeping `carry`, the bytes it sent that were not handled yet."""
+        with self.parked_changed:
+            if client not in self.clients:
+                return False
+            self.parked[client] = carry
+            self.parked_changed.notify_all()
+        return True
+
+    def stop_accepting(self):
+        """Wait out an accept() in progress; the accept loop in start() checks `draining` before the next one."""
+        with self.accept_lock:
+            pass
+
+    def stop_reading(self, clients):
+        """Threaded handlers notice `draining` between frames, within handoff_poll seconds."""
+
+    def detach_client(self, client):
+        return client.detach(self.handoff_timeout)
+
+    def stop(self):
+        """Make start() return and shut the server down."""
+        self.running = False
+        self.stopped.set()
+
+    def hand_off(self, channel):
+        """Hot restart: give the listening socket and every live client to the process on `channel`, then stop.
+
+        Runs on the hot restart thread (see handoff.py) once the new process
+        has connected. Clients that have not parked within handoff_timeout
+        seconds stay behind and are closed with this process; they reconnect
+        and resume their session.
+        """
+        handed = 0
+        try:
+            self.draining = True
+            channel.send({'type': 'listener'}, self.server.fileno())
+            self.stop_accepting()
+            with self.lock:
+                serving = [client for client, info in self.clients.items() if info['room']]
+            self.stop_reading(serving)
+            with self.parked_changed:
+                self.parked_changed.wait_for(lambda: all(client in self.parked for client in self.clients),
+                                             self.handoff_timeout)
+                parked = list(self.parked.items())
+            # Nobody speaks, joins or leaves here any more; make every numbered message durable
+            self.presence.stop()
+            self.message_writer.close()
+            for client, carry in parked:
+                session = self.session_state(client)
+                fd = self.detach_client(client) if session else None
+                self.remove_client(client, announce=False)
+                if fd is None:
+                    HANDED_OFF.labels('failed').inc()
+                    continue
+                try:
+                    channel.send({'type': 'client', 'session': session,
+                                  'carry': base64.b64encode(carry).decode('ascii')}, fd)
+                finally:
+                    os.close(fd)
+                HANDED_OFF.labels('ok').inc()
+                handed += 1
+            channel.send({'type': 'done'})
+        finally:
+            with self.lock:
+                left = len(self.clients)
+            logger.info("Hot restart: handed over %d connection(s), closing %d", handed, left)
+            self.stop()
 
     def handle_command(self, command, client):
         try:
@@ -138,52 +1074,135 @@ class ChatServer:
                 username = self.clients[client]['username']
                 current_room = self.clients[client]['room']
 
+            if not self.admit(client, commands=1):
+                return
+
             if command.startswith('/join '):
-                new_room = command.split(' ')[1]
-                if new_room not in self.rooms:
+                name = command.split(' ')[1]
+                room = self.rooms.get(name)
+                if room is None:
+                    client.sendall(self.encrypt_for(client, f"No such room: {name} (create it with /create {name})"))
+                elif room.name != current_room:
+                    self.switch_room(client, room)
+
+            elif command.startswith('/msg '):
+                parts = command.split(' ', 2)
+                if len(parts) < 3 or not parts[1] or not parts[2].strip():
+                    client.sendall(self.encrypt_for(client, "Usage: /msg <user> <message>"))
+                else:
+                    self.send_direct(client, parts[1], parts[2])
+
+            elif command == '/leave':
+                if current_room == LOBBY:
+                    client.sendall(self.encrypt_for(client, f"You are already in {LOBBY}"))
+                else:
+                    self.switch_room(client, self.rooms.get(LOBBY))
+
+            elif command.startswith('/create '):
+                name = command.split(' ', 1)[1].strip()
+                try:
+                    room = self.rooms.create(name, username)
+                except RoomError as e:
+                    client.sendall(self.encrypt_for(client, str(e)))
                     return
+                self.rooms_changed({'op': 'room_created', 'room': name, 'created_by': username})
+                self.switch_room(client, room)
 
-                with self.lock:
-                    if current_room == new_room:
-                        return
+            elif command.startswith('/delete '):
+                name = command.split(' ')[1]
+                try:
+                    room = self.rooms.delete(name, username)
+                except RoomError as e:
+                    client.sendall(self.encrypt_for(client, str(e)))
+                    return
+                self.close_room(room)
+                self.rooms_changed({'op': 'room_deleted', 'room': name})
 
-                    self.rooms[current_room].remove(client)
-                    self.rooms[new_room].append(client)
-                    self.clients[client]['room'] = new_room
+            elif command == '/history' or command.startswith('/history '):
+                # /history streams the next older page; /history <id> pages back from a given message
+                parts = command.split()
+                with self.lock:
+                    room = self.clients[client]['room']
+                    before_id = int(parts[1]) if len(parts) > 1 else self.clients[client].get('history_cursor')
+                oldest_id, payload = self.history_payload('history', room, self.framing_of(client), before_id)
+                with self.lock:
+                    if client in self.clients and self.clients[client]['room'] == room:
+                        self.clients[client]['history_cursor'] = oldest_id
+                client.sendall(payload)
 
-                history = self.db.get_messages(new_room)
-                client.send(json.dumps({'type': 'room_change', 'room': new_room, 'history': history}).encode('utf-8'))
+            elif command.startswith('/search '):
+                try:
+                    query = parse_query(command[len('/search '):], current_room)
+                except SearchError as e:
+                    client.sendall(self.encrypt_for(client, str(e)))
+                    return
+                client.sendall(self.search_payload(query, self.framing_of(client)))
 
-                self.broadcast(current_room, f"{username} left the room", client)
-                self.broadcast(new_room, f"{username} joined the room", client)
+            elif command.startswith('/passwd '):
+                parts = command.split(' ')
+                if len(parts) != 3:
+                    reply = "Usage: /passwd <old password> <new password>"
+                elif self.auth.submit(self.auth.change_password, username, parts[1], parts[2]).result():
+                    reply = "Password changed"
+                    if self.bus:
+                        self.bus.publish({'op': 'invalidate', 'username': username})
+                else:
+                    reply = "Password not changed: current password is wrong"
+                client.sendall(self.encrypt_for(client, reply))
 
             elif command == '/users':
                 with self.lock:
                     room = self.clients[client]['room']
-                    users = [self.clients[c]['username'] for c in self.rooms[room] if c in self.clients]
-                client.send(self.encryption.encrypt(f"Users in room ({len(users)}): {', '.join(users)}"))
+                members = self.rooms.get(room)
+                users = members.usernames() if members is not None else []
+                if self.bus:
+                    users += self.bus.remote_users(room)
+                client.sendall(self.encrypt_for(client, f"Users in room ({len(users)}): {', '.join(users)}"))
+        except FloodError:
+            raise
         except Exception as e:
-            print(f"Command error: {e}")
+            logger.error("Command error: %s", e)
 
     def start(self):
         self.running = True
-        print(f"Chat server started on {self.host}:{self.port}")
-        print(f"Available rooms: {', '.join(self.rooms)}")
+        logger.info("Chat server started on %s:%s", self.host, self.port)
+        logger.info("Available rooms: %s", ', '.join(self.rooms))
+        for client, session, carry in self.inherited_clients:
+            try:
+                client.setblocking(True)
+                address = client.getpeername()
+            except OSError:
+                client.close()
+                continue
+            threading.Thread(target=self.handle_client, args=(client, address, session, carry), daemon=True).start()
+        self.inherited_clients = []
         try:
             while self.running:
+                if self.draining:
+                    # The process taking over accepts from now on
+                    self.stopped.wait()
+                    break
                 try:
-                    client, addr = self.server.accept()
-                    print(f"Accepted connection from {addr}")
+                    # With hot restart on, only accept a connection that is already waiting, so that
+                    # once a handover begins none is taken by this process and then dropped
+                    if self.hot_restart and not readable(self.server, self.handoff_poll):
+                        continue
+                    with self.accept_lock:
+                        if self.draining:
+                            continue
+                        client, addr = self.server.accept()
+                    CONNECTIONS_TOTAL.inc()
+                    logger.debug("Accepted connection from %s", addr)
                     threading.Thread(target=self.handle_client, args=(client, addr), daemon=True).start()
                 except socket.timeout:
                     continue
         except KeyboardInterrupt:
-            print("Keyboard interrupt received. Shutting down server...")
+            logger.info("Keyboard interrupt received. Shutting down server...")
         finally:
             self.shutdown()
 
     def shutdown(self):
-        print("Shutting down server...")
+        logger.info("Shutting down server...")
         self.running = False
         with self.lock:
             for client in list(self.clients):
@@ -192,19 +1211,160 @@ class ChatServer:
                 except:
                     pass
             self.clients.clear()
-            for room in self.rooms:
-                self.rooms[room].clear()
+        for _, room in self.rooms.items():
+            room.close()
 
         if self.server:
             self.server.close()
-    
-        self.db.close_conn()  # ✅ Correctly closes the DB connection
-        print("Server shutdown complete.")
+        if self.hot_restart:
+            self.hot_restart.close()
+
+        if self.bus:
+            self.bus.close()
+        self.presence.stop()
+        self.timers.stop()
+        if self.retention:
+            self.retention.stop()
+        if self.metrics_server:
+            self.metrics_server.close()
+        self.auth.close()
+        self.message_writer.close()
+        logger.info("Message writer: %s", self.message_writer.stats())
+        logger.info("Compression: %s", self.encryption.compression.stats())
+        self.db.close()  # ✅ Closes the writer and every pooled reader
+        logger.info("Server shutdown complete.")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Encrypted chat server")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5555)
+    parser.add_argument('--mode', choices=('threaded', 'async'), default='threaded',
+                        help="threaded: one thread per client; async: single asyncio event loop")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="fork this many server processes sharing the port, with rooms sharded between them")
+    parser.add_argument('--relay', default=None, metavar='HOST:PORT',
+                        help="join a federated cluster through the relay at HOST:PORT (see federation.py)")
+    parser.add_argument('--hot-restart', default=None, metavar='PATH',
+                        help="wait on the Unix socket PATH for a replacement server; starting a server with the "
+                             "same PATH takes over the port and live connections of the one running (see handoff.py)")
+    parser.add_argument('--outbound-queue-size', type=int, default=256,
+                        help="frames buffered per client before the slow consumer policy applies")
+    parser.add_argument('--slow-consumer-policy', choices=POLICIES, default=DROP_OLDEST)
+    parser.add_argument('--slow-consumer-block-ms', type=int, default=200,
+                        help="how long the block policy waits for room before disconnecting")
+    parser.add_argument('--db-batch-size', type=int, default=200,
+                        help="flush queued messages to SQLite once this many are pending")
+    parser.add_argument('--db-flush-ms', type=int, default=50,
+                        help="flush queued messages to SQLite at least this often")
+    parser.add_argument('--db-readers', type=int, default=4,
+                        help="read-only SQLite connections pooled for history, search and logins "
+                             "(plus one writer), however many clients connect")
+    parser.add_argument('--password-scheme', choices=sorted(VERIFIERS), default='scrypt',
+                        help="KDF used for new and upgraded password hashes")
+    parser.add_argument('--attachment-dir', default='attachments',
+                        help="content-addressed store for uploaded files")
+    parser.add_argument('--max-attachment-mb', type=int, default=25)
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help="serve Prometheus metrics on this port (worker N of --workers uses port + N)")
+    parser.add_argument('--metrics-host', default='127.0.0.1')
+    parser.add_argument('--log-level', choices=LEVELS, default='info')
+    parser.add_argument('--rate-limit', action='append', default=[], metavar='[ROOM:]KIND=RATE/BURST',
+                        help="per-connection token bucket for messages, bytes, commands or transfer "
+                             "(attachment bytes), e.g. messages=5/10 or support:messages=1/3; a rate of 0 disables "
+                             "the limit (repeatable)")
+    parser.add_argument('--retain', action='append', default=[], metavar='[ROOM=]DAYS',
+                        help="archive messages older than DAYS, by default or for one room, e.g. 90 or "
+                             "support=365; 0 keeps a room's messages forever (repeatable)")
+    parser.add_argument('--archive-dir', default='archive',
+                        help="where monthly archive databases of retired messages are written")
+    parser.add_argument('--retention-interval', type=int, default=600,
+                        help="seconds between retention runs")
+    parser.add_argument('--idle-after', type=int, default=300,
+                        help="seconds without a message before a user is shown as idle")
+    parser.add_argument('--ping-interval', type=int, default=30,
+                        help="ping clients that have been quiet this many seconds")
+    parser.add_argument('--dead-after', type=int, default=90,
+                        help="close connections that have sent nothing, pongs included, for this many seconds")
+    parser.add_argument('--session-ttl', type=int, default=86400,
+                        help="seconds a session token lets a dropped client reconnect without its password")
+    parser.add_argument('--ciphers', default=','.join(CIPHER_SUITES),
+                        help="comma-separated cipher suites to accept, in order of preference "
+                             "(fernet is always used for clients that offer none)")
+    args = parser.parse_args()
+    args.ciphers = [name.strip() for name in args.ciphers.split(',') if name.strip()]
+    unknown = set(args.ciphers) - set(CIPHER_SUITES)
+    if unknown:
+        parser.error(f"unknown cipher suites: {', '.join(sorted(unknown))}")
+    if args.hot_restart and args.workers > 1:
+        parser.error("--hot-restart and --workers cannot be combined")
+    if args.relay:
+        if args.workers > 1:
+            parser.error("--relay and --workers cannot be combined")
+        host, _, port = args.relay.rpartition(':')
+        if not host or not port.isdigit():
+            parser.error("--relay must be HOST:PORT")
+        args.relay = (host, int(port))
+    args.rate_limits, args.room_rate_limits = {}, {}
+    for spec in args.rate_limit:
+        try:
+            room, kind, limit = parse_limit(spec)
+        except ValueError as e:
+            parser.error(f"--rate-limit {spec}: {e}")
+        (args.room_rate_limits.setdefault(room, {}) if room else args.rate_limits)[kind] = limit
+    args.retention = {}
+    for spec in args.retain:
+        try:
+            room, days = parse_retention(spec)
+        except ValueError as e:
+            parser.error(f"--retain {spec}: {e}")
+        args.retention[room] = days
+    return args
+
+
+def raise_interrupt(signum, frame):
+    raise KeyboardInterrupt
 
 
 if __name__ == "__main__":
+    # Let SIGTERM go through the same clean shutdown path as Ctrl+C
+    signal.signal(signal.SIGTERM, raise_interrupt)
+    args = parse_args()
+    configure_logging(args.log_level)
+    options = {
+        'outbound_queue_size': args.outbound_queue_size,
+        'slow_consumer_policy': args.slow_consumer_policy,
+        'slow_consumer_block_ms': args.slow_consumer_block_ms,
+        'db_batch_size': args.db_batch_size,
+        'db_flush_ms': args.db_flush_ms,
+        'db_readers': args.db_readers,
+        'password_scheme': args.password_scheme,
+        'attachment_dir': args.attachment_dir,
+        'max_attachment_mb': args.max_attachment_mb,
+        'cipher_suites': args.ciphers,
+        'metrics_host': args.metrics_host,
+        'metrics_port': args.metrics_port,
+        'rate_limits': args.rate_limits,
+        'room_rate_limits': args.room_rate_limits,
+        'retention': args.retention,
+        'archive_dir': args.archive_dir,
+        'retention_interval': args.retention_interval,
+        'idle_after': args.idle_after,
+        'ping_interval': args.ping_interval,
+        'dead_after': args.dead_after,
+        'session_ttl': args.session_ttl,
+        'hot_restart': args.hot_restart,
+    }
     try:
-        server = ChatServer()
-        server.start()
+        server_class = ChatServer
+        if args.mode == 'async':
+            from async_server import AsyncChatServer
+            server_class = AsyncChatServer
+        if args.workers > 1:
+            run_workers(server_class, args.host, args.port, args.workers, options)
+        elif args.relay:
+            server_class(args.host, args.port, shard=FederationBus(*args.relay), **options).start()
+        else:
+            server_class(args.host, args.port, **options).start()
     except Exception as e:
-        print(f"Failed to start server: {e}")
+        logger.error("Failed to start server: %s", e)
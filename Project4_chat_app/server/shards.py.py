@@ -0,0 +1,304 @@
+import json
+import logging
+import os
+import shutil
+import signal
+import socket
+import struct
+import tempfile
+import threading
+import weakref
+import zlib
+from database import Database
+from outbound import DROP_OLDEST, OutboundQueue, QueuedConnection
+from protocol import FRAME_JSON, FrameReader, ProtocolError, encode_frame, encode_json
+from records import Record, notice
+
+logger = logging.getLogger(__name__)
+
+# Every bus frame is a FRAME_JSON whose payload starts with (source, target)
+# worker indexes, so the broker can route without parsing the JSON.
+ROUTE = struct.Struct('>hh')
+EVERYONE = -1
+BUS_QUEUE_SIZE = 65536
+
+
+def encode_bus(source, target, message):
+    return encode_frame(FRAME_JSON, ROUTE.pack(source, target) + json.dumps(message).encode('utf-8'))
+
+
+def owner_of(room, workers):
+    """Index of the worker that orders and persists a room's messages."""
+    return zlib.crc32(room.encode('utf-8')) % workers
+
+
+class ShardBroker:
+    """Pub/sub hub run by the supervisor on a Unix socket.
+
+    Each worker connects once and says hello with its index. Frames with a
+    target go to that worker; frames for EVERYONE go to every worker but
+    the sender. Writes go through a per-worker OutboundQueue, so one busy
+    worker never stalls routing for the others.
+    """
+
+    def __init__(self, path, workers):
+        self.path = path
+        self.workers = workers
+        self.peers = {}  # {index: QueuedConnection}
+        self.lock = threading.Lock()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(workers)
+        self.running = False
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self._accept_loop, name='chat-bus-accept', daemon=True).start()
+
+    def _accept_loop(self):
+        while self.running:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                break
+            threading.Thread(target=self._serve, args=(conn,), name='chat-bus-peer', daemon=True).start()
+
+    def _route(self, source, target, frame):
+        with self.lock:
+            if target == EVERYONE:
+                peers = [peer for index, peer in self.peers.items() if index != source]
+            else:
+                peers = [self.peers[target]] if target in self.peers else []
+        for peer in peers:
+            try:
+                peer.sendall(frame)
+            except ConnectionError:
+                pass
+
+    def _serve(self, conn):
+        reader = FrameReader(conn)
+        peer = QueuedConnection(conn, OutboundQueue(BUS_QUEUE_SIZE, DROP_OLDEST))
+        index = None
+        try:
+            index = int(reader.read_json()['worker'])
+            with self.lock:
+                self.peers[index] = peer
+            self._route(index, EVERYONE, encode_bus(index, EVERYONE, {'op': 'hello'}))
+            while True:
+                frame = reader.read_frame()
+                if frame is None:
+                    break
+                source, target = ROUTE.unpack_from(frame[1])
+                self._route(source, target, encode_frame(*frame))
+        except (OSError, ConnectionError, ProtocolError, ValueError, KeyError):
+            pass
+        finally:
+            if index is not None:
+                with self.lock:
+                    if self.peers.get(index) is peer:
+                        del self.peers[index]
+                # Whatever that worker had in its rooms is gone now
+                self._route(index, EVERYONE, encode_bus(index, EVERYONE, {'op': 'roster', 'rooms': {}}))
+            peer.close()
+
+    def close(self):
+        self.running = False
+        self.sock.close()
+        with self.lock:
+            peers = list(self.peers.values())
+        for peer in peers:
+            peer.close()
+
+
+class ShardBus:
+    """A worker's connection to the broker, and the cross-shard half of ChatServer.
+
+    Any worker may accept any connection, since SO_REUSEPORT decides who
+    gets it. Each room has one owner worker, picked by hashing its name;
+    chat messages are forwarded to the owner, which gives them their id,
+    writes them and appends them to its history, then publishes the record
+    so every other worker can update its history ring and deliver it to its
+    own members. That keeps one total order per room across processes.
+    Join/leave notices skip the owner and go straight to every worker.
+    """
+
+    def __init__(self, path, index, workers, first_message_id):
+        self.path = path
+        self.index = index
+        self.workers = workers
+        self.first_message_id = first_message_id
+        self.server = None
+        self.conn = None
+        self.senders = weakref.WeakValueDictionary()  # {id(conn): conn} for echo suppression
+        self.rosters = {}  # {worker index: {room: [usernames]}}
+        self.homes = {}  # {username: index of a worker they are connected to}, rebuilt from the rosters
+        self.lock = threading.Lock()
+        self.commit_lock = threading.Lock()
+
+    def message_ids(self):
+        """(first id, step) for this worker's MessageWriter, so ids never collide across workers."""
+        return self.first_message_id + self.index, self.workers
+
+    def attach(self, server):
+        self.server = server
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        self.conn = QueuedConnection(sock, OutboundQueue(BUS_QUEUE_SIZE, DROP_OLDEST))
+        self.conn.sendall(encode_frame(FRAME_JSON, json.dumps({'worker': self.index}).encode('utf-8')))
+        threading.Thread(target=self._read_loop, args=(sock,), name='chat-bus', daemon=True).start()
+
+    def owns(self, room):
+        return owner_of(room, self.workers) == self.index
+
+    def publish(self, message, target=EVERYONE):
+        try:
+            self.conn.sendall(encode_bus(self.index, target, message))
+        except ConnectionError:
+            pass
+
+    def post(self, room, username, message, sender):
+        """Hand a chat message to the room's owner (ourselves, possibly)."""
+        self.senders[id(sender)] = sender
+        if self.owns(room):
+            self.commit(room, username, message, sender, self.index, None)
+        else:
+            self.publish({'op': 'post', 'room': room, 'username': username, 'message': message,
+                          'sender': id(sender)}, owner_of(room, self.workers))
+
+    def commit(self, room, username, message, sender, origin, sender_id):
+        # Id order, local delivery order and publish order must agree for the room's order to hold everywhere
+        with self.commit_lock:
+            record = self.server.commit_message(room, username, message, sender)
+            self.publish({'op': 'message', 'record': record, 'origin': origin, 'sender': sender_id})
+
+    def notice(self, room, message):
+        self.publish({'op': 'notice', 'room': room, 'message': message})
+
+    def presence(self, room, diff):
+        self.publish({'op': 'presence', 'room': room, 'diff': diff})
+
+    def forward_direct(self, record, sender):
+        """Send a direct message to the worker its recipient is connected to. Returns False if none is known."""
+        worker = self.worker_of(record.room)
+        if worker is None:
+            return False
+        self.publish({'op': 'direct', 'record': record}, worker)
+        return True
+
+    def roster_changed(self):
+        self.publish({'op': 'roster', 'rooms': self.server.local_roster()})
+
+    def worker_of(self, username):
+        """A worker `username` is connected to (by its last published roster), or None."""
+        with self.lock:
+            return self.homes.get(username)
+
+    def remote_users(self, room):
+        with self.lock:
+            return [user for rooms in self.rosters.values() for user in rooms.get(room, [])]
+
+    def _read_loop(self, sock):
+        reader = FrameReader(sock)
+        try:
+            while True:
+                frame = reader.read_frame()
+                if frame is None:
+                    break
+                source, _ = ROUTE.unpack_from(frame[1])
+                self.server.call_soon(self.handle, source, json.loads(frame[1][ROUTE.size:]))
+        except (OSError, ConnectionError, ProtocolError) as e:
+            logger.error("Shard bus error: %s", e)
+
+    def handle(self, source, message):
+        op = message.get('op')
+        try:
+            if op == 'post':
+                self.commit(message['room'], message['username'], message['message'], None,
+                            source, message['sender'])
+            elif op == 'message':
+                record = message['record']
+                sender = self.senders.get(message['sender']) if message['origin'] == self.index else None
+                self.server.history.append(record['room'], record)
+                self.server.deliver(record['room'], Database.record(record), sender)
+            elif op == 'presence':
+                frame = encode_json({'type': 'presence', 'room': message['room'], **message['diff']})
+                self.server.deliver_presence(message['room'], frame)
+            elif op == 'notice':
+                self.server.deliver(message['room'], notice(message['room'], message['message']))
+            elif op == 'roster':
+                with self.lock:
+                    self.rosters[source] = message['rooms']
+                    self.homes = {username: index for index, rooms in self.rosters.items()
+                                  for usernames in rooms.values() for username in usernames}
+            elif op == 'hello':
+                self.roster_changed()
+            elif op == 'direct':
+                # They may have logged off since the sender's worker last heard
+                record = Record(*message['record'])
+                if not self.server.deliver_direct(record):
+                    self.server.db.store_mail(record)
+            elif op == 'invalidate':
+                self.server.auth.invalidate(message['username'])
+            elif op == 'room_created':
+                self.server.rooms.add_local(message['room'], message['created_by'])
+                self.server.rooms_changed()
+            elif op == 'room_deleted':
+                room = self.server.rooms.remove_local(message['room'])
+                if room is not None:
+                    self.server.close_room(room)
+                self.server.rooms_changed()
+        except Exception as e:
+            logger.error("Shard bus error handling %s: %s", op, e)
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+
+
+def run_workers(server_class, host, port, workers, options):
+    """Supervisor: fork `workers` servers sharing one SO_REUSEPORT port and broker between them."""
+    db = Database(readers=1)
+    first_message_id = db.max_message_id() + 1
+    db.close()
+    bus_dir = tempfile.mkdtemp(prefix='chat-bus-')
+    path = os.path.join(bus_dir, 'bus.sock')
+    broker = ShardBroker(path, workers)
+
+    children = {}
+    for index in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                # Ctrl+C reaches the whole process group; workers stop on the supervisor's SIGTERM instead
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                broker.sock.close()
+                bus = ShardBus(path, index, workers, first_message_id)
+                server_class(host, port, shard=bus, **options).start()
+            except Exception as e:
+                logger.error("Worker %d failed: %s", index, e)
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = index
+
+    broker.start()
+    logger.info("Supervisor started %d workers on %s:%s (bus %s)", workers, host, port, path)
+    try:
+        while children:
+            pid, status = os.wait()
+            index = children.pop(pid, None)
+            if index is not None:
+                logger.warning("Worker %d exited with status %d", index, os.waitstatus_to_exitcode(status))
+    except KeyboardInterrupt:
+        logger.info("Stopping workers...")
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in list(children):
+            os.waitpid(pid, 0)
+    finally:
+        broker.close()
+        shutil.rmtree(bus_dir, ignore_errors=True)
@@ -0,0 +1,97 @@
+import json
+import os
+import socket
+import sys
+import threading
+
+import pytest
+
+# The server modules import each other by bare name, as they do when run from server/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from encryption import EncryptionManager  # noqa: E402
+from protocol import FRAME_CHAT, FRAME_JSON, FrameReader, encode_chat, encode_json  # noqa: E402
+from server import ChatServer  # noqa: E402
+
+
+@pytest.fixture
+def chat_server(tmp_path, monkeypatch):
+    """Factory for ChatServers running in this process on a free port, in a scratch directory."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('FLASK_ENV', 'development')  # the development encryption key
+    running = []
+
+    def start(server_class=ChatServer, **options):
+        options.setdefault('password_scheme', 'pbkdf2')
+        server = server_class('127.0.0.1', 0, **options)
+        server.port = server.server.getsockname()[1]
+        thread = threading.Thread(target=server.start, daemon=True)
+        thread.start()
+        running.append((server, thread))
+        return server
+
+    yield start
+    for server, thread in running:
+        server.stop()
+        thread.join(10)
+
+
+class Client:
+    """A minimal text client: logs in (registering first if needed) and enters a room."""
+
+    encryption = None
+
+    def __init__(self, port, username, room='general', password='correct horse', **auth):
+        if Client.encryption is None:
+            Client.encryption = EncryptionManager()
+        self.sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+        self.reader = FrameReader(self.sock)
+        for action in ('register', 'login'):
+            self.send_json({'action': action, 'username': username, 'password': password, **auth})
+            self.login = self.reader.read_json()
+            if self.login['status'] == 'success' or action == 'login':
+                break
+            self.sock.close()
+            self.sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+            self.reader = FrameReader(self.sock)
+        assert self.login['status'] == 'success', self.login
+        self.send_json({'room': room})
+        self.entry = self.reader.read_json()
+
+    def send_json(self, message):
+        self.sock.sendall(encode_json(message))
+
+    def say(self, text):
+        self.sock.sendall(encode_chat(self.encryption.encrypt(text)))
+
+    def receive(self):
+        """The next frame: a dict for JSON frames, text for chat, (type, payload) for anything else."""
+        frame_type, payload = self.reader.read_frame()
+        if frame_type == FRAME_JSON:
+            return json.loads(payload.decode('utf-8'))
+        if frame_type == FRAME_CHAT:
+            return self.encryption.decrypt(payload)
+        return frame_type, payload
+
+    def wait_for(self, predicate):
+        """Read frames until one matches `predicate`, and return it."""
+        while True:
+            frame = self.receive()
+            if predicate(frame):
+                return frame
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def client():
+    opened = []
+
+    def connect(*args, **kwargs):
+        opened.append(Client(*args, **kwargs))
+        return opened[-1]
+
+    yield connect
+    for each in opened:
+        each.close()
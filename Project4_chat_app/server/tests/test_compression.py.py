@@ -0,0 +1,24 @@
+import os
+
+from compression import CompressionStage
+
+
+def test_compressed_messages_count_towards_the_ratio():
+    stage = CompressionStage()
+    data = b'hello chat ' * 50
+    sent = stage.compress(data, 'zlib')
+    assert len(sent) < len(data)
+    assert stage.decompress(sent) == data
+    stats = stage.stats()['zlib']
+    assert (stats['messages'], stats['skipped'], stats['bytes_in']) == (1, 0, len(data))
+    assert stats['ratio'] < 1
+
+
+def test_messages_sent_uncompressed_are_skipped():
+    stage = CompressionStage()
+    data = os.urandom(1024)  # does not shrink
+    assert stage.compress(data, 'zlib') == data
+    assert stage.compress(b'short', 'zlib') == b'short'
+    stats = stage.stats()['zlib']
+    assert (stats['messages'], stats['skipped'], stats['bytes_in'], stats['bytes_out']) == (0, 2, 0, 0)
+    assert stats['ratio'] is None
@@ -0,0 +1,43 @@
+import time
+
+from federation import FederationBus, RelayBroker
+from records import TEXT
+
+
+def relay():
+    broker = RelayBroker('127.0.0.1', 0)
+    broker.start()
+    return broker
+
+
+def test_reconnecting_releases_the_previous_relay_link(chat_server):
+    broker = relay()
+    try:
+        bus = FederationBus('127.0.0.1', broker.sock.getsockname()[1])
+        server = chat_server(shard=bus)
+        first = bus.conn
+        bus._connect()
+        first.writer.join(5)
+        assert not first.writer.is_alive()
+        assert first.sock.fileno() == -1
+        assert bus.conn is not first
+        server.stop()
+    finally:
+        broker.close()
+
+
+def test_posted_records_keep_their_kind(chat_server, client):
+    broker = relay()
+    try:
+        bus = FederationBus('127.0.0.1', broker.sock.getsockname()[1])
+        server = chat_server(shard=bus, rate_limits={'messages': (0, 0)})
+        alice = client(server.port, 'alice')
+        alice.say("hello cluster")
+        # Numbered by the relay and back through handle(); the sender gets no echo, so watch the history
+        deadline = time.monotonic() + 5
+        while not server.history.recent('general')[0] and time.monotonic() < deadline:
+            time.sleep(0.05)
+        record = server.history.recent('general')[0][-1]
+        assert (record['message'], record['kind']) == ("hello cluster", TEXT)
+    finally:
+        broker.close()
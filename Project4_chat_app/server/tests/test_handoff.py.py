@@ -0,0 +1,65 @@
+import os
+import socket
+import time
+
+from handoff import Channel, take_over
+
+
+def test_cold_start_when_nothing_listens(tmp_path):
+    assert take_over(str(tmp_path / 'nobody.sock')) is None
+
+
+def test_channel_carries_a_descriptor_with_its_frame():
+    left, right = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    read_end, write_end = os.pipe()
+    sender, receiver = Channel(left), Channel(right)
+    try:
+        sender.send({'type': 'hello'})
+        sender.send({'type': 'client', 'session': {'username': 'alice'}}, write_end)
+        assert receiver.receive() == ({'type': 'hello'}, None)
+        message, fd = receiver.receive()
+        assert message['session'] == {'username': 'alice'}
+        os.write(fd, b'ping')
+        os.close(fd)
+        assert os.read(read_end, 4) == b'ping'
+        sender.close()
+        assert receiver.receive() == (None, None)
+    finally:
+        receiver.close()
+        os.close(read_end)
+        os.close(write_end)
+
+
+def is_line(text):
+    return lambda frame: isinstance(frame, str) and frame.endswith(text)
+
+
+def test_hot_restart_keeps_clients_connected(chat_server, client):
+    old = chat_server(hot_restart='handoff.sock', rate_limits={'messages': (0, 0)})
+    old.handoff_poll = 0.1
+    alice = client(old.port, 'alice')
+    bob = client(old.port, 'bob')
+    alice.say("before the restart")
+    bob.wait_for(is_line("alice: before the restart"))
+
+    new = chat_server(hot_restart='handoff.sock', rate_limits={'messages': (0, 0)})
+    assert old.stopped.wait(5)
+    assert new.port == old.port
+
+    # The new process adopts the inherited clients on their own handler threads
+    deadline = time.monotonic() + 5
+    while len([info for info in new.clients.values() if info['room']]) < 2 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert sorted(info['username'] for info in new.clients.values()) == ['alice', 'bob']
+
+    # Same sockets, now served by the new process, still in their room and with their cipher
+    alice.say("after the restart")
+    bob.wait_for(is_line("alice: after the restart"))
+
+    # The inherited listener accepts newcomers, and message ids carry on from the old process
+    carol = client(new.port, 'carol')
+    history = carol.entry['history']
+    assert history[-2].endswith("alice: before the restart")
+    assert history[-1].endswith("alice: after the restart")
+    records = new.history.recent('general')[0]
+    assert records[-1]['id'] == records[-2]['id'] + 1
@@ -0,0 +1,47 @@
+from ratelimit import RateLimiter, TokenBucket, parse_limit
+
+
+def test_bucket_refills_at_its_rate():
+    bucket = TokenBucket(2, 4, now=0.0)
+    assert all(bucket.take(now=0.0) for _ in range(4))
+    assert not bucket.take(now=0.0)
+    assert bucket.take(now=0.5)
+    assert bucket.wait_for(1) == 0.5
+
+
+def test_parse_limit():
+    assert parse_limit('messages=5/10') == (None, 'messages', (5.0, 10.0))
+    assert parse_limit('support:commands=1') == ('support', 'commands', (1.0, 1))
+
+
+def test_switching_rooms_does_not_refill_the_budget():
+    limiter = RateLimiter({'commands': (1, 5)})
+    conn = object()
+    allowed = [limiter.charge(conn, 'alice', f'hop{n}', {'commands': 1}) is None for n in range(30)]
+    assert allowed == [True] * 5 + [False] * 25
+
+
+def test_room_override_keeps_a_bucket_of_its_own():
+    limiter = RateLimiter({'messages': (1, 3)}, {'support': {'messages': (1, 1)}})
+    conn = object()
+    assert limiter.charge(conn, 'alice', 'support', {'messages': 1}) is None
+    kind, _ = limiter.charge(conn, 'alice', 'support', {'messages': 1})
+    assert kind == 'messages'
+    # The stricter room's bucket is separate from the default one every other room shares
+    assert [limiter.charge(conn, 'alice', room, {'messages': 1}) is None
+            for room in ('general', 'random', 'dev', 'general')] == [True, True, True, False]
+
+
+def test_connections_of_one_user_share_the_user_budget():
+    limiter = RateLimiter({'commands': (1, 2)}, user_factor=2)
+    conns = [object() for _ in range(5)]
+    verdicts = [limiter.charge(conn, 'alice', 'general', {'commands': 1}) for conn in conns]
+    assert [verdict is None for verdict in verdicts] == [True] * 4 + [False]
+
+
+def test_charge_is_all_or_nothing():
+    limiter = RateLimiter({'messages': (1, 10), 'bytes': (100, 100)})
+    conn = object()
+    assert limiter.charge(conn, 'alice', 'general', {'messages': 1, 'bytes': 150})[0] == 'bytes'
+    # The rejected charge took no messages either
+    assert all(limiter.charge(conn, 'alice', 'general', {'messages': 1}) is None for _ in range(5))
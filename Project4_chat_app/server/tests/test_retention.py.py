@@ -0,0 +1,75 @@
+import sqlite3
+import time
+
+import pytest
+
+from database import Database
+from persistence import MessageWriter
+from records import TEXT
+from retention import Archive, RetentionJob
+
+DAY_MS = 86400 * 1000
+
+
+def old_row(message_id, message, days=40):
+    return (message_id, 'general', 'alice', message, int(time.time() * 1000) - days * DAY_MS, TEXT)
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / 'chat.db')
+    db = Database(path)
+    db.register_user('alice', 'hash')
+    db.close()
+    return path
+
+
+def archived_ids(path):
+    with sqlite3.connect(path) as conn:
+        return [row[0] for row in conn.execute("SELECT id FROM messages ORDER BY id")]
+
+
+def test_ids_carry_on_after_retention_empties_the_table(db_path, tmp_path):
+    db = Database(db_path)
+    db.store_messages([old_row(message_id, f"message {message_id}") for message_id in range(1, 6)])
+    job = RetentionJob(db, {None: 30}, str(tmp_path / 'archive'), batch_pause=0)
+    assert job.run_once()['archived'] == {'general': 5}
+    db.close()
+
+    # A restart numbers the next message after the archived ones, not from 1 again
+    db = Database(db_path)
+    assert db.max_message_id() == 5
+    writer = MessageWriter(db)
+    message_id = next(writer.ids)
+    writer.append(dict(zip(('id', 'room', 'username', 'message', 'sent_at', 'kind'),
+                           old_row(message_id, "after the restart"))))
+    writer.close()
+    assert message_id == 6
+
+    files = RetentionJob(db, {None: 30}, str(tmp_path / 'archive'), batch_pause=0).run_once()['archive_files']
+    db.close()
+    assert archived_ids(files[0]) == [1, 2, 3, 4, 5, 6]
+
+
+def row(message_id, message):
+    return {'id': message_id, 'room': 'general', 'username': 'alice', 'message': message,
+            'timestamp': '2026-01-02 03:04:05', 'kind': TEXT, 'sent_at': 1767323045000}
+
+
+class ArchiveRow(dict):
+    """Rows come from sqlite3.Row: read by column name, turned into a tuple in column order."""
+
+    def __iter__(self):
+        return iter(self.values())
+
+
+def test_archive_refuses_a_different_message_under_an_archived_id(tmp_path):
+    archive = Archive(str(tmp_path / 'archive'))
+    first = ArchiveRow(row(1, "first"))
+    path, = archive.write([first])
+    # Retrying after a crash between archiving and deleting is harmless
+    archive.write([first, ArchiveRow(row(2, "second"))])
+    with pytest.raises(sqlite3.IntegrityError):
+        archive.write([ArchiveRow(row(3, "third")), ArchiveRow(row(1, "not the first"))])
+    archive.close()
+    assert archived_ids(path) == [1, 2]
@@ -0,0 +1,79 @@
+import threading
+
+import pytest
+
+from rooms import RoomError, RoomRegistry
+
+
+class SlowDatabase:
+    """A rooms table whose writes wait for `release`, like ones queued behind a write-behind flush."""
+
+    def __init__(self):
+        self.names = set()
+        self.writing = threading.Event()
+        self.release = threading.Event()
+
+    def list_rooms(self):
+        return []
+
+    def write(self):
+        self.writing.set()
+        assert self.release.wait(5)
+
+    def create_room(self, name, created_by):
+        self.write()
+        if name in self.names:
+            return False
+        self.names.add(name)
+        return True
+
+    def delete_room(self, name):
+        self.write()
+        self.names.discard(name)
+        return True
+
+
+def in_background(target, *args):
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_lookups_do_not_wait_for_room_writes():
+    db = SlowDatabase()
+    registry = RoomRegistry(db)
+    registry.load()
+    creating = in_background(registry.create, 'lounge', 'alice')
+    assert db.writing.wait(5)
+    # Broadcasts look rooms up while the INSERT is still queued
+    assert registry.get('general') is not None
+    assert 'lounge' not in registry
+    db.release.set()
+    creating.join(5)
+    assert registry.get('lounge').created_by == 'alice'
+
+    db.writing.clear()
+    db.release.clear()
+    deleting = in_background(registry.delete, 'lounge', 'alice')
+    assert db.writing.wait(5)
+    assert registry.get('general') is not None
+    db.release.set()
+    deleting.join(5)
+    assert 'lounge' not in registry
+
+
+def test_create_and_delete_checks():
+    db = SlowDatabase()
+    db.release.set()
+    registry = RoomRegistry(db)
+    registry.load()
+    room = registry.create('lounge', 'alice')
+    with pytest.raises(RoomError):
+        registry.create('lounge', 'bob')
+    with pytest.raises(RoomError):
+        registry.delete('lounge', 'bob')
+    with pytest.raises(RoomError):
+        registry.delete('general', 'alice')
+    assert registry.delete('lounge', 'alice') is room
+    with pytest.raises(RoomError):
+        registry.delete('lounge', 'alice')
@@ -0,0 +1,151 @@
+import hashlib
+import os
+import time
+
+import pytest
+
+from async_server import AsyncChatServer
+from attachments import CHUNK_SIZE, MAX_RANGE
+from protocol import FRAME_BLOB, decode_blob, encode_blob
+from server import ChatServer
+
+
+def is_type(kind):
+    return lambda frame: isinstance(frame, dict) and frame.get('type') == kind
+
+
+def test_control_frames_are_charged_as_commands(chat_server, client):
+    server = chat_server(rate_limits={'commands': (1, 3)})
+    alice = client(server.port, 'alice')
+    for upload_id in range(10):
+        alice.send_json({'type': 'upload_start', 'upload_id': upload_id, 'sha256': 'not a digest', 'size': 1})
+    answered = []
+    throttled = alice.wait_for(lambda frame: answered.append(frame) or is_type('throttled')(frame))
+    assert throttled['kind'] == 'commands'
+    # Only the burst reached the blob store
+    assert len([frame for frame in answered if is_type('upload_failed')(frame)]) == 3
+
+
+def test_heartbeat_pongs_are_free(chat_server, client):
+    server = chat_server(rate_limits={'commands': (1, 3)})
+    alice = client(server.port, 'alice')
+    for _ in range(10):
+        alice.send_json({'type': 'pong'})
+    alice.send_json({'type': 'upload_start', 'upload_id': 1, 'sha256': 'not a digest', 'size': 1})
+    answer = alice.wait_for(lambda frame: is_type('upload_failed')(frame) or is_type('throttled')(frame))
+    assert answer['type'] == 'upload_failed'
+
+
+def test_fetch_is_charged_the_bytes_it_asks_for(chat_server, client):
+    server = chat_server(rate_limits={'transfer': (1, 1024 * 1024)})
+    alice = client(server.port, 'alice')
+    for request_id in range(2):
+        alice.send_json({'type': 'fetch', 'request_id': request_id, 'sha256': '0' * 64, 'length': 1024 * 1024})
+    missing = alice.wait_for(is_type('fetch_failed'))
+    assert missing['request_id'] == 0 and 'retry_after' not in missing
+    # A throttled fetch is still answered, with when to ask again
+    throttled = alice.wait_for(is_type('fetch_failed'))
+    assert throttled['request_id'] == 1 and throttled['retry_after'] > 0
+
+
+def temp_files(server):
+    return os.listdir(server.blobs.temp_dir)
+
+
+def start_upload(alice, upload_id, data=b'attachment'):
+    alice.send_json({'type': 'upload_start', 'upload_id': upload_id, 'sha256': hashlib.sha256(data).hexdigest(),
+                     'size': len(data), 'name': 'notes.txt'})
+    return alice.wait_for(lambda frame: isinstance(frame, dict) and frame.get('upload_id') == upload_id)
+
+
+def test_reused_upload_id_is_refused(chat_server, client):
+    server = chat_server(rate_limits={'commands': (0, 0)})
+    alice = client(server.port, 'alice')
+    assert start_upload(alice, 1)['type'] == 'upload_ready'
+    for _ in range(20):
+        assert start_upload(alice, 1)['type'] == 'upload_failed'
+    assert len(temp_files(server)) == 1
+
+
+def test_open_uploads_per_connection_are_capped(chat_server, client):
+    server = chat_server(rate_limits={'commands': (0, 0)})
+    alice = client(server.port, 'alice')
+    replies = [start_upload(alice, upload_id)['type'] for upload_id in range(server.max_open_uploads + 3)]
+    assert replies == ['upload_ready'] * server.max_open_uploads + ['upload_failed'] * 3
+    assert len(temp_files(server)) == server.max_open_uploads
+
+
+def test_abandoned_uploads_are_cleaned_up(chat_server, client):
+    server = chat_server(rate_limits={'commands': (0, 0)})
+    alice = client(server.port, 'alice')
+    for upload_id in range(3):
+        start_upload(alice, upload_id)
+    assert len(temp_files(server)) == 3
+    alice.close()
+    deadline = time.monotonic() + 5
+    while temp_files(server) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert temp_files(server) == []
+
+
+def upload(alice, upload_id, data):
+    """Send `data` back to back in CHUNK_SIZE pieces, as the client does, and return the server's verdict."""
+    assert start_upload(alice, upload_id, data)['type'] == 'upload_ready'
+    for offset in range(0, len(data), CHUNK_SIZE):
+        alice.sock.sendall(encode_blob(upload_id, alice.encryption.encrypt(data[offset:offset + CHUNK_SIZE])))
+    alice.send_json({'type': 'upload_end', 'upload_id': upload_id})
+    return alice.wait_for(lambda frame: is_type('upload_done')(frame) or is_type('upload_failed')(frame))
+
+
+def download(alice, request_id, sha256, size):
+    """Fetch a blob range by range, asking again after a throttled range's retry_after. Returns (data, retries)."""
+    data, retries = bytearray(), 0
+    while len(data) < size:
+        alice.send_json({'type': 'fetch', 'request_id': request_id, 'sha256': sha256, 'offset': len(data),
+                         'length': MAX_RANGE})
+        while True:
+            frame = alice.receive()
+            if isinstance(frame, tuple) and frame[0] == FRAME_BLOB:
+                data += alice.encryption.decrypt_bytes(decode_blob(frame[1])[1])
+            elif is_type('fetch_done')(frame):
+                break
+            elif is_type('fetch_failed')(frame):
+                assert 'retry_after' in frame, frame
+                retries += 1
+                time.sleep(frame['retry_after'])
+                break
+    return bytes(data), retries
+
+
+def test_upload_completes(chat_server, client):
+    server = chat_server()
+    alice = client(server.port, 'alice')
+    data = os.urandom(3 * CHUNK_SIZE // 2)
+    done = upload(alice, 7, data)
+    assert done['sha256'] == hashlib.sha256(data).hexdigest()
+    assert server.blobs.exists(done['sha256']) and temp_files(server) == []
+
+
+@pytest.mark.parametrize('server_class', [ChatServer, AsyncChatServer])
+def test_large_attachments_under_the_default_limits(chat_server, client, server_class):
+    server = chat_server(server_class)
+    alice = client(server.port, 'alice')
+    data = os.urandom(5 * 1024 * 1024)  # more than the chat bytes burst
+    done = upload(alice, 1, data)
+    assert done['type'] == 'upload_done', done
+    fetched, retries = download(alice, 2, done['sha256'], len(data))
+    assert fetched == data and retries == 0
+
+
+@pytest.mark.parametrize('server_class', [ChatServer, AsyncChatServer])
+def test_transfers_over_the_limit_are_paced_not_failed(chat_server, client, server_class):
+    server = chat_server(server_class, rate_limits={'transfer': (4 * 1024 * 1024, 1024 * 1024)})
+    alice = client(server.port, 'alice')
+    data = os.urandom(3 * 1024 * 1024)
+    started = time.monotonic()
+    done = upload(alice, 1, data)
+    assert done['type'] == 'upload_done', done
+    assert time.monotonic() - started > 0.25
+    # The upload used up the burst, so some ranges are refused with a retry_after first
+    fetched, retries = download(alice, 2, done['sha256'], len(data))
+    assert fetched == data and retries > 0
@@ -0,0 +1,119 @@
+import socket
+import threading
+import time
+
+from async_server import AsyncChatServer
+from auth import SessionTokens
+from protocol import FrameReader, encode_json
+
+
+def tokens(stored, ttl=60):
+    return SessionTokens(b'k' * 32, stored.get, ttl)
+
+
+def test_token_round_trip():
+    sessions = tokens({'alice': 'hash-1'})
+    token = sessions.issue('alice')
+    assert sessions.username_of(token) == 'alice'
+    assert sessions.verify(token) == 'alice'
+    renewed = sessions.renew(token)
+    assert sessions.verify(renewed) == 'alice'
+
+
+def test_unknown_user_gets_no_token():
+    assert tokens({}).issue('nobody') is None
+
+
+def test_tampered_tokens_are_refused():
+    sessions = tokens({'alice': 'hash-1', 'bob': 'hash-2'})
+    encoded, expires, mac = sessions.issue('alice').split('.')
+    bob = sessions.issue('bob').split('.')[0]
+    for forged in (f"{bob}.{expires}.{mac}", f"{encoded}.{int(expires) + 1}.{mac}", f"{encoded}.{expires}.AAAA",
+                   'garbage', '', None):
+        assert sessions.verify(forged) is None
+        assert sessions.renew(forged) is False
+    assert sessions.username_of('!!!') == ''
+
+
+def test_tokens_from_another_key_are_refused():
+    stored = {'alice': 'hash-1'}
+    assert tokens(stored).verify(SessionTokens(b'x' * 32, stored.get).issue('alice')) is None
+
+
+def test_expired_tokens_are_refused():
+    sessions = tokens({'alice': 'hash-1'}, ttl=-1)
+    assert sessions.verify(sessions.issue('alice')) is None
+
+
+def test_password_change_revokes_tokens():
+    stored = {'alice': 'hash-1'}
+    sessions = tokens(stored)
+    token = sessions.issue('alice')
+    stored['alice'] = 'hash-2'
+    assert sessions.verify(token) is None
+    del stored['alice']
+    assert sessions.verify(token) is None
+
+
+def resume(port, token, **room_request):
+    sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+    reader = FrameReader(sock)
+    sock.sendall(encode_json({'action': 'resume', 'token': token}))
+    reply = reader.read_json()
+    if reply['status'] == 'success':
+        sock.sendall(encode_json({'room': 'general', **room_request}))
+        return sock, reply, reader.read_json()
+    sock.close()
+    return None, reply, None
+
+
+def test_resumed_session_gets_only_what_it_missed(chat_server, client):
+    server = chat_server(rate_limits={'messages': (0, 0)})
+    alice = client(server.port, 'alice', resume=True)
+    token = alice.login['session']
+    assert alice.login['framing'] == 'sequenced'
+    since = alice.entry['latest_id']
+    alice.close()
+
+    bob = client(server.port, 'bob')
+    bob.say("while you were away")
+    deadline = time.monotonic() + 5
+    while not server.history.recent('general')[0] and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    sock, reply, entry = resume(server.port, token, since=since)
+    try:
+        assert reply['message'] == "Session resumed"
+        assert reply['session']  # renewed, for the next reconnect
+        assert entry['resumed'] is True
+        assert entry['history'][-1].endswith("bob: while you were away")
+        assert entry['oldest_id'] > since
+    finally:
+        sock.close()
+
+
+def test_resume_with_a_forged_token_fails(chat_server, client):
+    server = chat_server()
+    token = client(server.port, 'alice', resume=True).login['session']
+    encoded, expires, mac = token.split('.')
+    sock, reply, _ = resume(server.port, f"{encoded}.{int(expires) + 60}.{mac}")
+    assert sock is None
+    assert reply['status'] != 'success'
+    assert reply['message'] == "Session expired, please log in again"
+
+
+def test_async_resume_reads_history_off_the_event_loop(chat_server, client):
+    server = chat_server(AsyncChatServer)
+    alice = client(server.port, 'alice', resume=True)
+    token, since = alice.login['session'], alice.entry['latest_id']
+    alice.close()
+    reading = []
+    history_since = server.history.since
+    server.history.since = lambda *args: reading.append(threading.current_thread().name) or history_since(*args)
+
+    sock, reply, entry = resume(server.port, token, since=since)
+    try:
+        assert entry['resumed'] is True
+        assert reading and reading[0].startswith('chat-db')
+    finally:
+        sock.close()
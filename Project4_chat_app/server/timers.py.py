@@ -0,0 +1,70 @@
+import logging
+import math
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class TimerWheel:
+    """Hashed timer wheel: one thread and one array of slots for every timeout in the server.
+
+    Scheduling, rescheduling and cancelling are O(1) dict operations, and
+    each tick only looks at the one slot that came due, however many timers
+    exist. Timers are meant to be lazy: hot paths just stamp a "last seen"
+    time, and the callback compares it with the clock when the slot comes
+    round, rescheduling itself if the deadline moved. A delay longer than
+    the wheel's span fires early, at the end of the span, for the same
+    re-check. Callbacks run on the wheel thread and must not block.
+    """
+
+    def __init__(self, tick=1.0, slots=512):
+        self.tick_seconds = tick
+        self.slots = [{} for _ in range(slots)]  # [{key: callback}]
+        self.where = {}  # {key: slot index}
+        self.current = 0
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='chat-timers', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+
+    def schedule(self, key, delay, callback):
+        """Call callback(key) about `delay` seconds from now, replacing any timer already set for `key`."""
+        ticks = min(len(self.slots) - 1, max(1, math.ceil(delay / self.tick_seconds)))
+        with self.lock:
+            old = self.where.get(key)
+            if old is not None:
+                self.slots[old].pop(key, None)
+            index = (self.current + ticks) % len(self.slots)
+            self.slots[index][key] = callback
+            self.where[key] = index
+
+    def cancel(self, key):
+        with self.lock:
+            index = self.where.pop(key, None)
+            if index is not None:
+                self.slots[index].pop(key, None)
+
+    def __len__(self):
+        return len(self.where)
+
+    def tick(self):
+        """Advance one slot and fire its timers."""
+        with self.lock:
+            self.current = (self.current + 1) % len(self.slots)
+            due, self.slots[self.current] = self.slots[self.current], {}
+            for key in due:
+                del self.where[key]
+        for key, callback in due.items():
+            try:
+                callback(key)
+            except Exception as e:
+                logger.error("Timer %r failed: %s", key, e)
+
+    def _run(self):
+        while not self.stopping.wait(self.tick_seconds):
+            self.tick()